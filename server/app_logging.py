@@ -0,0 +1,148 @@
+"""
+構造化ログの設定モジュール
+
+ログはキューに積むだけでイベントループを止めず、別スレッドで書き出す。
+各レコードにはコンテキスト変数から現在のセッション・タスク・ステップのIDを
+付けるため、並行して動く複数のタスクのログを後から追いかけられる。
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+# ログに付ける相関ID（asyncioのタスクごとに引き継がれる）
+session_id_var = contextvars.ContextVar("log_session_id", default=None)
+task_id_var = contextvars.ContextVar("log_task_id", default=None)
+step_id_var = contextvars.ContextVar("log_step_id", default=None)
+
+NOISY_LOGGERS = ("httpx", "httpcore")
+
+CORRELATION_FIELDS = (
+    ("session_id", session_id_var),
+    ("task_id", task_id_var),
+    ("step_id", step_id_var),
+)
+
+
+def bind(session_id=None, task_id=None, step_id=None):
+    """
+    現在のコンテキストの相関IDを設定する（Noneの項目は変更しない）
+    """
+    if session_id is not None:
+        session_id_var.set(session_id)
+    if task_id is not None:
+        task_id_var.set(task_id)
+    if step_id is not None:
+        step_id_var.set(step_id)
+
+
+class LazyJSON:
+    """
+    ログに出力されるときだけJSONに変換する値（無効なレベルのログでは変換しない）
+    """
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = json.dumps(self.value, ensure_ascii=False, default=str)
+        return text[:self.limit] if self.limit else text
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    ログを出力したコンテキストの相関IDをレコードに付ける
+    """
+
+    def filter(self, record):
+        for name, var in CORRELATION_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, var.get())
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, _ in CORRELATION_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        ids = " ".join(
+            f"{name}={getattr(record, name)}" for name, _ in CORRELATION_FIELDS if getattr(record, name, None)
+        )
+        return f"{text} [{ids}]" if ids else text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        # キューが一杯で捨てたログの数
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # 引数が後から変更されても影響しないよう、メッセージはここで組み立てて渡す
+        # （出力されないレベルのログはここに来ないため、組み立ては必要な分だけ行われる）
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level="INFO", fmt="json", max_queue=10000):
+    """
+    ルートロガーにキュー経由のハンドラーを設定し、書き出し用のリスナーを開始して返す
+
+    キューが一杯の場合はログを捨て、呼び出し側を待たせない。
+    """
+    log_queue = queue.Queue(max_queue)
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(CorrelationFilter())
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        if isinstance(existing, _QueueHandler):
+            root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # リクエストごとに出力されるHTTPクライアントのログは警告以上のみにする
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    listener.start()
+    return listener
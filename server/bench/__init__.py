@@ -0,0 +1,10 @@
+"""
+GPUやモデルなしでサーバーの性能を測るためのツール
+
+- fake_ollama: 遅延・生成速度・返す実行計画を指定できるOllamaの代わりのサーバー
+- agent_bench: 複数のセッションからタスクを投げ、処理時間やサーバーのCPU・メモリを測る
+- ws_load: 多数のWebSocket接続への配信と、再接続時の履歴の再送の負荷を測る
+- memory_bench: ストアに保持するメッセージ・アクションなど1件あたりのメモリ使用量を比べる
+
+serverディレクトリで python -m bench.agent_bench のように実行する。
+"""
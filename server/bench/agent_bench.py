@@ -0,0 +1,182 @@
+"""
+エージェントの処理全体のベンチマーク
+
+偽のOllama（bench.fake_ollama）とサーバーを起動し、複数のセッションから同時に
+タスクを投げて、タスクの完了までの時間・最初のイベントが届くまでの時間の分布と、
+その間のサーバーのCPU時間・メモリ使用量（RSS）を測る。
+
+    python -m bench.agent_bench --sessions 20 --tasks-per-session 3 --latency 0.2
+
+--server-url を指定すると起動済みのサーバーに対して実行する（--server-pid を
+指定すればそのプロセスのCPU・メモリも測る。/proc のあるLinuxのみ）。
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import websockets
+
+from bench.harness import ProcessSampler, add_server_arguments, distribution, format_seconds, server_stack
+
+# メッセージの送信時にサーバーがすぐに返すイベント（エージェントの処理によるものではない）
+ECHO_STATES = {"planning"}
+
+
+class TaskResult:
+    def __init__(self):
+        self.status = "timeout"
+        self.latency = None
+        self.first_event = None
+        self.first_step = None
+        self.events = 0
+
+
+async def run_task(client, ws, base_url, session_id, prompt, timeout, finished_tasks):
+    """
+    メッセージを送信し、エージェントが待機状態に戻るまでのイベントを受け取る
+
+    前のタスクの要約など、完了済みのタスクについて後から届くイベントは数えない。
+    """
+    result = TaskResult()
+    started = time.monotonic()
+    response = await client.post(f"{base_url}/api/chat/sessions/{session_id}/messages", data={"content": prompt})
+    response.raise_for_status()
+    busy = False
+    task_id = task_status = None
+    deadline = started + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return result
+        try:
+            raw = await asyncio.wait_for(ws.recv(), remaining)
+        except asyncio.TimeoutError:
+            return result
+        event = json.loads(raw)
+        elapsed = time.monotonic() - started
+        event_type, data = event.get("type"), event.get("data")
+        if event_type == "message" and isinstance(data, dict) and data.get("role") == "user":
+            continue
+        if event_type == "agent_state" and data in ECHO_STATES:
+            continue
+        if event_type == "task" and isinstance(data, dict) and data.get("id") in finished_tasks:
+            continue
+        if event_type == "message" and not busy:
+            continue
+        result.events += 1
+        if result.first_event is None:
+            result.first_event = elapsed
+        if event_type == "task_step" and result.first_step is None:
+            result.first_step = elapsed
+        if event_type == "task" and isinstance(data, dict):
+            task_id, task_status = data.get("id"), data.get("status")
+        if event_type == "agent_state":
+            if data != "idle":
+                busy = True
+            elif busy:
+                result.latency = elapsed
+                result.status = task_status if task_status in ("completed", "failed") else "failed"
+                finished_tasks.add(task_id)
+                return result
+
+
+async def drain(ws, quiet=0.2):
+    """
+    接続直後に送られてくる既存の履歴を読み捨てる
+    """
+    while True:
+        try:
+            await asyncio.wait_for(ws.recv(), quiet)
+        except asyncio.TimeoutError:
+            return
+
+
+async def run_session(index, base_url, model, tasks, prompt, timeout):
+    ws_url = base_url.replace("http", "ws", 1)
+    async with httpx.AsyncClient(timeout=30) as client:
+        response = await client.post(
+            f"{base_url}/api/chat/sessions", params={"model_id": model, "title": f"bench-{index}"}
+        )
+        response.raise_for_status()
+        session_id = response.json()["id"]
+        results = []
+        finished_tasks = set()
+        async with websockets.connect(f"{ws_url}/ws/chat/{session_id}", max_size=None) as ws:
+            await drain(ws)
+            for _ in range(tasks):
+                results.append(await run_task(client, ws, base_url, session_id, prompt, timeout, finished_tasks))
+        await client.delete(f"{base_url}/api/chat/sessions/{session_id}")
+        return results
+
+
+def print_report(report):
+    tasks = report["tasks"]
+    print(f"セッション数: {report['sessions']}  タスク数: {tasks['total']}"
+          f"（完了 {tasks['completed']} / 失敗 {tasks['failed']} / タイムアウト {tasks['timeout']}）")
+    print(f"所要時間: {report['elapsed_seconds']:.2f}秒  スループット: {report['tasks_per_second']:.2f} タスク/秒")
+    print(f"{'（秒）':<16}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}")
+    for label, key in (("タスクの完了", "latency"), ("最初のイベント", "first_event"), ("最初のステップ", "first_step")):
+        dist = report[key]
+        print(f"{label:<14}" + "".join(format_seconds(dist[name]) for name in ("p50", "p95", "p99", "max")))
+    server = report.get("server")
+    if server:
+        print(f"サーバー: CPU {server['cpu_seconds']:.2f}秒（平均 {server['cpu_percent']:.1f}%）"
+              f"  RSS {server['rss_start_mb']:.1f}MB → 最大 {server['rss_peak_mb']:.1f}MB")
+    else:
+        print("サーバー: CPU・メモリは測定していません（プロセスが不明か /proc がありません）")
+
+
+async def run_benchmark(args):
+    async with server_stack(args, prefix="agent-bench-") as (base_url, server_pid):
+        sampler = ProcessSampler(server_pid, args.sample_interval)
+        sampler.start()
+        started = time.monotonic()
+        sessions = await asyncio.gather(*(
+            run_session(i, base_url, args.model, args.tasks_per_session, args.prompt, args.task_timeout)
+            for i in range(args.sessions)
+        ))
+        elapsed = time.monotonic() - started
+        server_report = await sampler.stop()
+
+    results = [result for session in sessions for result in session]
+    finished = [result for result in results if result.latency is not None]
+    return {
+        "sessions": args.sessions,
+        "tasks": {
+            "total": len(results),
+            "completed": sum(result.status == "completed" for result in results),
+            "failed": sum(result.status == "failed" for result in results),
+            "timeout": sum(result.status == "timeout" for result in results)
+        },
+        "elapsed_seconds": elapsed,
+        "tasks_per_second": len(finished) / elapsed if elapsed > 0 else 0.0,
+        "latency": distribution([result.latency for result in finished]),
+        "first_event": distribution([result.first_event for result in results if result.first_event is not None]),
+        "first_step": distribution([result.first_step for result in results if result.first_step is not None]),
+        "events_per_task": sum(result.events for result in results) / len(results) if results else 0,
+        "server": server_report
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エージェントの処理全体のベンチマーク")
+    parser.add_argument("--sessions", type=int, default=10, help="同時に動かすセッション数")
+    parser.add_argument("--tasks-per-session", type=int, default=1, help="セッションごとに順番に投げるタスク数")
+    parser.add_argument("--prompt", default="メモを作成して内容を確認してください", help="送信するメッセージ")
+    parser.add_argument("--task-timeout", type=float, default=120.0, help="1タスクあたりの待ち時間の上限（秒）")
+    add_server_arguments(parser)
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
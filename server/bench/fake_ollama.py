@@ -0,0 +1,204 @@
+"""
+Ollamaの代わりに決まった応答を返すサーバー
+
+/api/tags・/api/generate・/api/chat（ストリーミングと非ストリーミング）・/api/show・/api/ps
+に応答する。出力形式（format）を指定したリクエストには実行計画を、それ以外には
+要約の文章を返す。最初のトークンまでの遅延と生成速度を指定でき、応答には
+実際のOllamaと同じく eval_count などの計測値を含める。
+
+    python -m bench.fake_ollama --port 11500 --latency 0.2 --tokens-per-second 40
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 既定の実行計画（ネットワークを使わず、どの環境でも成功するステップのみ）
+DEFAULT_PLANS = [
+    {
+        "thought": "メモを作成して内容を確認する",
+        "steps": [
+            {"title": "メモの作成", "description": "メモをファイルに書き込む", "action": "write_file",
+             "params": {"path": "memo.txt", "content": "ベンチマーク用のメモです。\n"}},
+            {"title": "メモの確認", "description": "書き込んだメモを読み込む", "action": "read_file",
+             "params": {"path": "memo.txt"}}
+        ]
+    },
+    {
+        "thought": "スクリプトを作成して実行する",
+        "steps": [
+            {"title": "スクリプトの作成", "description": "簡単なスクリプトを書く", "action": "write_file",
+             "params": {"path": "hello.py", "content": "print('hello')\n"}},
+            {"title": "ファイルの一覧", "description": "作業ディレクトリの内容を確認する", "action": "shell_command",
+             "params": {"command": "ls -la"}},
+            {"title": "スクリプトの確認", "description": "スクリプトの内容を表示する", "action": "shell_command",
+             "params": {"command": "cat hello.py"}}
+        ]
+    }
+]
+
+DEFAULT_SUMMARY = "タスクは正常に完了しました。作成したファイルと実行結果は作業ディレクトリで確認できます。"
+
+# 1トークンとみなす文字数（生成速度とeval_countの計算に使う）
+CHARS_PER_TOKEN = 3
+
+
+class FakeOllamaConfig:
+    def __init__(self, models=("fake",), latency=0.1, tokens_per_second=50.0, load_time=0.0,
+                 plans=None, summary=DEFAULT_SUMMARY, context_length=8192):
+        self.models = list(models)
+        # 最初のトークンを返すまでの時間（プロンプトの評価時間に相当、秒）
+        self.latency = latency
+        # 生成速度（0以下なら待たずにすべて返す）
+        self.tokens_per_second = tokens_per_second
+        # モデルごとに最初のリクエストだけ追加でかかる時間（ロード時間に相当、秒）
+        self.load_time = load_time
+        self.plans = plans or DEFAULT_PLANS
+        self.summary = summary
+        self.context_length = context_length
+
+
+def create_app(config=None):
+    config = config or FakeOllamaConfig()
+    app = FastAPI(title="Fake Ollama")
+    plans = itertools.cycle(config.plans)
+    loaded = set()
+    stats = {"requests": 0, "streams": 0}
+
+    def response_text(data):
+        if data.get("format"):
+            return json.dumps(next(plans), ensure_ascii=False)
+        return config.summary
+
+    def prompt_text(data):
+        if "messages" in data:
+            return "".join(message.get("content", "") for message in data["messages"])
+        return data.get("system", "") + data.get("prompt", "")
+
+    async def prepare(data):
+        """
+        ロードとプロンプトの評価にかかる時間を待ち、(ロード時間, 評価時間) をナノ秒で返す
+        """
+        model = data.get("model", "")
+        load_ns = 0
+        if model not in loaded:
+            loaded.add(model)
+            if config.load_time > 0:
+                await asyncio.sleep(config.load_time)
+                load_ns = int(config.load_time * 1e9)
+        if config.latency > 0:
+            await asyncio.sleep(config.latency)
+        return load_ns, int(config.latency * 1e9)
+
+    def final_fields(data, load_ns, prompt_ns, eval_count, eval_ns, started):
+        return {
+            "model": data.get("model", ""),
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": time.monotonic_ns() - started,
+            "load_duration": load_ns,
+            "prompt_eval_count": max(1, len(prompt_text(data)) // CHARS_PER_TOKEN),
+            "prompt_eval_duration": prompt_ns,
+            "eval_count": eval_count,
+            "eval_duration": max(1, eval_ns)
+        }
+
+    def chunk(data, text):
+        if "messages" in data:
+            return {"model": data.get("model", ""), "message": {"role": "assistant", "content": text}, "done": False}
+        return {"model": data.get("model", ""), "response": text, "done": False}
+
+    async def respond(request):
+        data = await request.json()
+        stats["requests"] += 1
+        started = time.monotonic_ns()
+        text = response_text(data)
+        tokens = [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+        interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        load_ns, prompt_ns = await prepare(data)
+
+        if not data.get("stream", True):
+            eval_started = time.monotonic_ns()
+            if interval:
+                await asyncio.sleep(interval * len(tokens))
+            body = chunk(data, text)
+            body.update(final_fields(data, load_ns, prompt_ns, len(tokens), time.monotonic_ns() - eval_started, started))
+            return body
+
+        stats["streams"] += 1
+
+        async def stream():
+            eval_started = time.monotonic_ns()
+            for token in tokens:
+                yield json.dumps(chunk(data, token), ensure_ascii=False) + "\n"
+                if interval:
+                    await asyncio.sleep(interval)
+            done = chunk(data, "")
+            done.update(final_fields(data, load_ns, prompt_ns, len(tokens), time.monotonic_ns() - eval_started, started))
+            yield json.dumps(done, ensure_ascii=False) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": model, "model": model, "size": 0} for model in config.models]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": model, "model": model} for model in sorted(loaded)]}
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        return {"model_info": {"fake.context_length": config.context_length}}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        return await respond(request)
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        return await respond(request)
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollamaの代わりに決まった応答を返すサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--models", default="fake", help="モデル名（カンマ区切り）")
+    parser.add_argument("--latency", type=float, default=0.1, help="最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="生成速度（0で待たない）")
+    parser.add_argument("--load-time", type=float, default=0.0, help="モデルごとの初回のロード時間（秒）")
+    parser.add_argument("--plans", help="返す実行計画のJSONファイル（計画のリスト、順番に使う）")
+    parser.add_argument("--summary", default=DEFAULT_SUMMARY, help="要約として返す文章")
+    args = parser.parse_args()
+
+    plans = None
+    if args.plans:
+        with open(args.plans, encoding="utf-8") as f:
+            plans = json.load(f)
+    config = FakeOllamaConfig(
+        models=[model.strip() for model in args.models.split(",") if model.strip()],
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        load_time=args.load_time,
+        plans=plans,
+        summary=args.summary
+    )
+
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+ベンチマークで共通に使う処理
+
+偽のOllamaとサーバーの起動・停止、/proc によるサーバーのCPU・メモリの測定、
+測定値の分布（パーセンタイル）の計算をまとめる。
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    """
+    線形補間によるパーセンタイル（値がなければNone）
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def distribution(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None
+    }
+
+
+class ProcessSampler:
+    """
+    /proc からプロセスのCPU時間とRSSを定期的に読み取る
+    """
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._task = None
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    @property
+    def available(self):
+        return self.pid is not None and os.path.exists(f"/proc/{self.pid}/stat")
+
+    def read(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            # コマンド名に空白が含まれることがあるため、最後の ")" 以降を分割する
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / self._clock_ticks
+        rss_bytes = 0
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_bytes = int(line.split()[1]) * 1024
+                    break
+        return time.monotonic(), cpu_seconds, rss_bytes
+
+    async def _run(self):
+        while True:
+            try:
+                self.samples.append(self.read())
+            except (OSError, ValueError, IndexError):
+                return
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.available:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return None
+        try:
+            self.samples.append(self.read())
+        except (OSError, ValueError, IndexError):
+            pass
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return self.report()
+
+    def report(self):
+        if len(self.samples) < 2:
+            return None
+        (start, cpu_start, _), (end, cpu_end, rss_end) = self.samples[0], self.samples[-1]
+        cpu_seconds = cpu_end - cpu_start
+        return {
+            "cpu_seconds": cpu_seconds,
+            "cpu_percent": 100 * cpu_seconds / (end - start) if end > start else 0.0,
+            "rss_start_mb": self.samples[0][2] / 1024 / 1024,
+            "rss_peak_mb": max(sample[2] for sample in self.samples) / 1024 / 1024,
+            "rss_end_mb": rss_end / 1024 / 1024
+        }
+
+
+def start_process(args, log_path, env=None, cwd=None):
+    """
+    プロセスを起動する（出力が詰まらないよう、ログはファイルに書き出す）
+    """
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(
+            args, env={**os.environ, **(env or {})}, cwd=cwd, stdout=log, stderr=subprocess.STDOUT
+        )
+    process.log_path = log_path
+    return process
+
+
+async def wait_ready(url, process=None, timeout=30):
+    async with httpx.AsyncClient(timeout=2) as client:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                with open(process.log_path, encoding="utf-8", errors="replace") as f:
+                    raise RuntimeError(f"起動に失敗しました: {f.read()[-2000:]}")
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"起動を待つ間にタイムアウトしました: {url}")
+
+
+def stop_process(process):
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def add_server_arguments(parser):
+    """
+    サーバーと偽のOllamaの起動に関するコマンドライン引数を追加する
+    """
+    parser.add_argument("--model", default="fake")
+    parser.add_argument("--server-url", help="起動済みのサーバーのURL（指定しない場合は偽のOllamaとサーバーを起動する）")
+    parser.add_argument("--server-pid", type=int, help="起動済みのサーバーのプロセスID（CPU・メモリの測定用）")
+    parser.add_argument("--port", type=int, default=18000, help="起動するサーバーのポート")
+    parser.add_argument("--fake-port", type=int, default=11500, help="起動する偽のOllamaのポート")
+    parser.add_argument("--latency", type=float, default=0.1, help="偽のOllamaの最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="偽のOllamaの生成速度")
+    parser.add_argument("--load-time", type=float, default=0.0, help="偽のOllamaのモデルの初回ロード時間（秒）")
+    parser.add_argument("--plans", help="偽のOllamaが返す実行計画のJSONファイル")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="起動するサーバーに渡す環境変数（複数指定可）")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="CPU・メモリの測定間隔（秒）")
+
+
+@asynccontextmanager
+async def server_stack(args, prefix="bench-"):
+    """
+    偽のOllamaとサーバーを起動し、(サーバーのURL, プロセスID) を返す（async with で使う）
+
+    args.server_url が指定されていれば何も起動せず、そのサーバーを使う。
+    """
+    if args.server_url:
+        yield args.server_url.rstrip("/"), args.server_pid
+        return
+
+    processes = []
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    try:
+        fake_url = f"http://127.0.0.1:{args.fake_port}"
+        fake_args = [
+            sys.executable, "-m", "bench.fake_ollama", "--port", str(args.fake_port),
+            "--latency", str(args.latency), "--tokens-per-second", str(args.tokens_per_second),
+            "--load-time", str(args.load_time), "--models", args.model
+        ]
+        if args.plans:
+            fake_args += ["--plans", os.path.abspath(args.plans)]
+        fake = start_process(fake_args, os.path.join(workdir, "fake_ollama.log"), env={"PYTHONPATH": SERVER_DIR})
+        processes.append(fake)
+        await wait_ready(f"{fake_url}/api/tags", fake)
+
+        base_url = f"http://127.0.0.1:{args.port}"
+        server = start_process(
+            [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", SERVER_DIR,
+             "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+            os.path.join(workdir, "server.log"),
+            env={
+                "OLLAMA_API_URL": fake_url,
+                "OLLAMA_API_URLS": "",
+                "WORKSPACE_ROOT": os.path.join(workdir, "workspaces"),
+                "LOG_LEVEL": "WARNING",
+                **dict(item.split("=", 1) for item in args.server_env)
+            },
+            cwd=workdir
+        )
+        processes.append(server)
+        await wait_ready(f"{base_url}/api/models", server)
+        yield base_url, server.pid
+    finally:
+        for process in reversed(processes):
+            stop_process(process)
+        print(f"サーバーのログ: {workdir}", file=sys.stderr)
+
+
+def format_seconds(value):
+    return f"{value:8.3f}" if value is not None else "       -"
@@ -0,0 +1,133 @@
+"""
+ストアに保持する1件あたりのメモリ使用量の比較
+
+メッセージ・アクション・タスク・ステップを、APIのPydanticのモデルのまま保持した場合と
+records.pyの記録で保持した場合のそれぞれについて、count件を作成して tracemalloc で
+増えたメモリを測り、1件あたりのバイト数を表示する。
+
+サーバーと同じようにIDは uuid4 の文字列、日時は datetime.now() から作る。本文や詳細の
+内容はどちらでも同じオブジェクトを保持するため、あらかじめ作成して測定には含めない。
+
+    python -m bench.memory_bench --count 20000
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from models import AgentAction, AgentActionType, Message, Task, TaskStatus, TaskStep, TaskStepStatus
+from records import AgentActionRecord, MessageRecord, TaskRecord, TaskStepRecord
+
+SESSION_ID = str(uuid.uuid4())
+
+
+def message_fields(index, contents):
+    return {
+        "id": str(uuid.uuid4()),
+        "role": "assistant" if index % 2 else "user",
+        "content": contents[index % len(contents)],
+        "timestamp": datetime.now(),
+        "files": None
+    }
+
+
+def action_fields(index, details):
+    return {
+        "id": str(uuid.uuid4()),
+        "session_id": SESSION_ID,
+        "type": AgentActionType.command,
+        "description": "ステップ実行",
+        "details": details[index % len(details)],
+        "created_at": datetime.now()
+    }
+
+
+def task_fields(index, contents):
+    now = datetime.now()
+    return {
+        "id": str(uuid.uuid4()),
+        "session_id": SESSION_ID,
+        "title": "タスク",
+        "description": contents[index % len(contents)],
+        "status": TaskStatus.completed,
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+def step_fields(index, task_ids):
+    now = datetime.now()
+    return {
+        "id": str(uuid.uuid4()),
+        "task_id": task_ids[index % len(task_ids)],
+        "title": "ステップ",
+        "description": "ステップの説明",
+        "status": TaskStepStatus.completed,
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+def measure(factory, count):
+    """
+    count件を作成して保持し、増えたメモリ（バイト）を1件あたりで返す
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [factory(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # リスト自体（1件あたり1つの参照）は除く
+    list_bytes = items.__sizeof__()
+    del items
+    return (after - before - list_bytes) / count
+
+
+def run_benchmark(count):
+    contents = [f"メッセージの本文 {i}" * 5 for i in range(100)]
+    details = [{"command": f"ls -la {i}"} for i in range(100)]
+    task_ids = [str(uuid.uuid4()) for _ in range(100)]
+    kinds = {
+        "message": (Message, MessageRecord, lambda i: message_fields(i, contents)),
+        "agent_action": (AgentAction, AgentActionRecord, lambda i: action_fields(i, details)),
+        "task": (Task, TaskRecord, lambda i: task_fields(i, contents)),
+        "task_step": (TaskStep, TaskStepRecord, lambda i: step_fields(i, task_ids))
+    }
+    report = {"count": count, "kinds": {}}
+    for name, (model, record, fields) in kinds.items():
+        model_bytes = measure(lambda i: model(**fields(i)), count)
+        record_bytes = measure(lambda i: record(**fields(i)), count)
+        report["kinds"][name] = {
+            "pydantic_bytes": model_bytes,
+            "record_bytes": record_bytes,
+            "ratio": record_bytes / model_bytes if model_bytes else None
+        }
+    return report
+
+
+def print_report(report):
+    print(f"件数: {report['count']}（本文・詳細の内容は含まない）")
+    print(f"{'（バイト/件）':<16}{'Pydantic':>10}{'記録':>10}{'比率':>8}")
+    for name, result in report["kinds"].items():
+        print(f"{name:<16}{result['pydantic_bytes']:>10.0f}{result['record_bytes']:>10.0f}{result['ratio']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ストアに保持する1件あたりのメモリ使用量の比較")
+    parser.add_argument("--count", type=int, default=20000, help="種類ごとに作成する件数")
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.count)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
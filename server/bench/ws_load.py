@@ -0,0 +1,302 @@
+"""
+WebSocketの配信と再接続時の履歴の再送の負荷試験
+
+多数のセッションにそれぞれ多数の /ws/chat/{session_id} 接続を張り、各セッションで
+イベントを連続して発生させて、全接続への配信の遅延の分布・届かなかったイベント数・
+接続1つあたりのサーバーのメモリ使用量を測る。続けて、長い履歴を持つセッションに
+新しい接続を同時に張り、履歴の再送にかかる時間を測る。
+
+イベントはWebSocketの model_change（同じモデルへの変更）で発生させる。1回ごとに
+セッション情報とシステムメッセージの2件が配信され、メッセージは履歴にも残る。
+配信の遅延はメッセージのtimestampから受信までの時間で、サーバーと同じマシンで
+実行した場合のみ正確に測れる。多数の接続を1プロセスで受けるため、接続数が
+非常に多い場合はこのプロセス自体のCPUが測定値に影響することに注意する。
+
+    python -m bench.ws_load --sessions 20 --connections-per-session 100 --storm-events 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import httpx
+import websockets
+
+from bench.harness import ProcessSampler, add_server_arguments, distribution, format_seconds, server_stack
+
+
+class Connection:
+    """
+    1つのWebSocket接続で受け取ったイベントを記録する
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.ws = None
+        self.storm_received = 0
+        self.latencies = []
+        self.frames = 0
+        self.bytes = 0
+        self.error = None
+        self.replay_seconds = None
+        self.replay_frames = 0
+        self._replayed = None
+        self._task = None
+
+    async def open(self, ws_url):
+        """
+        接続して、接続直後に送られてくる履歴を最後（エージェントの状態）まで受け取る
+        """
+        started = time.monotonic()
+        self._replayed = asyncio.get_running_loop().create_future()
+        self.ws = await websockets.connect(
+            f"{ws_url}/ws/chat/{self.session_id}", max_size=None, ping_interval=None, open_timeout=60
+        )
+        self._task = asyncio.create_task(self._receive())
+        await self._replayed
+        self.replay_seconds = time.monotonic() - started
+
+    async def _receive(self):
+        try:
+            async for raw in self.ws:
+                self.frames += 1
+                self.bytes += len(raw)
+                event = json.loads(raw)
+                if not self._replayed.done():
+                    self.replay_frames += 1
+                    if event.get("type") == "agent_state":
+                        self._replayed.set_result(None)
+                    continue
+                data = event.get("data")
+                if event.get("type") == "message" and isinstance(data, dict) and data.get("role") == "system":
+                    self.storm_received += 1
+                    try:
+                        sent = datetime.fromisoformat(data["timestamp"])
+                    except (KeyError, ValueError):
+                        continue
+                    self.latencies.append((datetime.now() - sent).total_seconds())
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is None or e.rcvd.code != 1000:
+                self.error = f"切断されました: {e}"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            if not self._replayed.done():
+                self._replayed.set_exception(ConnectionError(self.error or "履歴を受け取る前に切断されました"))
+
+    async def send(self, message):
+        await self.ws.send(json.dumps(message))
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def open_connections(connections, ws_url, concurrency):
+    """
+    同時に張る接続数を抑えながら接続する（失敗した接続はerrorに記録する）
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_one(connection):
+        async with semaphore:
+            try:
+                await connection.open(ws_url)
+            except Exception as e:
+                connection.error = connection.error or f"接続に失敗しました: {type(e).__name__}: {e}"
+
+    await asyncio.gather(*(open_one(connection) for connection in connections))
+    return [connection for connection in connections if connection.error is None]
+
+
+async def trigger_events(driver, model, count, rate):
+    """
+    model_change を count 回送る（rateは1秒あたりの回数、0以下なら待たずに送る）
+    """
+    interval = 1 / rate if rate > 0 else 0
+    started = time.monotonic()
+    for i in range(count):
+        if interval:
+            delay = started + i * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await driver.send({"type": "model_change", "model_id": model})
+
+
+async def wait_received(connections, expected, quiet_timeout):
+    """
+    全接続がexpected件を受け取るか、quiet_timeout秒のあいだ受信が進まなくなるまで待つ
+    """
+    last_total, last_progress = -1, time.monotonic()
+    while True:
+        total = sum(connection.storm_received for connection in connections)
+        if all(connection.storm_received >= expected or connection.error for connection in connections):
+            return
+        if total != last_total:
+            last_total, last_progress = total, time.monotonic()
+        elif time.monotonic() - last_progress > quiet_timeout:
+            return
+        await asyncio.sleep(0.1)
+
+
+def read_rss(sampler):
+    if not sampler.available:
+        return None
+    return sampler.read()[2]
+
+
+async def run_load_test(args):
+    async with server_stack(args, prefix="ws-load-") as (base_url, server_pid):
+        ws_url = base_url.replace("http", "ws", 1)
+        sampler = ProcessSampler(server_pid, args.sample_interval)
+        sampler.start()
+        async with httpx.AsyncClient(timeout=30) as client:
+            session_ids = []
+            for i in range(args.sessions):
+                response = await client.post(
+                    f"{base_url}/api/chat/sessions", params={"model_id": args.model, "title": f"ws-load-{i}"}
+                )
+                response.raise_for_status()
+                session_ids.append(response.json()["id"])
+
+            # 各セッションでイベントを送る接続（自分宛ての配信も受け取る）
+            drivers = [Connection(session_id) for session_id in session_ids]
+            drivers = await open_connections(drivers, ws_url, args.connect_concurrency)
+
+            # 再送の試験用に、あらかじめ履歴を積んでおく
+            if args.history > 0:
+                await asyncio.gather(*(trigger_events(driver, args.model, args.history, 0) for driver in drivers))
+                await wait_received(drivers, args.history, args.quiet_timeout)
+                for driver in drivers:
+                    driver.storm_received = 0
+                    driver.latencies.clear()
+
+            # 接続前後のRSSの差から接続1つあたりのメモリ使用量を求める
+            await asyncio.sleep(1)
+            rss_before = read_rss(sampler)
+            listeners = [
+                Connection(session_id) for session_id in session_ids for _ in range(args.connections_per_session)
+            ]
+            connect_started = time.monotonic()
+            opened = await open_connections(listeners, ws_url, args.connect_concurrency)
+            connect_seconds = time.monotonic() - connect_started
+            await asyncio.sleep(1)
+            rss_connected = read_rss(sampler)
+
+            # 全セッションで同時にイベントを発生させる
+            live = drivers + opened
+            storm_started = time.monotonic()
+            await asyncio.gather(*(
+                trigger_events(driver, args.model, args.storm_events, args.storm_rate) for driver in drivers
+            ))
+            await wait_received(live, args.storm_events, args.quiet_timeout)
+            storm_seconds = time.monotonic() - storm_started
+
+            # 長い履歴を持つセッションへの再接続（同時に張る）
+            replays = [
+                Connection(session_id) for session_id in session_ids for _ in range(args.replay_connections)
+            ]
+            replay_started = time.monotonic()
+            replayed = await open_connections(replays, ws_url, args.connect_concurrency)
+            replay_seconds = time.monotonic() - replay_started
+
+            history = await client.get(f"{base_url}/api/chat/sessions/{session_ids[0]}/messages")
+            history_length = len(history.json()) if history.status_code == 200 else None
+
+            for connection in drivers + listeners + replays:
+                await connection.close()
+            for session_id in session_ids:
+                await client.delete(f"{base_url}/api/chat/sessions/{session_id}")
+        server_report = await sampler.stop()
+
+    expected = args.storm_events * len(live)
+    received = sum(min(connection.storm_received, args.storm_events) for connection in live)
+    latencies = [latency for connection in live for latency in connection.latencies]
+    memory_per_connection = None
+    if rss_before is not None and rss_connected is not None and opened:
+        memory_per_connection = (rss_connected - rss_before) / len(opened)
+    replay_bytes = sum(connection.bytes for connection in replayed)
+    return {
+        "sessions": args.sessions,
+        "connections": {
+            "requested": len(listeners),
+            "opened": len(opened),
+            "failed": len(listeners) - len(opened),
+            "connect_seconds": connect_seconds,
+            "errors": sorted({connection.error for connection in drivers + listeners + replays if connection.error})[:10]
+        },
+        "memory_per_connection_bytes": memory_per_connection,
+        "storm": {
+            "events_per_session": args.storm_events,
+            "expected": expected,
+            "received": received,
+            "dropped": expected - received,
+            "seconds": storm_seconds,
+            "deliveries_per_second": received / storm_seconds if storm_seconds > 0 else 0.0,
+            "latency": distribution(latencies)
+        },
+        "replay": {
+            "connections": len(replays),
+            "completed": len(replayed),
+            "history_messages": history_length,
+            "frames_per_connection": (
+                sum(connection.replay_frames for connection in replayed) / len(replayed) if replayed else 0
+            ),
+            "seconds": replay_seconds,
+            "megabytes": replay_bytes / 1024 / 1024,
+            "latency": distribution([connection.replay_seconds for connection in replayed])
+        },
+        "server": server_report
+    }
+
+
+def print_report(report):
+    connections = report["connections"]
+    storm = report["storm"]
+    replay = report["replay"]
+    print(f"セッション数: {report['sessions']}  接続数: {connections['opened']}/{connections['requested']}"
+          f"（失敗 {connections['failed']}、{connections['connect_seconds']:.2f}秒）")
+    if report["memory_per_connection_bytes"] is not None:
+        print(f"接続1つあたりのメモリ: {report['memory_per_connection_bytes'] / 1024:.1f}KB")
+    print(f"配信: {storm['received']}/{storm['expected']} 件（未着 {storm['dropped']}）"
+          f"  {storm['seconds']:.2f}秒  {storm['deliveries_per_second']:.0f} 件/秒")
+    print(f"再送: {replay['completed']}/{replay['connections']} 接続  履歴 {replay['history_messages']} 件"
+          f"  1接続あたり {replay['frames_per_connection']:.0f} フレーム  計 {replay['megabytes']:.1f}MB")
+    print(f"{'（秒）':<16}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}")
+    for label, dist in (("配信の遅延", storm["latency"]), ("履歴の再送", replay["latency"])):
+        print(f"{label:<14}" + "".join(format_seconds(dist[name]) for name in ("p50", "p95", "p99", "max")))
+    server = report.get("server")
+    if server:
+        print(f"サーバー: CPU {server['cpu_seconds']:.2f}秒（平均 {server['cpu_percent']:.1f}%）"
+              f"  RSS {server['rss_start_mb']:.1f}MB → 最大 {server['rss_peak_mb']:.1f}MB")
+    for error in connections["errors"]:
+        print(f"エラー: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocketの配信と履歴の再送の負荷試験")
+    parser.add_argument("--sessions", type=int, default=10, help="セッション数")
+    parser.add_argument("--connections-per-session", type=int, default=50, help="セッションごとの接続数")
+    parser.add_argument("--storm-events", type=int, default=100, help="セッションごとに発生させるイベント数")
+    parser.add_argument("--storm-rate", type=float, default=0, help="セッションごとの1秒あたりのイベント数（0で待たない）")
+    parser.add_argument("--history", type=int, default=0, help="接続前に積んでおく履歴のメッセージ数")
+    parser.add_argument("--replay-connections", type=int, default=10, help="再送の試験でセッションごとに張る接続数")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="同時に張る接続数の上限")
+    parser.add_argument("--quiet-timeout", type=float, default=10.0, help="受信が進まなくなってから打ち切るまでの秒数")
+    add_server_arguments(parser)
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load_test(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
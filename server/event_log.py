@@ -0,0 +1,341 @@
+"""
+セッションごとの追記専用のイベントログとスナップショット
+
+セッションの状態の変更をイベントとして、セッションごとのディレクトリに追記する。
+1件のイベントは「長さ（4バイト）・CRC32（4バイト）・JSON」の形式で書き込み、
+途中で書き込みが途切れたイベント（プロセスの強制終了など）は読み込み時に切り捨てる。
+
+append() はメモリ上のキューに積むだけで、バックグラウンドのタスクが一定間隔で
+まとめてファイルに書き込み、fsyncする。一定数のイベントごとにセッションの状態全体を
+スナップショットとして書き出し、それより前のイベントを含むセグメントのファイルを削除する
+（コンパクション）。再起動時はスナップショットとそれ以降のイベントだけを読めばよい。
+
+    <directory>/<session_id>/snapshot          最新のスナップショット（1フレーム）
+    <directory>/<session_id>/<開始番号>.log     開始番号以降のイベント
+"""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import struct
+import zlib
+
+from session_ids import check_session_id, is_valid_session_id, session_path
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct("<II")
+SNAPSHOT_NAME = "snapshot"
+SEGMENT_SUFFIX = ".log"
+
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_frames(path):
+    """
+    ファイルからフレームを読み、(JSONのリスト, 正しく読めたバイト数) を返す
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        length, checksum = FRAME_HEADER.unpack_from(data, offset)
+        start = offset + FRAME_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        try:
+            records.append(json.loads(payload))
+        except ValueError:
+            break
+        offset = start + length
+    return records, offset
+
+
+def fsync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class SessionLog:
+    """
+    1つのセッションのログの状態
+    """
+
+    __slots__ = ("seq", "since_snapshot", "segment_start", "pending")
+
+    def __init__(self, seq=0):
+        # 最後に割り当てたイベントの番号
+        self.seq = seq
+        # 最後のスナップショット以降のイベント数
+        self.since_snapshot = 0
+        # 書き込み先のセグメントの開始番号（書き込みスレッドだけが更新する）
+        self.segment_start = seq + 1
+        # 書き込み待ちの操作（"event" / "snapshot" / "delete"）
+        self.pending = []
+
+
+class RestoredSession:
+    """
+    読み込んだスナップショットとそれ以降のイベント
+    """
+
+    def __init__(self, session_id, snapshot, events):
+        self.session_id = session_id
+        # スナップショットの状態（なければNone）
+        self.snapshot = snapshot
+        # スナップショット以降のイベント（{"seq", "type", "data"} のリスト）
+        self.events = events
+
+
+class EventLog:
+    """
+    セッションごとのイベントログの追記・スナップショット・読み込み
+    """
+
+    def __init__(self, directory="session_logs", flush_interval=0.05, snapshot_every=1000, snapshot_fn=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        # この数のイベントごとにスナップショットを書き出す（0以下なら書き出さない）
+        self.snapshot_every = snapshot_every
+        # セッションIDからスナップショットにする状態（JSONにできる値）を返す関数
+        self.snapshot_fn = snapshot_fn
+        self.sessions = {}
+        self._dirty = set()
+        # 削除したセッションの書き込み待ちの操作（同じIDで作り直されても混ざらないよう分けて持つ）
+        self._deleted = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.written_events = 0
+        self.written_snapshots = 0
+
+    def _session_dir(self, session_id):
+        # IDが不正なら InvalidSessionId（directoryの外を作成・削除しないよう必ずここを通す）
+        return session_path(self.directory, session_id)
+
+    # --- 追記（イベントループ上で呼ぶ） ---
+
+    def append(self, session_id, event_type, data):
+        """
+        イベントを書き込み待ちに積む（data は書き込みまで変更しないこと）
+        """
+        check_session_id(session_id)
+        log = self.sessions.get(session_id)
+        if log is None:
+            log = self.sessions[session_id] = SessionLog()
+        log.seq += 1
+        log.since_snapshot += 1
+        log.pending.append(("event", log.seq, {"seq": log.seq, "type": event_type, "data": data}))
+        self._dirty.add(session_id)
+        if self.snapshot_every > 0 and log.since_snapshot >= self.snapshot_every:
+            self.snapshot(session_id)
+
+    def snapshot(self, session_id):
+        """
+        現時点の状態をスナップショットとして書き込み待ちに積む
+        """
+        log = self.sessions.get(session_id)
+        if log is None or self.snapshot_fn is None:
+            return
+        state = self.snapshot_fn(session_id)
+        if state is None:
+            return
+        log.since_snapshot = 0
+        log.pending.append(("snapshot", log.seq, state))
+        self._dirty.add(session_id)
+
+    def delete(self, session_id):
+        check_session_id(session_id)
+        log = self.sessions.pop(session_id, None) or SessionLog()
+        # 書き込み前のイベントは書く必要がない
+        log.pending = [("delete", log.seq, None)]
+        self._deleted.append((session_id, log))
+        self._wakeup.set()
+
+    # --- 書き込み ---
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("セッションのイベントログの書き込みに失敗しました")
+
+    async def flush(self):
+        """
+        書き込み待ちの操作をまとめてファイルに書き込み、fsyncする
+        """
+        async with self._flush_lock:
+            batch = []
+            for session_id, log in self._deleted:
+                batch.append((session_id, log, log.pending))
+            self._deleted = []
+            for session_id in self._dirty:
+                log = self.sessions.get(session_id)
+                if log is not None and log.pending:
+                    batch.append((session_id, log, log.pending))
+                    log.pending = []
+            self._dirty.clear()
+            if batch:
+                await asyncio.to_thread(self._write_batch, batch)
+
+    def _write_batch(self, batch):
+        for session_id, log, operations in batch:
+            try:
+                self._write_session(session_id, log, operations)
+            except OSError as e:
+                logger.error("セッションのイベントログを書き込めません: %s - %s", session_id, e)
+
+    def _write_session(self, session_id, log, operations):
+        directory = self._session_dir(session_id)
+        buffer = []
+
+        def write_events():
+            if not buffer:
+                return
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{log.segment_start:012d}{SEGMENT_SUFFIX}")
+            created = not os.path.exists(path)
+            with open(path, "ab") as f:
+                f.write(b"".join(buffer))
+                f.flush()
+                os.fsync(f.fileno())
+            if created:
+                fsync_directory(directory)
+            self.written_events += len(buffer)
+            buffer.clear()
+
+        for kind, seq, payload in operations:
+            if kind == "event":
+                buffer.append(encode_frame(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")))
+            elif kind == "snapshot":
+                write_events()
+                self._write_snapshot(directory, seq, payload)
+                log.segment_start = seq + 1
+                self._compact(directory, seq)
+            elif kind == "delete":
+                buffer.clear()
+                shutil.rmtree(directory, ignore_errors=True)
+                return
+        write_events()
+
+    def _write_snapshot(self, directory, seq, state):
+        os.makedirs(directory, exist_ok=True)
+        payload = json.dumps({"seq": seq, "state": state}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        path = os.path.join(directory, SNAPSHOT_NAME)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(encode_frame(payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        fsync_directory(directory)
+        self.written_snapshots += 1
+
+    def _compact(self, directory, seq):
+        """
+        スナップショットに含まれるイベントだけのセグメントを削除する
+        """
+        for name in os.listdir(directory):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                start = int(name[:-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            if start <= seq:
+                os.remove(os.path.join(directory, name))
+
+    # --- 読み込み（起動時） ---
+
+    def load(self):
+        """
+        すべてのセッションのスナップショットとそれ以降のイベントを読み込む
+
+        途中で途切れたイベントはファイルから切り捨て、以降の追記は新しいセグメントに行う。
+        """
+        restored = []
+        if not os.path.isdir(self.directory):
+            return restored
+        for session_id in sorted(os.listdir(self.directory)):
+            if not is_valid_session_id(session_id):
+                logger.warning("セッションIDではないディレクトリを読み飛ばします: %s", session_id)
+                continue
+            try:
+                directory = self._session_dir(session_id)
+                if not os.path.isdir(directory):
+                    continue
+                restored.append(self._load_session(session_id, directory))
+            except (OSError, ValueError) as e:
+                logger.error("セッションのイベントログを読み込めません: %s - %s", session_id, e)
+        return restored
+
+    def _load_session(self, session_id, directory):
+        snapshot, snapshot_seq = None, 0
+        snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+        if os.path.exists(snapshot_path):
+            records, _ = read_frames(snapshot_path)
+            if records:
+                snapshot, snapshot_seq = records[0]["state"], records[0]["seq"]
+            else:
+                logger.warning("スナップショットが壊れています: %s", snapshot_path)
+
+        segments = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        events = []
+        seq = snapshot_seq
+        for name in segments:
+            path = os.path.join(directory, name)
+            records, valid_length = read_frames(path)
+            if valid_length < os.path.getsize(path):
+                logger.warning("途中で途切れたイベントを切り捨てます: %s (%dバイト目以降)", path, valid_length)
+                with open(path, "r+b") as f:
+                    f.truncate(valid_length)
+            for record in records:
+                if record["seq"] > seq:
+                    events.append(record)
+                    seq = record["seq"]
+
+        log = self.sessions[session_id] = SessionLog(seq)
+        log.since_snapshot = len(events)
+        return RestoredSession(session_id, snapshot, events)
+
+    def status(self):
+        return {
+            "sessions": len(self.sessions),
+            "pending": sum(len(log.pending) for log in self.sessions.values()),
+            "written_events": self.written_events,
+            "written_snapshots": self.written_snapshots
+        }
@@ -0,0 +1,202 @@
+"""
+HTMLからLLMに渡すための読みやすいテキストを抽出するモジュール
+
+スクリプト・スタイル・ナビゲーションなどの定型部分を除去し、
+リンクを [テキスト](URL) 形式で残したテキストを生成する。
+HTMLParserはチャンク単位でfeedできるため、レスポンスを受信しながら
+逐次的に抽出し、トークン上限に達した時点で抽出を打ち切る。
+"""
+
+import re
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+from tokens import count_chars, tokens_from_chars, truncate_to_tokens
+
+# 中身ごと捨てるタグ
+SKIP_TAGS = {
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe",
+    "nav", "header", "footer", "aside", "form", "button", "select",
+}
+
+# 改行を入れるブロック要素
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "br", "hr", "li", "ul", "ol",
+    "table", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote",
+    "dl", "dt", "dd", "figure", "figcaption", "title",
+}
+
+# 内容のない要素（終了タグが来ない）
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+    "meta", "param", "source", "track", "wbr",
+}
+
+# class/idのトークン（空白区切りの1語全体）がこれらに一致する要素は定型部分として除去する
+# "has-sidebar" や "header-fixed" のような語の一部には一致させない
+BOILERPLATE_TOKENS = {
+    "nav", "navbar", "menu", "breadcrumb", "breadcrumbs", "footer", "header", "sidebar",
+    "cookie", "banner", "advert", "ads", "share", "social", "popup", "modal",
+}
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search"}
+
+# 本文を囲む要素（class/id/roleによる定型部分の判定をしない）
+CONTENT_ROOT_TAGS = {"html", "body", "main", "article"}
+
+WHITESPACE_PATTERN = re.compile(r"[ \t\r\f\v]+")
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    HTMLをストリーミングでテキストに変換するパーサー
+    """
+
+    def __init__(self, base_url=None, max_tokens=None):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.max_tokens = max_tokens
+        self.title = ""
+        self.links = []
+        self.truncated = False
+        self._parts = []
+        # 出力済みの文字数（断片ごとに切り上げないよう、文字数で足してからトークン数に換算する）
+        self._wide = 0
+        self._narrow = 0
+        # 除去中の要素のタグスタック（ネストした同名タグに対応するため）
+        self._skip_stack = []
+        self._in_title = False
+        self._in_pre = 0
+        self._link_href = None
+        self._link_text = []
+
+    @property
+    def done(self):
+        """
+        トークン上限に達してこれ以上の入力が不要かどうか
+        """
+        return self.truncated
+
+    def _is_boilerplate(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            return True
+        if tag in CONTENT_ROOT_TAGS:
+            return False
+        attr_map = dict(attrs)
+        if (attr_map.get("role") or "").lower() in BOILERPLATE_ROLES:
+            return True
+        if attr_map.get("aria-hidden") == "true" or "hidden" in attr_map:
+            return True
+        marker = f"{attr_map.get('class') or ''} {attr_map.get('id') or ''}"
+        return any(token in BOILERPLATE_TOKENS for token in marker.lower().split())
+
+    def _emit(self, text):
+        if self.truncated or not text:
+            return
+        if self.max_tokens is not None:
+            wide, narrow = count_chars(text)
+            if tokens_from_chars(self._wide + wide, self._narrow + narrow) > self.max_tokens:
+                remaining = self.max_tokens - tokens_from_chars(self._wide, self._narrow)
+                self._parts.append(truncate_to_tokens(text, remaining))
+                self.truncated = True
+                return
+            self._wide += wide
+            self._narrow += narrow
+        self._parts.append(text)
+
+    def _newline(self):
+        if self._parts and not self._parts[-1].endswith("\n"):
+            self._emit("\n")
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_stack:
+            if tag not in VOID_TAGS:
+                self._skip_stack.append(tag)
+            return
+        if tag == "title":
+            self._in_title = True
+            return
+        if self._is_boilerplate(tag, attrs):
+            if tag not in VOID_TAGS:
+                self._skip_stack.append(tag)
+            return
+        if tag in BLOCK_TAGS:
+            self._newline()
+        if tag == "li":
+            self._emit("- ")
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            self._emit("#" * int(tag[1]) + " ")
+        elif tag == "pre":
+            self._in_pre += 1
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href and not href.startswith(("javascript:", "#", "mailto:")):
+                self._link_href = urljoin(self.base_url, href) if self.base_url else href
+                self._link_text = []
+
+    def handle_endtag(self, tag):
+        if self._skip_stack:
+            # 対応する開始タグまで巻き戻す（閉じ忘れのタグを許容する）
+            if tag in self._skip_stack:
+                while self._skip_stack and self._skip_stack.pop() != tag:
+                    pass
+            return
+        if tag == "title":
+            self._in_title = False
+            return
+        if tag == "a" and self._link_href is not None:
+            text = WHITESPACE_PATTERN.sub(" ", "".join(self._link_text)).strip()
+            if text and not self.truncated:
+                self.links.append({"text": text, "url": self._link_href})
+                self._emit(f"[{text}]({self._link_href})")
+            self._link_href = None
+            self._link_text = []
+            return
+        if tag == "pre" and self._in_pre:
+            self._in_pre -= 1
+        if tag in BLOCK_TAGS:
+            self._newline()
+
+    def handle_data(self, data):
+        if self._skip_stack:
+            return
+        if self._in_title:
+            self.title += data
+            return
+        if not self._in_pre:
+            data = WHITESPACE_PATTERN.sub(" ", data.replace("\n", " "))
+            if not data.strip():
+                if self._parts and not self._parts[-1].endswith((" ", "\n")):
+                    data = " "
+                else:
+                    return
+        if self._link_href is not None:
+            self._link_text.append(data)
+            return
+        if not self._in_pre and (not self._parts or self._parts[-1].endswith("\n")):
+            data = data.lstrip()
+        self._emit(data)
+
+    def get_text(self):
+        """
+        抽出済みのテキストを返す
+        """
+        text = "".join(self._parts)
+        lines = [line.rstrip() for line in text.split("\n")]
+        # 空行の連続を1行にまとめる
+        text = re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+        return text.strip()
+
+
+def extract_text(html, base_url=None, max_tokens=None):
+    """
+    HTML全体からテキストを抽出する
+    """
+    parser = HTMLTextExtractor(base_url=base_url, max_tokens=max_tokens)
+    parser.feed(html)
+    parser.close()
+    return {
+        "title": parser.title.strip(),
+        "text": parser.get_text(),
+        "links": parser.links,
+        "truncated": parser.truncated,
+    }
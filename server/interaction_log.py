@@ -0,0 +1,298 @@
+"""
+Ollamaとのやり取りとツールの実行結果をタスクごとに記録・再生するモジュール
+
+記録モードでは、タスクの処理中に行ったOllamaへのリクエストの応答（失敗を含む）と
+AgentToolsの実行結果を、タスクごとに1つのgzip圧縮したJSON Linesのファイルに書き出す。
+再生モードでは、同じ指示のタスクに対して記録した応答をそのまま返すため、
+Ollamaやネットワークなしで同じ入力の処理を再現でき、サーバーの変更前後で
+スループットや遅延を比べられる。
+
+記録はコンテキスト変数でタスクに結び付けるため、並行して動く複数のタスクや、
+タスクから起動したバックグラウンドの処理（先行実行・要約）の記録も混ざらない。
+"""
+
+import asyncio
+import contextvars
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+LOG_VERSION = 1
+
+# 再生モードでネットワークを使うために必ず記録から返すツール
+NETWORK_TOOLS = {"web_fetch"}
+# ツールの引数の文字列のうち、これより長いものは長さとハッシュ値だけを記録する
+MAX_RECORDED_ARG_CHARS = 1024
+
+# 現在のタスクの記録（記録モード）または再生する記録（再生モード）
+current_recording = contextvars.ContextVar("interaction_recording", default=None)
+
+
+class ReplayMiss(Exception):
+    """
+    再生する記録が見つからないことを示す例外
+    """
+
+
+def request_key(*parts):
+    """
+    リクエストの内容から照合用のキーを求める
+    """
+    text = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def compact_arguments(value):
+    """
+    記録するツールの引数から長い文字列（write_fileの内容など）を長さとハッシュ値に置き換える
+    """
+    if isinstance(value, str) and len(value) > MAX_RECORDED_ARG_CHARS:
+        return {"length": len(value), "sha256": hashlib.sha256(value.encode("utf-8", "replace")).hexdigest()}
+    if isinstance(value, dict):
+        return {key: compact_arguments(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [compact_arguments(item) for item in value]
+    return value
+
+
+def description_key(description):
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+class TaskRecording:
+    """
+    記録中の1つのタスクのやり取り
+    """
+
+    def __init__(self, description, model_id):
+        self.header = {
+            "version": LOG_VERSION,
+            "description": description,
+            "model_id": model_id,
+            "recorded_at": time.time(),
+            "task_id": None
+        }
+        self.entries = []
+        self.finished = False
+
+    def add(self, kind, key, request, response, duration, error=None):
+        entry = {"kind": kind, "key": key, "request": request, "duration": round(duration, 4)}
+        if error is not None:
+            entry["error"] = error
+        else:
+            entry["response"] = response
+        self.entries.append(entry)
+
+    def dump(self):
+        lines = [json.dumps(self.header, ensure_ascii=False)]
+        lines.extend(json.dumps(entry, ensure_ascii=False, default=str) for entry in self.entries)
+        return gzip.compress(("\n".join(lines) + "\n").encode("utf-8"))
+
+
+class TaskReplay:
+    """
+    再生する1つのタスクのやり取り
+
+    キーが一致する記録を優先し、なければ同じ種類の記録を記録した順に返す。
+    """
+
+    def __init__(self, path, header, entries):
+        self.path = path
+        self.header = header
+        self.entries = entries
+        self._used = set()
+        self._by_key = {}
+        self._by_kind = {}
+        for index, entry in enumerate(entries):
+            self._by_key.setdefault((entry["kind"], entry.get("key")), deque()).append(index)
+            self._by_kind.setdefault(entry["kind"], deque()).append(index)
+
+    def _next(self, queue):
+        while queue:
+            index = queue.popleft()
+            if index not in self._used:
+                self._used.add(index)
+                return self.entries[index]
+        return None
+
+    def take(self, kind, key=None):
+        entry = None
+        if key is not None:
+            entry = self._next(self._by_key.get((kind, key), deque()))
+        if entry is None:
+            entry = self._next(self._by_kind.get(kind, deque()))
+        if entry is None:
+            raise ReplayMiss(f"再生する記録がありません: {kind}")
+        return entry
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            entries = [json.loads(line) for line in f if line.strip()]
+        return cls(path, header, entries)
+
+
+def read_header(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())
+
+
+class InteractionLog:
+    """
+    記録・再生のモード（off / record / replay）に応じて、タスクごとの記録を管理する
+    """
+
+    def __init__(self, mode="off", directory="interactions", replay_speed=0.0, replay_tools="all"):
+        if mode not in ("off", "record", "replay"):
+            raise ValueError(f"不明なモードです: {mode}")
+        self.mode = mode
+        self.directory = directory
+        # 記録した所要時間に対する再生の速さ（0以下なら待たずに返す）
+        self.replay_speed = replay_speed
+        # 再生するツール（all: すべて, network: ネットワークを使うツールのみ）
+        self.replay_tools = replay_tools
+        # 指示の内容 -> 未使用の記録ファイル（記録した順）
+        self._index = None
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def _load_index(self):
+        index = {}
+        if os.path.isdir(self.directory):
+            headers = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".jsonl.gz"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    headers.append((read_header(path), path))
+                except (OSError, ValueError) as e:
+                    logger.warning("記録ファイルを読み込めません: %s - %s", path, e)
+            for header, path in sorted(headers, key=lambda item: item[0].get("recorded_at", 0)):
+                index.setdefault(description_key(header.get("description", "")), deque()).append(path)
+        logger.info("再生する記録を読み込みました: %d件", sum(len(paths) for paths in index.values()))
+        return index
+
+    def begin(self, description, model_id):
+        """
+        タスクの記録または再生を始める（現在のコンテキストに結び付ける）
+        """
+        if self.recording:
+            current_recording.set(TaskRecording(description, model_id))
+        elif self.replaying:
+            if self._index is None:
+                self._index = self._load_index()
+            paths = self._index.get(description_key(description))
+            replay = None
+            while paths and replay is None:
+                path = paths.popleft()
+                try:
+                    replay = TaskReplay.load(path)
+                except (OSError, ValueError) as e:
+                    logger.warning("記録ファイルを読み込めません: %s - %s", path, e)
+            if replay is None:
+                logger.warning("このタスクの記録がありません: %.50s", description)
+            current_recording.set(replay)
+
+    def set_task(self, task_id):
+        recording = current_recording.get()
+        if isinstance(recording, TaskRecording):
+            recording.header["task_id"] = task_id
+
+    async def finish(self):
+        """
+        タスクの処理の終了時に記録を書き出す（以降に追加された記録はその都度書き直す）
+        """
+        recording = current_recording.get()
+        if isinstance(recording, TaskRecording):
+            recording.finished = True
+            await self.save(recording)
+
+    def _path(self, recording):
+        stamp = datetime.fromtimestamp(recording.header["recorded_at"]).strftime("%Y%m%d-%H%M%S")
+        name = recording.header["task_id"] or request_key(recording.header["recorded_at"], id(recording))
+        return os.path.join(self.directory, f"{stamp}-{name}.jsonl.gz")
+
+    async def save(self, recording):
+        path = self._path(recording)
+        data = recording.dump()
+
+        def write():
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            logger.warning("記録の書き出しに失敗しました: %s - %s", path, e)
+
+    def record(self, kind, key, request, response, duration, error=None):
+        recording = current_recording.get()
+        if not self.recording or not isinstance(recording, TaskRecording):
+            return
+        recording.add(kind, key, request, response, duration, error)
+        if recording.finished:
+            # タスクの終了後に届いた記録（バックグラウンドの要約など）
+            asyncio.create_task(self.save(recording))
+
+    async def replay(self, kind, key=None):
+        """
+        記録した応答を返す（記録した時間に合わせて待つ）。見つからなければReplayMissを送出する
+        """
+        recording = current_recording.get()
+        if not isinstance(recording, TaskReplay):
+            raise ReplayMiss(f"再生する記録がありません: {kind}")
+        entry = recording.take(kind, key)
+        if self.replay_speed > 0 and entry.get("duration"):
+            await asyncio.sleep(entry["duration"] / self.replay_speed)
+        return entry
+
+    def replays_tool(self, kind):
+        return self.replaying and (self.replay_tools == "all" or kind in NETWORK_TOOLS)
+
+    def tool(self, kind, omit_result_keys=()):
+        """
+        AgentToolsのメソッドの実行結果を記録・再生するデコレーター
+
+        omit_result_keysに指定した結果の項目（web_fetchの生のHTMLなど）は記録しない。
+        再生時の結果にもその項目は含まれない。
+        """
+        def decorate(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if self.replays_tool(kind):
+                    try:
+                        return (await self.replay(kind))["response"]
+                    except ReplayMiss as e:
+                        logger.warning("%s", e)
+                        return {"success": False, "error": str(e)}
+                if not self.recording:
+                    return await fn(*args, **kwargs)
+                started = time.monotonic()
+                result = await fn(*args, **kwargs)
+                recorded = result
+                if omit_result_keys and isinstance(result, dict):
+                    recorded = {key: value for key, value in result.items() if key not in omit_result_keys}
+                request = {"args": compact_arguments(args), "kwargs": compact_arguments(kwargs)}
+                self.record(kind, None, request, recorded, time.monotonic() - started)
+                return result
+            return wrapper
+        return decorate
@@ -0,0 +1,133 @@
+"""
+LLMのストリーミング出力から、生成途中のJSONを逐次取り出すパーサー
+
+ルートがオブジェクトであるJSONを想定し、トップレベルのメンバー
+（例: "thought"）が閉じた時点と、トップレベルの配列メンバーの要素
+（例: "steps" の各ステップ）が閉じた時点でイベントを返す。
+全体の検証は生成完了後に行うため、ここでは構文の追跡のみを行う。
+"""
+
+import json
+
+
+class IncrementalJSONParser:
+    """
+    チャンク単位でfeedし、完成したメンバー・配列要素を返すパーサー
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.members = {}
+        self.closed = False
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+        self._array_key = None
+        self._item_start = None
+        self._item_index = 0
+
+    def _decode(self, fragment):
+        try:
+            return True, json.loads(fragment)
+        except ValueError:
+            return False, None
+
+    def _emit_member(self, events, end):
+        ok, value = self._decode(self.text[self._value_start:end])
+        if ok and self._key is not None:
+            self.members[self._key] = value
+            events.append(("member", self._key, value))
+        self._value_start = None
+        self._key = None
+        self._array_key = None
+
+    def _emit_item(self, events, end):
+        ok, value = self._decode(self.text[self._item_start:end])
+        if ok:
+            events.append(("item", self._array_key, self._item_index, value))
+        self._item_index += 1
+        self._item_start = None
+
+    def feed(self, chunk):
+        """
+        チャンクを追加し、新たに完成したイベントのリストを返す
+
+        イベントは ("member", キー, 値) または ("item", 配列のキー, 添字, 値)。
+        """
+        self.text += chunk
+        events = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            if self.closed:
+                break
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1 and self._expect_key and self._key_start is not None:
+                        ok, key = self._decode(text[self._key_start:i + 1])
+                        self._key = key if ok else None
+                        self._key_start = None
+                        self._expect_key = False
+                continue
+            if ch.isspace():
+                continue
+
+            depth = len(self._stack)
+            # 値・要素の開始位置を記録する
+            if depth == 1 and not self._expect_key and self._key is not None \
+                    and self._value_start is None and ch not in ":,}":
+                self._value_start = i
+            if depth == 2 and self._array_key is not None and self._stack[-1] == "[" \
+                    and self._item_start is None and ch not in ",]":
+                self._item_start = i
+
+            if ch == '"':
+                self._in_string = True
+                if depth == 1 and self._expect_key:
+                    self._key_start = i
+            elif ch in "{[":
+                self._stack.append(ch)
+                if len(self._stack) == 1:
+                    if ch != "{":
+                        # ルートがオブジェクトでない場合は逐次処理しない
+                        self.closed = True
+                    self._expect_key = True
+                elif len(self._stack) == 2 and ch == "[" and self._value_start == i:
+                    self._array_key = self._key
+                    self._item_index = 0
+            elif ch in "}]":
+                # 閉じ括弧の直前で終わるスカラー値
+                if depth == 2 and ch == "]" and self._array_key is not None and self._item_start is not None:
+                    self._emit_item(events, i)
+                if depth == 1 and ch == "}" and self._value_start is not None:
+                    self._emit_member(events, i)
+                if self._stack:
+                    self._stack.pop()
+                new_depth = len(self._stack)
+                # オブジェクト・配列である要素やメンバーの終わり
+                if new_depth == 2 and self._array_key is not None and self._item_start is not None:
+                    self._emit_item(events, i + 1)
+                if new_depth == 1 and self._value_start is not None:
+                    self._emit_member(events, i + 1)
+                if new_depth == 0:
+                    self.closed = True
+            elif ch == ",":
+                if depth == 1:
+                    if self._value_start is not None:
+                        self._emit_member(events, i)
+                    self._expect_key = True
+                    self._key = None
+                elif depth == 2 and self._array_key is not None and self._item_start is not None:
+                    self._emit_item(events, i)
+        self._pos = len(text)
+        return events
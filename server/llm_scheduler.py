@@ -0,0 +1,109 @@
+"""
+Ollamaへのリクエストを優先度付きで送り出すスケジューラー
+
+実行計画の生成などユーザーが待っているリクエストを優先し、タスクの要約や
+会話履歴の要約といった後回しにできるリクエストは別の同時実行数の枠で扱う。
+低優先度のリクエストは短い時間待って集めてからまとめて送り出し、Ollama側の
+並列処理（OLLAMA_NUM_PARALLEL）でまとめて処理されるようにする。
+"""
+
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+
+
+class Priority:
+    # ユーザーが結果を待っているリクエスト（実行計画の生成・修正）
+    interactive = 0
+    # 後回しにできるリクエスト（要約など）
+    background = 1
+
+
+class LLMScheduler:
+    """
+    同時実行数の上限の範囲で、優先度の高いリクエストから順に実行枠を割り当てる
+    """
+
+    def __init__(self, max_concurrency=4, background_concurrency=1, batch_window=0.2):
+        self.max_concurrency = max(1, max_concurrency)
+        # 低優先度のリクエストに使える実行枠（残りは常に高優先度のために空けておく）
+        self.background_concurrency = max(1, min(background_concurrency, self.max_concurrency))
+        self.batch_window = batch_window
+        self.active = {Priority.interactive: 0, Priority.background: 0}
+        self._waiters = []
+        self._seq = itertools.count()
+        # 低優先度のリクエストのまとまりの番号（送り出し済みの最大の番号まで実行できる）
+        self._batch = 0
+        self._released_batch = 0
+
+    @asynccontextmanager
+    async def slot(self, priority=Priority.interactive):
+        """
+        実行枠を確保してから処理を行う（async with で使う）
+        """
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    async def run(self, priority, fn):
+        async with self.slot(priority):
+            return await fn()
+
+    async def _acquire(self, priority):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = 0
+        if priority != Priority.interactive and self.batch_window > 0:
+            # 最初の低優先度のリクエストから一定時間待って、その間に来たものとまとめて送り出す
+            if self._batch == self._released_batch:
+                self._batch += 1
+                loop.call_later(self.batch_window, self._release_batch, self._batch)
+            batch = self._batch
+        heapq.heappush(self._waiters, (priority, next(self._seq), batch, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 実行枠を割り当てた直後に取り消された場合は返却する
+            if future.done() and not future.cancelled():
+                self._release(priority)
+            raise
+
+    def _release(self, priority):
+        self.active[priority] -= 1
+        self._dispatch()
+
+    def _release_batch(self, batch):
+        self._released_batch = max(self._released_batch, batch)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiters:
+            priority, _, batch, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if sum(self.active.values()) >= self.max_concurrency:
+                break
+            if priority != Priority.interactive:
+                # 以降はすべて低優先度（追加順）なので、ここで止めてよい
+                if self.active[Priority.background] >= self.background_concurrency or batch > self._released_batch:
+                    break
+            heapq.heappop(self._waiters)
+            self.active[priority] += 1
+            future.set_result(None)
+
+    def status(self):
+        waiting = {Priority.interactive: 0, Priority.background: 0}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                waiting[priority] += 1
+        return {
+            "max_concurrency": self.max_concurrency,
+            "background_concurrency": self.background_concurrency,
+            "active": {"interactive": self.active[Priority.interactive], "background": self.active[Priority.background]},
+            "waiting": {"interactive": waiting[Priority.interactive], "background": waiting[Priority.background]}
+        }
@@ -1,6 +1,7 @@
-from fastapi import FastAPI, UploadFile, File, Form, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, WebSocket, WebSocketDisconnect, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, ValidationError
 from typing import List, Optional, Dict, Any
 import uuid
 import json
@@ -18,6 +19,45 @@ import aiohttp
 import base64
 from io import BytesIO
 import traceback
+import codecs
+import hashlib
+import hmac
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from app_logging import setup_logging, bind, LazyJSON
+from html_extract import HTMLTextExtractor
+from interaction_log import InteractionLog, ReplayMiss, request_key
+from shell_session import ShellSessionManager, ShellSessionError
+from search_index import SearchIndex
+from event_log import EventLog
+from sandbox import ResourceLimits, CgroupManager, parse_timeout, run_limited
+from session_ids import is_valid_session_id
+from workspace import WorkspaceManager, WorkspaceQuotaExceeded
+from json_stream import IncrementalJSONParser
+from ollama_sessions import OllamaSessionStore
+from model_residency import ModelResidencyManager
+from llm_scheduler import LLMScheduler, Priority
+from metrics import MetricsRegistry
+from ollama_pool import OllamaBackendPool, BackendError, NoBackendAvailable, RETRYABLE_STATUS_CODES, NOT_FAULT_STATUS_CODES
+from ollama_retry import (
+    OllamaError, OllamaUnavailableError, OllamaRequestError, OllamaOutputError, DeadlineExceeded,
+    RetryPolicy, Deadline, current_deadline, request_timeout, error_from_status, error_from_exception, error_from_kind
+)
+from profiler import SamplingProfiler, LoopLagMonitor
+from prompt_builder import PromptBuilder, HistoryCompactor, allocate_evenly
+from tokens import estimate_tokens, truncate_to_tokens
+from tracing import Tracer, OTLPFileExporter
+from models import (
+    ModelInfo, FileAttachment, Message, ChatSession, TaskStatus, Task, TaskStepStatus, TaskStep,
+    AgentActionType, AgentAction, AgentState
+)
+from records import MessageRecord, TaskRecord, TaskStepRecord, AgentActionRecord
+from usage import UsageTracker
+
+logger = logging.getLogger(__name__)
 
 # FastAPIアプリケーションの初期化
 app = FastAPI(title="Manus Clone API")
@@ -31,112 +71,179 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# データモデル定義
-class ModelInfo(BaseModel):
-    id: str
-    name: str
-    description: str
-    context_length: int
-
-class FileAttachment(BaseModel):
-    id: str
-    name: str
-    type: str
-    url: str
-    size: int
-
-class Message(BaseModel):
-    id: str
-    role: str
-    content: str
-    timestamp: datetime
-    files: Optional[List[FileAttachment]] = None
-
-class ChatSession(BaseModel):
-    id: str
-    model_id: str
-    title: str
-    created_at: datetime
-    updated_at: datetime
-
-class TaskStatus(str, Enum):
-    pending = "pending"
-    in_progress = "in_progress"
-    completed = "completed"
-    failed = "failed"
-
-class Task(BaseModel):
-    id: str
-    session_id: str
-    title: str
-    description: str
-    status: TaskStatus
-    created_at: datetime
-    updated_at: datetime
-
-class TaskStepStatus(str, Enum):
-    pending = "pending"
-    in_progress = "in_progress"
-    completed = "completed"
-    failed = "failed"
-
-class TaskStep(BaseModel):
-    id: str
-    task_id: str
+# タスク解析で生成する実行計画のモデル
+class PlanActionType(str, Enum):
+    shell_command = "shell_command"
+    read_file = "read_file"
+    write_file = "write_file"
+    web_fetch = "web_fetch"
+
+class PlanStep(BaseModel):
     title: str
     description: str
-    status: TaskStepStatus
-    created_at: datetime
-    updated_at: datetime
-
-class AgentActionType(str, Enum):
-    command = "command"
-    file_operation = "file_operation"
-    network_request = "network_request"
-    analysis = "analysis"
-    other = "other"
-    browser = "browser"
-    file = "file"
-    notify = "notify"
-    ask = "ask"
-
-class AgentAction(BaseModel):
-    id: str
-    session_id: str
-    type: AgentActionType
-    description: str
-    details: Optional[Dict[str, Any]] = None
-    created_at: datetime
-
-class AgentState(str, Enum):
-    idle = "idle"
-    thinking = "thinking"  # 思考中の状態を追加
-    planning = "planning"
-    executing = "executing"
-    waiting_for_user = "waiting_for_user"
-    error = "error"
-    completed = "completed"
+    action: PlanActionType
+    params: Dict[str, Any] = {}
+
+class TaskPlan(BaseModel):
+    thought: str
+    steps: List[PlanStep]
 
 # インメモリデータストア（実際の実装ではデータベースを使用）
 models_db = []  # 空リストに変更、Ollamaから動的に取得するため
 
+# ログの出力レベルと形式（json: 1行1レコードのJSON, text: 人が読む形式）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT)
+
 # Ollamaの接続設定
 OLLAMA_API_URL = os.environ.get("OLLAMA_API_URL", "http://localhost:11434")
+# 複数のOllamaサーバーを使う場合はカンマ区切りで指定する（未指定ならOLLAMA_API_URLのみ）
+OLLAMA_API_URLS = [url.strip() for url in os.environ.get("OLLAMA_API_URLS", "").split(",") if url.strip()] or [OLLAMA_API_URL]
+# 連続して何回失敗したらバックエンドを切り離すか、切り離してから再試行するまでの秒数
+OLLAMA_BACKEND_FAILURE_THRESHOLD = int(os.environ.get("OLLAMA_BACKEND_FAILURE_THRESHOLD", "3"))
+OLLAMA_BACKEND_RESET_TIMEOUT = float(os.environ.get("OLLAMA_BACKEND_RESET_TIMEOUT", "30"))
+# バックエンドのヘルスチェックの間隔（秒、0で無効）
+OLLAMA_BACKEND_PROBE_INTERVAL = float(os.environ.get("OLLAMA_BACKEND_PROBE_INTERVAL", "15"))
+# モデルをロード済みのバックエンドへの偏りを許す処理中リクエスト数の差
+OLLAMA_BACKEND_MAX_LOAD_SKEW = int(os.environ.get("OLLAMA_BACKEND_MAX_LOAD_SKEW", "4"))
+# Ollamaへの1リクエストあたりのタイムアウト（秒）
+OLLAMA_REQUEST_TIMEOUT = float(os.environ.get("OLLAMA_REQUEST_TIMEOUT", "120"))
+# 過負荷・タイムアウトなど一時的な失敗の再試行（試行回数と待機時間の基準・上限、秒）
+OLLAMA_RETRY_ATTEMPTS = int(os.environ.get("OLLAMA_RETRY_ATTEMPTS", "3"))
+OLLAMA_RETRY_BASE_DELAY = float(os.environ.get("OLLAMA_RETRY_BASE_DELAY", "0.5"))
+OLLAMA_RETRY_MAX_DELAY = float(os.environ.get("OLLAMA_RETRY_MAX_DELAY", "8"))
+# Ollamaへ同時に送るリクエスト数の上限と、そのうち要約など後回しにできるリクエストに使える数
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", str(4 * len(OLLAMA_API_URLS))))
+LLM_BACKGROUND_CONCURRENCY = int(os.environ.get("LLM_BACKGROUND_CONCURRENCY", "2"))
+# 後回しにできるリクエストをまとめて送るために集める時間（秒）
+LLM_BATCH_WINDOW = float(os.environ.get("LLM_BATCH_WINDOW", "0.2"))
+# タスク完了後のLLMによる要約（background: 完了通知の後に生成, on_demand: クライアントの要求時のみ生成）
+TASK_SUMMARY_MODE = os.environ.get("TASK_SUMMARY_MODE", "background")
+# この数以下のステップがすべて成功し、出力も短いタスクはLLMを使わずに定型文で要約する
+SUMMARY_TRIVIAL_MAX_STEPS = int(os.environ.get("SUMMARY_TRIVIAL_MAX_STEPS", "2"))
+SUMMARY_TRIVIAL_MAX_OUTPUT_TOKENS = int(os.environ.get("SUMMARY_TRIVIAL_MAX_OUTPUT_TOKENS", "300"))
+# 要約の生成用に保持する実行結果の件数と保持時間（秒）（超えたものは古い順に捨て、要約は作れなくなる）
+TASK_RESULTS_MAX_ENTRIES = int(os.environ.get("TASK_RESULTS_MAX_ENTRIES", "200"))
+TASK_RESULTS_TTL = int(os.environ.get("TASK_RESULTS_TTL", str(60 * 60)))
+# 1つのタスクの処理全体（計画・各ステップ・要約）の制限時間（秒、0で無制限）
+AGENT_JOB_TIMEOUT = int(os.environ.get("AGENT_JOB_TIMEOUT", "1800"))
+# セッションごとに保持するトレースのスパン数（古いものから捨てる）
+TRACE_MAX_SPANS_PER_SESSION = int(os.environ.get("TRACE_MAX_SPANS_PER_SESSION", "2000"))
+# トレースを参照できるタスクの数（古いものから捨てる）
+TRACE_MAX_TASKS = int(os.environ.get("TRACE_MAX_TASKS", "1000"))
+# 完了したトレースをOTLP/JSON形式で追記するファイル（未指定なら書き出さない）
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+# Ollamaとのやり取りとツールの実行結果の記録・再生（off / record / replay）と記録先
+INTERACTION_MODE = os.environ.get("INTERACTION_MODE", "off")
+INTERACTION_LOG_DIR = os.environ.get("INTERACTION_LOG_DIR", "interactions")
+# 再生の速さ（1で記録した所要時間どおり、0で待たずに返す）と、再生するツール（all / network）
+INTERACTION_REPLAY_SPEED = float(os.environ.get("INTERACTION_REPLAY_SPEED", "0"))
+INTERACTION_REPLAY_TOOLS = os.environ.get("INTERACTION_REPLAY_TOOLS", "all")
+# 再生時にストリーミングの応答を分割して返す文字数
+REPLAY_STREAM_CHUNK_CHARS = 16
+# 管理用API（プロファイラーなど）に必要なトークン（X-Admin-Tokenヘッダーで渡す。未設定なら管理用APIは無効）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# 1回のプロファイリングの最大秒数
+PROFILER_MAX_SECONDS = float(os.environ.get("PROFILER_MAX_SECONDS", "60"))
+# イベントループがこの秒数以上止まったら、その間の呼び出しをログに出す（0で監視しない）
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", "0.1"))
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.05"))
+# セッションごとのリソース使用量の上限（0で無制限）。上限に達したセッションでは新しいステップを実行しない
+SESSION_BUDGET_TOKENS = int(os.environ.get("SESSION_BUDGET_TOKENS", "0"))
+SESSION_BUDGET_LLM_SECONDS = float(os.environ.get("SESSION_BUDGET_LLM_SECONDS", "0"))
+SESSION_BUDGET_TOOL_SECONDS = float(os.environ.get("SESSION_BUDGET_TOOL_SECONDS", "0"))
+SESSION_BUDGET_CPU_SECONDS = float(os.environ.get("SESSION_BUDGET_CPU_SECONDS", "0"))
+# 全文検索の索引に含める1件あたりの文字数
+SEARCH_MAX_DOCUMENT_CHARS = int(os.environ.get("SEARCH_MAX_DOCUMENT_CHARS", "20000"))
+# セッションの状態の変更をイベントログとして保存し、再起動時に復元するかどうかと保存先
+SESSION_LOG_ENABLED = os.environ.get("SESSION_LOG_ENABLED", "1") == "1"
+SESSION_LOG_DIR = os.environ.get("SESSION_LOG_DIR", "session_logs")
+# イベントログをまとめて書き込み・fsyncする間隔（秒）と、スナップショットを書き出すイベント数
+SESSION_LOG_FLUSH_INTERVAL = float(os.environ.get("SESSION_LOG_FLUSH_INTERVAL", "0.05"))
+SESSION_LOG_SNAPSHOT_EVERY = int(os.environ.get("SESSION_LOG_SNAPSHOT_EVERY", "1000"))
+
+# web_fetchで取得したHTMLから抽出するテキストのトークン上限
+WEB_EXTRACT_MAX_TOKENS = int(os.environ.get("WEB_EXTRACT_MAX_TOKENS", "2000"))
+# web_fetchのキャッシュ有効期間（秒）
+WEB_CACHE_TTL = int(os.environ.get("WEB_CACHE_TTL", "600"))
+
+# セッションごとに常駐シェルを使うかどうか（Windowsでは常にコマンドごとに起動する）
+PERSISTENT_SHELL_ENABLED = os.environ.get("PERSISTENT_SHELL_ENABLED", "1") == "1" and sys.platform != 'win32'
+# 常駐シェルを回収するまでのアイドル時間（秒）
+PERSISTENT_SHELL_IDLE_TIMEOUT = int(os.environ.get("PERSISTENT_SHELL_IDLE_TIMEOUT", "600"))
+# シェルコマンド1つあたりのタイムアウト（秒）
+SHELL_COMMAND_TIMEOUT = int(os.environ.get("SHELL_COMMAND_TIMEOUT", "300"))
+# シェルコマンドにリソース制限をかけるかどうか（制限値はSANDBOX_*で設定）
+SANDBOX_ENABLED = os.environ.get("SANDBOX_ENABLED", "1") == "1" and sys.platform != 'win32'
+
+# 実行計画の出力形式（schema: JSONスキーマで制約, json: JSONモードのみ）
+PLAN_OUTPUT_FORMAT = os.environ.get("PLAN_OUTPUT_FORMAT", "schema")
+# Ollamaに指定するコンテキスト長の上限（モデルの最大値と小さい方を使う）
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "8192"))
+# 出力トークン数の上限（プロンプトの予算からあらかじめ差し引く）
+PLAN_MAX_TOKENS = int(os.environ.get("PLAN_MAX_TOKENS", "2000"))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "1000"))
+# モデルをメモリに保持する時間（Ollamaのkeep_alive）
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# 同時に常駐させるモデル数（超えた分は最も長く使われていないモデルからアンロードする）
+MODEL_MAX_RESIDENT = int(os.environ.get("MODEL_MAX_RESIDENT", "2"))
+# セッションごとに過去のやり取りを/api/chatに引き継いでKVキャッシュを再利用するかどうか
+OLLAMA_SESSION_CONTEXT_ENABLED = os.environ.get("OLLAMA_SESSION_CONTEXT_ENABLED", "1") == "1"
+OLLAMA_SESSION_MAX_TURNS = int(os.environ.get("OLLAMA_SESSION_MAX_TURNS", "8"))
+OLLAMA_SESSION_MAX_TOKENS = int(os.environ.get("OLLAMA_SESSION_MAX_TOKENS", "3000"))
+OLLAMA_SESSION_MAX_SESSIONS = int(os.environ.get("OLLAMA_SESSION_MAX_SESSIONS", "100"))
+OLLAMA_SESSION_TTL = int(os.environ.get("OLLAMA_SESSION_TTL", "1800"))
+# 要約せずにそのまま残す直近のメッセージ数
+HISTORY_KEEP_RECENT = int(os.environ.get("HISTORY_KEEP_RECENT", "6"))
+# 会話履歴の要約1回に渡すメッセージの最小トークン数（1メッセージは最大300トークンに切り詰められる）
+MIN_SUMMARY_CHUNK_TOKENS = 512
+
+# 不正な実行計画を修正させる再試行の回数
+PLAN_REPAIR_RETRIES = int(os.environ.get("PLAN_REPAIR_RETRIES", "2"))
+# ステップが失敗したときに残りのステップを立て直す回数と、そのために使うトークン数の上限（タスクごと）
+TASK_REPLAN_RETRIES = int(os.environ.get("TASK_REPLAN_RETRIES", "2"))
+TASK_REPLAN_TOKEN_BUDGET = int(os.environ.get("TASK_REPLAN_TOKEN_BUDGET", "12000"))
+# 計画の生成完了を待たずに最初のステップを先行実行するかどうか
+SPECULATIVE_EXECUTION_ENABLED = os.environ.get("SPECULATIVE_EXECUTION_ENABLED", "1") == "1"
+# 先行実行してよいアクション（取り消せないシェルコマンドは含めない）
+SPECULATIVE_ACTIONS = {"read_file", "web_fetch", "write_file"}
+
+# ワークスペースの設定（クォータ・回収までのアイドル時間は0で無効）
+WORKSPACE_ROOT = os.environ.get("WORKSPACE_ROOT", "workspaces")
+WORKSPACE_QUOTA_MB = int(os.environ.get("WORKSPACE_QUOTA_MB", "1024"))
+WORKSPACE_TTL = int(os.environ.get("WORKSPACE_TTL", str(24 * 60 * 60)))
+WORKSPACE_SWEEP_INTERVAL = int(os.environ.get("WORKSPACE_SWEEP_INTERVAL", "300"))
 
 # Ollamaからモデル一覧を取得する関数
 async def fetch_ollama_models() -> List[ModelInfo]:
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_API_URL}/api/tags")
-            
+        async def fetch_tags(backend):
+            async with httpx.AsyncClient() as client:
+                response = await client.get(f"{backend.url}/api/tags")
             if response.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"Ollamaサーバーからの応答エラー: {response.status_code}")
-            
-            data = response.json()
-            models = []
-            
+                raise BackendError(f"Ollamaサーバーからの応答エラー: {response.status_code}", response.status_code)
+            return response.json()
+        
+        # 各バックエンドのモデル一覧をまとめる（応答しないバックエンドは除く）
+        results = await asyncio.gather(
+            *(ollama_pool.call_backend(backend, fetch_tags) for backend in ollama_pool.backends),
+            return_exceptions=True
+        )
+        if all(isinstance(result, Exception) for result in results):
+            raise HTTPException(status_code=500, detail=f"Ollamaサーバーからの応答エラー: {results[0]}")
+        
+        models = []
+        seen = set()
+        
+        for data in results:
+            if isinstance(data, Exception):
+                continue
             for model in data.get("models", []):
                 model_name = model.get("name", "")
+                if model_name in seen:
+                    continue
+                seen.add(model_name)
                 models.append(
                     ModelInfo(
                         id=model_name,
@@ -145,34 +252,34 @@ async def fetch_ollama_models() -> List[ModelInfo]:
                         context_length=8192  # デフォルト値、実際のコンテキスト長はモデルごとに異なる
                     )
                 )
-            
-            # モデルが見つからない場合はデフォルトモデルを追加
-            if not models:
-                models = [
-                    ModelInfo(
-                        id="llama3-8b",
-                        name="Llama 3 8B",
-                        description="Meta AI製の8Bパラメータモデル",
-                        context_length=8192
-                    ),
-                    ModelInfo(
-                        id="mistral-7b",
-                        name="Mistral 7B",
-                        description="Mistral AI製の高性能7Bパラメータモデル",
-                        context_length=8192
-                    ),
-                    ModelInfo(
-                        id="gemma-7b",
-                        name="Gemma 7B",
-                        description="Google製のオープンモデル",
-                        context_length=8192
-                    )
-                ]
-            
-            return models
+        
+        # モデルが見つからない場合はデフォルトモデルを追加
+        if not models:
+            models = [
+                ModelInfo(
+                    id="llama3-8b",
+                    name="Llama 3 8B",
+                    description="Meta AI製の8Bパラメータモデル",
+                    context_length=8192
+                ),
+                ModelInfo(
+                    id="mistral-7b",
+                    name="Mistral 7B",
+                    description="Mistral AI製の高性能7Bパラメータモデル",
+                    context_length=8192
+                ),
+                ModelInfo(
+                    id="gemma-7b",
+                    name="Gemma 7B",
+                    description="Google製のオープンモデル",
+                    context_length=8192
+                )
+            ]
+        
+        return models
     except Exception as e:
         # エラー発生時もデフォルトモデルを返す
-        print(f"Ollamaモデル取得エラー: {str(e)}")
+        logger.warning("Ollamaモデル取得エラー: %s", e)
         return [
             ModelInfo(
                 id="llama3-8b",
@@ -195,11 +302,169 @@ async def fetch_ollama_models() -> List[ModelInfo]:
         ]
 
 sessions_db: Dict[str, ChatSession] = {}
-messages_db: Dict[str, List[Message]] = {}
-tasks_db: Dict[str, List[Task]] = {}
-task_steps_db: Dict[str, List[TaskStep]] = {}
-agent_actions_db: Dict[str, List[AgentAction]] = {}
+# メッセージ・タスク・ステップ・アクションは省メモリの記録で保持し、返す時点でAPIのモデルに変換する
+messages_db: Dict[str, List[MessageRecord]] = {}
+tasks_db: Dict[str, List[TaskRecord]] = {}
+task_steps_db: Dict[str, List[TaskStepRecord]] = {}
+agent_actions_db: Dict[str, List[AgentActionRecord]] = {}
 agent_state_db: Dict[str, AgentState] = {}
+# 完了したタスクの要約の生成に使う実行結果（タスクID -> 実行結果、古い順）
+task_results_db: Dict[str, Dict[str, Any]] = OrderedDict()
+# 生成中のタスクの要約（タスクID -> asyncio.Task）
+task_summary_jobs: Dict[str, asyncio.Task] = {}
+# モデルIDごとのコンテキスト長
+model_context_db: Dict[str, int] = {}
+# セッションごとの会話履歴の要約
+history_compactor = HistoryCompactor()
+# セッションごとのOllamaとの会話（KVキャッシュの再利用用）
+ollama_sessions = OllamaSessionStore(
+    max_sessions=OLLAMA_SESSION_MAX_SESSIONS,
+    max_tokens=OLLAMA_SESSION_MAX_TOKENS,
+    max_turns=OLLAMA_SESSION_MAX_TURNS,
+    ttl=OLLAMA_SESSION_TTL
+)
+# Ollamaサーバー（複数可）へのリクエストの振り分け
+ollama_pool = OllamaBackendPool(
+    OLLAMA_API_URLS,
+    failure_threshold=OLLAMA_BACKEND_FAILURE_THRESHOLD,
+    reset_timeout=OLLAMA_BACKEND_RESET_TIMEOUT,
+    probe_interval=OLLAMA_BACKEND_PROBE_INTERVAL,
+    max_load_skew=OLLAMA_BACKEND_MAX_LOAD_SKEW
+)
+# Ollamaへのリクエストの再試行方針
+ollama_retry_policy = RetryPolicy(
+    max_attempts=OLLAMA_RETRY_ATTEMPTS,
+    base_delay=OLLAMA_RETRY_BASE_DELAY,
+    max_delay=OLLAMA_RETRY_MAX_DELAY
+)
+# Ollamaへのリクエストの優先度付きの実行枠
+llm_scheduler = LLMScheduler(
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    background_concurrency=LLM_BACKGROUND_CONCURRENCY,
+    batch_window=LLM_BATCH_WINDOW
+)
+# Ollamaとのやり取りとツールの実行結果の記録・再生
+interactions = InteractionLog(
+    mode=INTERACTION_MODE,
+    directory=INTERACTION_LOG_DIR,
+    replay_speed=INTERACTION_REPLAY_SPEED,
+    replay_tools=INTERACTION_REPLAY_TOOLS
+)
+# Ollamaに常駐させるモデルの管理（記録の再生中はOllamaを使わない）
+model_residency = ModelResidencyManager(
+    ollama_pool,
+    max_resident=MODEL_MAX_RESIDENT,
+    keep_alive=OLLAMA_KEEP_ALIVE,
+    enabled=not interactions.replaying
+)
+
+# メトリクス（/metricsでPrometheusのテキスト形式で出力する）
+metrics = MetricsRegistry()
+ollama_request_seconds = metrics.histogram(
+    "ollama_request_duration_seconds", "Ollamaへのリクエストの所要時間（待ち・再試行を含む）", ["model", "stream"]
+)
+ollama_first_token_seconds = metrics.histogram(
+    "ollama_time_to_first_token_seconds", "最初のトークンが返るまでの時間", ["model", "stream"]
+)
+ollama_tokens_per_second = metrics.histogram(
+    "ollama_tokens_per_second", "生成速度（トークン/秒）", ["model"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+)
+ollama_prompt_tokens = metrics.counter("ollama_prompt_tokens_total", "評価したプロンプトのトークン数", ["model"])
+ollama_eval_tokens = metrics.counter("ollama_eval_tokens_total", "生成したトークン数", ["model"])
+ollama_request_errors = metrics.counter("ollama_request_errors_total", "Ollamaへのリクエストの失敗数", ["model", "kind"])
+step_seconds = metrics.histogram("agent_step_duration_seconds", "ステップの実行時間", ["action"])
+broadcast_seconds = metrics.histogram(
+    "websocket_broadcast_duration_seconds", "1回の配信で全接続に送り終えるまでの時間",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+agent_jobs_running = metrics.gauge("agent_jobs_running", "実行中のエージェントの処理数")
+event_loop_lag_seconds = metrics.histogram(
+    "event_loop_lag_seconds", "イベントループの応答の遅れ",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+metrics.callback_gauge("chat_sessions", "チャットセッション数", lambda: len(sessions_db))
+metrics.callback_gauge(
+    "websocket_connections", "WebSocketの接続数", lambda: sum(len(connections) for connections in manager.active_connections.values())
+)
+metrics.callback_gauge("websocket_sessions", "WebSocketが接続しているセッション数", lambda: len(manager.active_connections))
+metrics.callback_gauge(
+    "llm_scheduler_requests", "Ollamaへのリクエストの実行枠の状態", lambda: {
+        (state, priority): count
+        for state, counts in llm_scheduler.status().items() if state in ("active", "waiting")
+        for priority, count in counts.items()
+    }, ["state", "priority"]
+)
+metrics.callback_gauge(
+    "ollama_backend_outstanding", "バックエンドごとの処理中のリクエスト数",
+    lambda: {(backend.url,): backend.outstanding for backend in ollama_pool.backends}, ["backend"]
+)
+metrics.callback_gauge(
+    "ollama_backend_up", "バックエンドが利用可能か（サーキットブレーカーが開いていなければ1）",
+    lambda: {(backend.url,): int(backend.state != "open") for backend in ollama_pool.backends}, ["backend"]
+)
+metrics.callback_gauge(
+    "store_items", "インメモリのストアの件数", lambda: {
+        ("sessions",): len(sessions_db),
+        ("messages",): sum(len(messages) for messages in messages_db.values()),
+        ("tasks",): sum(len(tasks) for tasks in tasks_db.values()),
+        ("task_steps",): sum(len(steps) for steps in task_steps_db.values()),
+        ("agent_actions",): sum(len(actions) for actions in agent_actions_db.values()),
+        ("task_results",): len(task_results_db),
+        ("ollama_conversations",): len(ollama_sessions.conversations),
+        ("history_summaries",): len(history_compactor.summaries),
+        ("search_documents",): len(search_index.documents)
+    }, ["store"]
+)
+
+def record_ollama_timings(model_id, stream, result, first_token_seconds=None):
+    """
+    Ollamaの応答（ストリーミングの場合は最後のチャンク）に含まれる計測値を記録する
+    """
+    if first_token_seconds is None and result.get("prompt_eval_duration") is not None:
+        # 非ストリーミングではロードとプロンプトの評価にかかった時間で近似する
+        first_token_seconds = (result.get("load_duration", 0) + result.get("prompt_eval_duration", 0)) / 1e9
+    if first_token_seconds is not None:
+        ollama_first_token_seconds.observe(first_token_seconds, model=model_id, stream=str(stream).lower())
+    if result.get("prompt_eval_count"):
+        ollama_prompt_tokens.inc(result["prompt_eval_count"], model=model_id)
+    if result.get("eval_count"):
+        ollama_eval_tokens.inc(result["eval_count"], model=model_id)
+        if result.get("eval_duration"):
+            ollama_tokens_per_second.observe(result["eval_count"] / (result["eval_duration"] / 1e9), model=model_id)
+    usage_tracker.add_ollama_response(result)
+
+# 動作中のプロセスのプロファイラーと、イベントループの停止の監視
+profiler = SamplingProfiler(max_seconds=PROFILER_MAX_SECONDS)
+loop_lag_monitor = LoopLagMonitor(
+    threshold=LOOP_LAG_THRESHOLD, interval=LOOP_LAG_INTERVAL, on_lag=event_loop_lag_seconds.observe
+)
+
+# セッション・タスクごとのリソース使用量
+usage_tracker = UsageTracker(budgets={
+    "tokens": SESSION_BUDGET_TOKENS,
+    "llm_seconds": SESSION_BUDGET_LLM_SECONDS,
+    "tool_seconds": SESSION_BUDGET_TOOL_SECONDS,
+    "subprocess_cpu_seconds": SESSION_BUDGET_CPU_SECONDS
+})
+
+# メッセージとアクションの全文検索
+search_index = SearchIndex(max_document_chars=SEARCH_MAX_DOCUMENT_CHARS)
+
+# セッションの状態の変更のイベントログ（スナップショットの状態は session_state() で作る）
+session_log = EventLog(
+    directory=SESSION_LOG_DIR,
+    flush_interval=SESSION_LOG_FLUSH_INTERVAL,
+    snapshot_every=SESSION_LOG_SNAPSHOT_EVERY,
+    snapshot_fn=lambda session_id: session_state(session_id)
+) if SESSION_LOG_ENABLED else None
+
+# タスクごとの処理のトレース
+tracer = Tracer(
+    max_spans_per_session=TRACE_MAX_SPANS_PER_SESSION,
+    exporter=OTLPFileExporter(TRACE_EXPORT_PATH) if TRACE_EXPORT_PATH else None,
+    max_task_traces=TRACE_MAX_TASKS
+)
 
 # API用のプロンプトテンプレート - より単純なシステムプロンプトに変更
 SYSTEM_PROMPT = """
@@ -207,113 +472,456 @@ SYSTEM_PROMPT = """
 レスポンスはJSON形式で返してください。
 """
 
-# テスト用の単純なリクエスト関数を追加
-async def test_ollama_simple_request():
+def build_ollama_request(model_id, prompt, system_prompt, max_tokens, format=None, num_ctx=None, stream=False, conversation=None):
+    """
+    Ollamaへのリクエストのパスとデータを作成する（送信先のバックエンドはollama_poolが選ぶ）
+
+    conversationを指定した場合は、過去のやり取りを先頭に付けて/api/chatへ送る。
+    """
+    options = {
+        "num_predict": max_tokens
+    }
+    if num_ctx is not None:
+        options["num_ctx"] = num_ctx
+    
+    if conversation is not None:
+        path = "/api/chat"
+        data = {
+            "model": model_id,
+            "messages": conversation.messages(prompt),
+            "stream": stream,
+            "options": options,
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }
+    else:
+        path = "/api/generate"
+        data = {
+            "model": model_id,
+            "prompt": prompt,
+            "system": system_prompt,
+            "stream": stream,
+            "options": options,
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }
+    if format is not None:
+        data["format"] = format
+    return path, data
+
+def get_session_conversation(session_id, model_id, system_prompt):
+    """
+    セッションのOllamaとの会話を取得する（無効な場合はNone）
+    """
+    if not session_id or not OLLAMA_SESSION_CONTEXT_ENABLED:
+        return None
+    return ollama_sessions.get(session_id, model_id, system_prompt)
+
+def session_conversation_tokens(session_id, model_id):
+    """
+    セッションの会話として先頭に付く過去のやり取りの概算トークン数
+    """
+    conversation = ollama_sessions.conversations.get(session_id) if session_id else None
+    if conversation is None or conversation.model_id != model_id:
+        return 0
+    return conversation.tokens
+
+# Ollamaからレスポンスを取得する関数 - 改善版
+async def get_ollama_response(model_id, prompt, system_prompt=SYSTEM_PROMPT, max_tokens=4000, format=None, num_ctx=None, session_id=None, priority=Priority.interactive):
     """
-    Ollamaへの最小限のリクエストテスト
+    Ollamaサーバーからレスポンスを取得する関数 - 改善版
+
+    formatに "json" またはJSONスキーマを指定すると、出力をその形式に制約する。
+    num_ctxを指定すると、その長さのコンテキストでモデルを動かす。
+    session_idを指定すると、そのセッションの過去のやり取りに続けて送信し、
+    Ollama側のKVキャッシュを再利用させる。
+    失敗した場合はOllamaErrorのサブクラスを送出する。過負荷やタイムアウトなど
+    一時的な失敗は、タスクの制限時間の範囲で待機してから再試行する。
+    要約など後回しにできるリクエストはpriorityにPriority.backgroundを指定する。
     """
-    model_id = "llama3" # または使用可能な別のモデル
-    simple_prompt = "こんにちは"
-    simple_system = "あなたは有能なアシスタントです。"
+    interaction_key = request_key(model_id, prompt, system_prompt, max_tokens, format, num_ctx)
+    if interactions.replaying:
+        return await replay_ollama_response("generate", interaction_key)
     
-    print("--- シンプルなOllamaリクエストテスト開始 ---")
+    conversation = get_session_conversation(session_id, model_id, system_prompt)
+    path, data = build_ollama_request(
+        model_id, prompt, system_prompt, max_tokens,
+        format=format, num_ctx=num_ctx, conversation=conversation
+    )
     
-    base_url = OLLAMA_API_URL
-    url = f"{base_url}/api/generate"
+    logger.debug("Ollamaリクエスト内容: %s...", LazyJSON(data, limit=500))
+    model_residency.touch(model_id)
     
-    # 最小限のデータ
-    data = {
-        "model": model_id,
-        "prompt": simple_prompt,
-        "system": simple_system,
-        "stream": False
-    }
+    async def send(backend):
+        async with httpx.AsyncClient(timeout=request_timeout(OLLAMA_REQUEST_TIMEOUT)) as client:
+            response = await client.post(f"{backend.url}{path}", json=data)
+        # 過負荷やモデル未取得のバックエンドでは別のバックエンドで再試行する
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise BackendError(f"HTTPエラー: {response.status_code} - {response.text}", response.status_code)
+        return response
+    
+    async def attempt():
+        try:
+            async with llm_slot(priority):
+                response = await ollama_pool.call(model_id, send)
+        except (NoBackendAvailable, httpx.HTTPError) as e:
+            raise error_from_exception(e) from e
+        if response.status_code != 200:
+            raise error_from_status(response.status_code, f"HTTPエラー: {response.status_code} - {response.text}")
+        try:
+            return response.json()
+        except json.JSONDecodeError as e:
+            raise OllamaError(f"JSONデコードエラー: {str(e)}") from e
+    
+    with tracer.span("ollama.request", model=model_id, stream=False) as span:
+        started = time.monotonic()
+        try:
+            result = await ollama_retry_policy.run(attempt)
+        except OllamaError as e:
+            logger.warning("Ollamaリクエストエラー（%s）: %.500s", e.kind, e)
+            ollama_request_errors.inc(model=model_id, kind=e.kind)
+            record_ollama_interaction("generate", interaction_key, model_id, prompt, format, started, error=e)
+            raise
+        ollama_request_seconds.observe(time.monotonic() - started, model=model_id, stream="false")
+        record_ollama_timings(model_id, False, result)
+        if span is not None:
+            span.set(prompt_tokens=result.get("prompt_eval_count"), eval_tokens=result.get("eval_count"))
     
+    if conversation is not None:
+        response_text = result.get("message", {}).get("content", "")
+        ollama_sessions.record(session_id, conversation, prompt, response_text)
+    else:
+        response_text = result.get("response", "")
+    logger.debug("Ollamaレスポンス成功: 長さ%d文字", len(response_text))
+    record_ollama_interaction("generate", interaction_key, model_id, prompt, format, started, response_text)
+    return response_text
+
+def record_ollama_interaction(kind, key, model_id, prompt, format, started, response=None, error=None):
+    """
+    Ollamaへのリクエストの結果を記録する（記録モードのときのみ）
+    """
+    if not interactions.recording:
+        return
+    interactions.record(
+        kind, key,
+        {"model": model_id, "prompt_chars": len(prompt), "format": format is not None},
+        response, time.monotonic() - started,
+        error={"kind": error.kind, "message": str(error)} if error is not None else None
+    )
+
+async def replay_ollama_response(kind, key):
+    """
+    記録したOllamaの応答を返す（記録した失敗は同じ種類の例外として送出する）
+    """
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=data)
-            
-            if response.status_code == 200:
-                result = response.json()
-                print(f"成功! レスポンス: {result.get('response', '')[:100]}...")
-                return True
-            else:
-                print(f"エラー: {response.status_code} - {response.text}")
-                return False
-    except Exception as e:
-        print(f"例外: {str(e)}")
-        return False
+        entry = await interactions.replay(kind, key)
+    except ReplayMiss as e:
+        raise OllamaRequestError(str(e)) from e
+    if "error" in entry:
+        raise error_from_kind(entry["error"]["kind"], entry["error"]["message"])
+    return entry["response"]
 
-# Ollamaからレスポンスを取得する関数 - 改善版
-async def get_ollama_response(model_id, prompt, system_prompt=SYSTEM_PROMPT, max_tokens=4000):
+@asynccontextmanager
+async def llm_slot(priority):
     """
-    Ollamaサーバーからレスポンスを取得する関数 - 改善版
+    Ollamaへのリクエストの実行枠を確保する（実行枠を待った時間をトレースに記録する）
+    """
+    waited = time.time_ns()
+    async with llm_scheduler.slot(priority):
+        tracer.record("llm.queue_wait", waited, priority="interactive" if priority == Priority.interactive else "background")
+        yield
+
+async def _stream_from_pool(model_id, path, data, on_done):
+    """
+    バックエンドを選んで生成中のテキストを逐次返す（何も返す前の失敗は別のバックエンドで再試行する）
+    """
+    parts = []
+    tried = set()
+    last_error = OllamaUnavailableError("利用可能なOllamaバックエンドがありません")
+    while True:
+        backend = ollama_pool.acquire(model_id, exclude=tried)
+        if backend is None:
+            raise last_error
+        tried.add(backend.url)
+        # 成否（Noneは途中で打ち切られた場合など、バックエンドの状態として記録しない）
+        success = None
+        try:
+            async with httpx.AsyncClient(timeout=request_timeout(OLLAMA_REQUEST_TIMEOUT)) as client:
+                async with client.stream("POST", f"{backend.url}{path}", json=data) as response:
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        detail = f"HTTPエラー: {response.status_code} - {body.decode('utf-8', errors='replace')}"
+                        last_error = error_from_status(response.status_code, detail)
+                        if response.status_code in RETRYABLE_STATUS_CODES:
+                            # まだ何も返していないので別のバックエンドで再試行する
+                            success = False if response.status_code not in NOT_FAULT_STATUS_CODES else None
+                            logger.warning("Ollamaバックエンドでの処理に失敗しました: %s - %s", backend.url, detail)
+                            continue
+                        raise last_error
+                    async for line in response.aiter_lines():
+                        if not line.strip():
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            raise OllamaError(chunk["error"])
+                        if "message" in chunk:
+                            text = chunk.get("message", {}).get("content", "")
+                        else:
+                            text = chunk.get("response", "")
+                        if text:
+                            parts.append(text)
+                            yield text
+                        if chunk.get("done"):
+                            on_done("".join(parts), chunk)
+                            break
+            success = True
+            return
+        except httpx.TransportError as e:
+            success = False
+            last_error = error_from_exception(e)
+            if parts:
+                # 出力の途中で切れた場合は再試行できない
+                raise last_error from e
+            logger.warning("Ollamaバックエンドでの処理に失敗しました: %s - %s", backend.url, last_error)
+        except httpx.RequestError as e:
+            raise OllamaError(f"リクエストエラー: {str(e)}") from e
+        except json.JSONDecodeError as e:
+            raise OllamaError(f"JSONデコードエラー: {str(e)}") from e
+        finally:
+            ollama_pool.release(backend, success, model_id)
+
+# Ollamaからレスポンスをストリーミングで取得する関数
+async def stream_ollama_response(model_id, prompt, system_prompt=SYSTEM_PROMPT, max_tokens=4000, format=None, num_ctx=None, session_id=None, priority=Priority.interactive):
+    """
+    Ollamaサーバーから生成中のテキストを逐次取得する（非同期ジェネレーター）
+
+    session_idの扱いはget_ollama_responseと同じで、生成が最後まで完了した場合のみ
+    やり取りをセッションの会話に追加する。一時的な失敗は、まだ何も返していない
+    場合に限りget_ollama_responseと同じ方針で再試行する。
     """
+    interaction_key = request_key(model_id, prompt, system_prompt, max_tokens, format, num_ctx)
+    if interactions.replaying:
+        text = await replay_ollama_response("stream", interaction_key)
+        # 記録した応答を少しずつ返し、逐次処理する側の動きを再現する
+        for i in range(0, len(text), REPLAY_STREAM_CHUNK_CHARS):
+            yield text[i:i + REPLAY_STREAM_CHUNK_CHARS]
+        return
+    
+    conversation = get_session_conversation(session_id, model_id, system_prompt)
+    path, data = build_ollama_request(
+        model_id, prompt, system_prompt, max_tokens,
+        format=format, num_ctx=num_ctx, stream=True, conversation=conversation
+    )
+    model_residency.touch(model_id)
+    
+    request_started = time.monotonic()
+    # 非同期ジェネレーターの中では現在のスパンを切り替えられないため、区間は後から記録する
+    trace_started = time.time_ns()
+    first_token_seconds = None
+    
+    def on_done(text, chunk):
+        ollama_request_seconds.observe(time.monotonic() - request_started, model=model_id, stream="true")
+        record_ollama_interaction("stream", interaction_key, model_id, prompt, format, request_started, text)
+        record_ollama_timings(model_id, True, chunk, first_token_seconds)
+        tracer.record(
+            "ollama.request", trace_started, model=model_id, stream=True, first_token_seconds=first_token_seconds,
+            prompt_tokens=chunk.get("prompt_eval_count"), eval_tokens=chunk.get("eval_count")
+        )
+        if conversation is not None:
+            ollama_sessions.record(session_id, conversation, prompt, text)
+    
+    attempt = 0
+    while True:
+        attempt += 1
+        started = False
+        try:
+            async with llm_slot(priority):
+                async for text in _stream_from_pool(model_id, path, data, on_done):
+                    if not started:
+                        started = True
+                        first_token_seconds = time.monotonic() - request_started
+                    yield text
+            return
+        except OllamaError as e:
+            if started or not ollama_retry_policy.should_retry(e, attempt):
+                ollama_request_errors.inc(model=model_id, kind=e.kind)
+                record_ollama_interaction("stream", interaction_key, model_id, prompt, format, request_started, error=e)
+                raise
+            logger.info("Ollamaへのリクエストを再試行します（%d/%d）: %.200s", attempt, ollama_retry_policy.max_attempts - 1, e)
+            await ollama_retry_policy.backoff(attempt)
+
+async def get_model_context_length(model_id):
+    """
+    モデルのコンテキスト長を返す（記録の再生中は記録した値を返す）
+    """
+    key = request_key(model_id)
+    if interactions.replaying:
+        try:
+            return (await interactions.replay("context_length", key))["response"]
+        except ReplayMiss:
+            return OLLAMA_NUM_CTX
+    started = time.monotonic()
+    context_length = await fetch_model_context_length(model_id)
+    if interactions.recording:
+        interactions.record("context_length", key, {"model": model_id}, context_length, time.monotonic() - started)
+    return context_length
+
+async def fetch_model_context_length(model_id):
+    """
+    モデルのコンテキスト長を取得する（OLLAMA_NUM_CTXを上限とし、結果はキャッシュする）
+    """
+    if model_id in model_context_db:
+        return model_context_db[model_id]
+    
+    async def show(backend):
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.post(f"{backend.url}/api/show", json={"model": model_id})
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise BackendError(f"HTTPエラー: {response.status_code}", response.status_code)
+        return response
+    
+    context_length = None
     try:
-        # 設定からURLを取得
-        base_url = OLLAMA_API_URL
-        url = f"{base_url}/api/generate"
-        
-        # シンプル化したリクエストデータ
-        data = {
-            "model": model_id,
-            "prompt": prompt,
-            "system": system_prompt,
-            "stream": False,
-            "options": {
-                "num_predict": max_tokens
-            }
-        }
-        
-        print(f"Ollamaリクエスト内容: {json.dumps(data, ensure_ascii=False)[:500]}...")
-        
-        # タイムアウト設定を長め（120秒）に設定
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            # まずシンプルなテストリクエストを試す
-            test_success = await test_ollama_simple_request()
-            if not test_success:
-                print("警告: シンプルなテストリクエストが失敗しました。Ollamaサーバーに問題がある可能性があります。")
-            
-            # 実際のリクエストを送信
-            response = await client.post(url, json=data)
-            
-            if response.status_code == 200:
-                result = response.json()
-                response_text = result.get("response", "")
-                print(f"Ollamaレスポンス成功: 長さ{len(response_text)}文字")
-                return response_text
-            else:
-                error_detail = f"HTTPエラー: {response.status_code} - {response.text}"
-                print(f"Ollamaリクエストエラー: {error_detail}")
-                return f"エラー: {error_detail}"
+        response = await ollama_pool.call(model_id, show)
+        if response.status_code == 200:
+            for key, value in response.json().get("model_info", {}).items():
+                if key.endswith(".context_length"):
+                    context_length = int(value)
+                    break
+    except (httpx.HTTPError, NoBackendAvailable, ValueError) as e:
+        logger.warning("モデル情報の取得に失敗しました: %s - %s", model_id, e)
     
-    except httpx.TimeoutException as e:
-        error_msg = f"タイムアウトエラー: {str(e)}"
-        print(error_msg)
-        return f"エラー: {error_msg}"
+    if not context_length:
+        # 取得できない場合はモデル一覧の値を使う
+        known = next((model for model in models_db if model.id == model_id), None)
+        context_length = known.context_length if known else OLLAMA_NUM_CTX
+        
+        # 取得に失敗した場合はキャッシュせず、次回もう一度問い合わせる
+        return min(context_length, OLLAMA_NUM_CTX)
     
-    except httpx.RequestError as e:
-        error_msg = f"リクエストエラー: {str(e)}"
-        print(error_msg)
-        return f"エラー: {error_msg}"
+    model_context_db[model_id] = min(context_length, OLLAMA_NUM_CTX)
+    return model_context_db[model_id]
+
+async def summarize_history(model_id, previous_summary, new_messages):
+    """
+    これまでの要約に新しいメッセージを取り込んだ要約を生成する
+    """
+    context_length = await get_model_context_length(model_id)
+    builder = PromptBuilder(
+        context_length,
+        reserved_tokens=SUMMARY_MAX_TOKENS + estimate_tokens(SYSTEM_PROMPT)
+    )
+    builder.add(f"""
+以下はユーザーとAIエージェントの会話の要約と、その続きのメッセージです。
+重要な事実・ユーザーの要望・作成したファイルや結果を残して、全体を300文字程度の要約にまとめてください。
+要約のみを出力してください。
+
+これまでの要約:
+{previous_summary or "（なし）"}
+""", required=True)
+    # 通常は history_summary_chunk_tokens() ずつ渡されるため収まるが、収まらなければ末尾を切り詰める
+    builder.add(f"続きのメッセージ:\n{new_messages}\n", required=True)
+    prompt = builder.build()
+    try:
+        response = await get_ollama_response(
+            model_id, prompt, max_tokens=SUMMARY_MAX_TOKENS, priority=Priority.background, num_ctx=context_length
+        )
+    except OllamaError:
+        return None
+    return response.strip()
+
+def history_summary_chunk_tokens(model_id):
+    """
+    会話履歴の要約1回に渡すメッセージのトークン数
+
+    出力とシステムプロンプトの分を除いたコンテキスト長の半分とし、残りを指示とこれまでの要約に充てる。
+    呼び出し時点でコンテキスト長が分からないモデルはOLLAMA_NUM_CTXで見積もる。
+    """
+    context_length = model_context_db.get(model_id, OLLAMA_NUM_CTX)
+    return max(MIN_SUMMARY_CHUNK_TOKENS, (context_length - SUMMARY_MAX_TOKENS - estimate_tokens(SYSTEM_PROMPT)) // 2)
+
+def build_history_section(session_id, model_id, budget):
+    """
+    プロンプトに含める会話履歴を予算内で作成する
+
+    入りきらない古い履歴があれば、次回以降のためにバックグラウンドで要約を更新する。
+    """
+    if not session_id or budget <= 0:
+        return ""
+    messages = messages_db.get(session_id, [])
+    # 処理中のユーザーメッセージはプロンプト本体に含めるため除外する
+    if messages and messages[-1].role == "user":
+        messages = messages[:-1]
+    if not messages:
+        return ""
     
-    except json.JSONDecodeError as e:
-        error_msg = f"JSONデコードエラー: {str(e)}"
-        print(error_msg)
-        return f"エラー: {error_msg}"
+    header = "これまでの会話:\n"
+    history, needs_compaction = history_compactor.build_history(
+        session_id, messages, budget - estimate_tokens(header)
+    )
+    if needs_compaction:
+        history_compactor.schedule_compaction(
+            session_id,
+            messages,
+            HISTORY_KEEP_RECENT,
+            lambda previous, new: summarize_history(model_id, previous, new),
+            chunk_tokens=history_summary_chunk_tokens(model_id)
+        )
+    return header + history if history else ""
+
+def plan_output_format():
+    """
+    実行計画の生成時にOllamaへ指定する出力形式を返す
+    """
+    if PLAN_OUTPUT_FORMAT == "schema":
+        return TaskPlan.model_json_schema()
+    return "json"
+
+def extract_json_block(content):
+    """
+    自由形式のテキストからJSON部分を取り出す（```json ブロック、または最初の { から最後の } まで）
+    """
+    import re
     
-    except Exception as e:
-        error_msg = f"予期せぬエラー: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
-        return f"エラー: {error_msg}"
+    json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', content, re.DOTALL)
+    if json_match:
+        return json_match.group(1)
+    first_brace = content.find('{')
+    last_brace = content.rfind('}')
+    if first_brace >= 0 and last_brace > first_brace:
+        return content[first_brace:last_brace+1]
+    return content
+
+def validate_plan(content):
+    """
+    生成されたテキストを実行計画として検証する
+
+    戻り値は (TaskPlan, None) または (None, エラー内容)。
+    """
+    try:
+        return TaskPlan.model_validate_json(content), None
+    except ValidationError as e:
+        # JSONの前後に説明文が付いている場合はJSON部分だけで再検証する
+        json_str = extract_json_block(content)
+        if json_str != content:
+            try:
+                return TaskPlan.model_validate_json(json_str), None
+            except ValidationError:
+                pass
+        return None, str(e)
 
-# タスクを解析して実行ステップに分解する - 改善版
-async def analyze_task(model_id, task_description):
+# タスクを解析して実行ステップに分解する - 構造化出力版
+async def analyze_task(model_id, task_description, on_thought=None, on_step=None, session_id=None):
     """
-    ユーザーのタスク指示を解析し、実行ステップに分解する - 改善版
+    ユーザーのタスク指示を解析し、実行ステップに分解する
+
+    OllamaのJSONモード（スキーマ制約付き）で生成させ、出力をストリーミングで
+    読みながら、完成したステップから順にon_step(添字, ステップ)を呼び出す。
+    生成結果はTaskPlanで検証し、不正な場合は修正を依頼して一定回数まで再試行する。
+    on_thought/on_stepは最初の生成でのみ呼ばれるため、最終的な計画と
+    異なる場合は呼び出し側で差し替える必要がある。
+    session_idを指定すると、そのセッションの会話履歴をコンテキスト長の範囲で含める。
     """
-    print(f"タスク解析開始 - モデル: {model_id}, タスク: {task_description[:50]}...")
-    prompt = f"""
+    logger.info("タスク解析開始 - モデル: %s, タスク: %.50s...", model_id, task_description)
+    instruction = f"""
 ユーザーの次のタスクを解析し、実行ステップに分解してください：
 
 {task_description}
@@ -333,76 +941,125 @@ async def analyze_task(model_id, task_description):
     ]
 }}
 """
+    # コンテキスト長から出力・システムプロンプト・引き継ぐ過去のやり取りの分を除いた範囲で、
+    # 会話履歴を含める（過去のやり取りを引き継ぐ場合はそれが履歴の代わりになる）
+    context_length = await get_model_context_length(model_id)
+    conversation_tokens = session_conversation_tokens(session_id, model_id)
+    builder = PromptBuilder(
+        context_length,
+        reserved_tokens=PLAN_MAX_TOKENS + estimate_tokens(SYSTEM_PROMPT) + conversation_tokens
+    )
+    if not conversation_tokens:
+        history_budget = builder.budget - estimate_tokens(instruction)
+        builder.add(build_history_section(session_id, model_id, history_budget), priority=1)
+    builder.add(instruction, required=True)
+    prompt = builder.build()
+    
+    output_format = plan_output_format()
     
-    response = await get_ollama_response(model_id, prompt)
-    if not response.startswith("エラー: ") and not response.startswith("例外発生: "):
-        # レスポンスからJSONを抽出
+    # 最初の生成はストリーミングで受け取り、ステップを逐次通知する
+    parser = IncrementalJSONParser()
+    try:
+        async for chunk in stream_ollama_response(
+            model_id, prompt, max_tokens=PLAN_MAX_TOKENS, format=output_format,
+            num_ctx=context_length, session_id=session_id
+        ):
+            for event in parser.feed(chunk):
+                if event[0] == "member" and event[1] == "thought" and on_thought:
+                    await on_thought(event[2])
+                elif event[0] == "item" and event[1] == "steps" and on_step:
+                    # 途中のステップも検証してから通知する
+                    try:
+                        step = PlanStep.model_validate(event[3])
+                    except ValidationError:
+                        continue
+                    await on_step(event[2], step.model_dump(mode="json"))
+    except OllamaError as e:
+        logger.warning("タスク解析リクエストエラー: %s", e)
+        return {
+            "success": False,
+            "error": f"エラー: {str(e)}",
+            "error_kind": e.kind
+        }
+    
+    content = parser.text
+    logger.debug("タスク解析レスポンス: %.100s...", content)
+    plan, error = validate_plan(content)
+    
+    # 不正な出力は、エラー内容を添えて修正を依頼する
+    attempt = 0
+    while plan is None and attempt < PLAN_REPAIR_RETRIES:
+        attempt += 1
+        logger.info("実行計画の検証に失敗しました（修正 %d/%d）: %.200s", attempt, PLAN_REPAIR_RETRIES, error)
+        repair_prompt = f"""
+次のJSONは実行計画として不正です。エラー内容に従って修正し、正しいJSONのみを返してください。
+
+タスク:
+{task_description}
+
+不正なJSON:
+{content[:4000]}
+
+エラー内容:
+{error[:1000]}
+"""
         try:
-            content = response
-            print(f"タスク解析レスポンス: {content[:100]}...")
-            
-            # JSONブロックを抽出する - 改善版
-            import re
-            
-            # 1. JSONブロック（```json 〜 ```）を探す
-            json_match = re.search(r'```(?:json)?\s*(.*?)\s*```', content, re.DOTALL)
-            if json_match:
-                print("JSONブロックを検出しました")
-                json_str = json_match.group(1)
-            else:
-                # 2. 単純に最初の { から最後の } までを取得
-                first_brace = content.find('{')
-                last_brace = content.rfind('}')
-                
-                if first_brace >= 0 and last_brace > first_brace:
-                    print("JSONブロックは見つかりませんが、{}で囲まれた部分を抽出します")
-                    json_str = content[first_brace:last_brace+1]
-                else:
-                    print("JSON形式のデータが見つかりません、テキスト全体を解析します")
-                    json_str = content
-            
-            print(f"JSONパース前: {json_str[:100]}...")
-            
-            # 文字列をJSON形式に整形してからパース
-            try:
-                plan = json.loads(json_str)
-                print("JSONパース成功")
-                
-                # 必須フィールドの存在確認
-                if "thought" not in plan or "steps" not in plan:
-                    print("JSONの形式が不正: 'thought'または'steps'フィールドがありません")
-                    return {
-                        "success": False,
-                        "error": "JSONの形式が不正: 必須フィールドがありません",
-                        "raw_response": content
-                    }
-                
-                return {
-                    "success": True,
-                    "plan": plan
-                }
-            except json.JSONDecodeError as e:
-                # JSON解析エラー - 単純なエラーメッセージを返す
-                error_msg = f"JSONの解析に失敗しました: {str(e)}"
-                print(f"{error_msg}")
-                return {
-                    "success": False,
-                    "error": error_msg,
-                    "raw_response": content
-                }
-        except Exception as e:
-            error_msg = f"タスク解析処理中にエラーが発生しました: {str(e)}"
-            print(f"{error_msg} - レスポンス: {content[:200]}")
+            content = await get_ollama_response(
+                model_id, repair_prompt, max_tokens=PLAN_MAX_TOKENS, format=output_format, num_ctx=context_length
+            )
+        except OllamaError as e:
             return {
                 "success": False,
-                "error": error_msg,
-                "raw_response": content
+                "error": f"エラー: {str(e)}",
+                "error_kind": e.kind
             }
-    else:
+        plan, error = validate_plan(content)
+    
+    if plan is None:
+        logger.warning("実行計画の検証に失敗しました: %.200s", error)
         return {
             "success": False,
-            "error": response
+            "error": f"実行計画の形式が不正です: {error}",
+            "error_kind": OllamaOutputError.kind,
+            "raw_response": content
         }
+    
+    logger.info("タスク解析成功 - ステップ数: %d", len(plan.steps))
+    return {
+        "success": True,
+        "plan": plan.model_dump(mode="json"),
+        "repaired": attempt > 0
+    }
+
+def parse_bool(value, default):
+    """
+    LLMが指定した真偽値を解釈する（"false" や "0" などの文字列も偽として扱う）
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "yes", "on", "1"):
+            return True
+        if lowered in ("false", "no", "off", "0", ""):
+            return False
+    return default
+
+def parse_web_max_tokens(value):
+    """
+    LLMが指定したweb_fetchのmax_tokensを整数にし、WEB_EXTRACT_MAX_TOKENS以下に収める（不正なら既定値）
+    """
+    if isinstance(value, bool):
+        return WEB_EXTRACT_MAX_TOKENS
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return WEB_EXTRACT_MAX_TOKENS
+    if value <= 0:
+        return WEB_EXTRACT_MAX_TOKENS
+    return min(value, WEB_EXTRACT_MAX_TOKENS)
 
 # ステップを実行する
 async def execute_step(step, session_id):
@@ -412,83 +1069,271 @@ async def execute_step(step, session_id):
     action_type = step.get("action", "").lower()
     params = step.get("params", {})
     
-    # 作業用ディレクトリを作成・使用
-    work_dir = f"workspaces/{session_id}"
-    os.makedirs(work_dir, exist_ok=True)
-    
     result = {
         "success": False,
         "output": "",
         "error": ""
     }
+    started = time.monotonic()
+    trace_started = time.time_ns()
     
     try:
-        if action_type == "shell_command":
-            command = params.get("command", "")
-            result = await AgentTools.execute_shell_command(command, cwd=work_dir)
-            
-        elif action_type == "read_file":
-            file_path = params.get("path", "")
-            # 相対パスの場合は作業ディレクトリからの相対パスとして解釈
-            if not os.path.isabs(file_path):
-                file_path = os.path.join(work_dir, file_path)
-            result = await AgentTools.read_file(file_path)
-            
-        elif action_type == "write_file":
-            file_path = params.get("path", "")
-            content = params.get("content", "")
-            # 相対パスの場合は作業ディレクトリからの相対パスとして解釈
-            if not os.path.isabs(file_path):
-                file_path = os.path.join(work_dir, file_path)
-            result = await AgentTools.write_file(file_path, content)
+        # 作業用ディレクトリを使用中として確保（実行中は回収されない）
+        async with workspaces.use(session_id) as workspace:
+            work_dir = workspace.path
+            # すでにクォータを超えている場合はステップを実行しない
+            workspaces.check_quota(session_id)
             
-        elif action_type == "web_fetch":
-            url = params.get("url", "")
-            result = await AgentTools.fetch_web_content(url)
-            
-        else:
-            result = {
-                "success": False,
-                "error": f"不明なアクションタイプ: {action_type}"
-            }
+            if action_type == "shell_command":
+                command = params.get("command", "")
+                bytes_before = workspace.bytes_used
+                result = await AgentTools.execute_shell_command(
+                    command,
+                    cwd=work_dir,
+                    session_id=session_id if parse_bool(params.get("persistent"), PERSISTENT_SHELL_ENABLED) else None,
+                    # LLMが指定したタイムアウトは数値にして SHELL_COMMAND_TIMEOUT 以下に収める
+                    timeout=parse_timeout(params.get("timeout"), SHELL_COMMAND_TIMEOUT)
+                )
+                # コマンドによる変更内容は分からないため使用量を再計算し、増えた分を書き込み量として数える
+                rescanned = await workspaces.rescan(session_id)
+                usage_tracker.add(workspace_bytes_written=max(0, rescanned.bytes_used - bytes_before))
+                workspaces.check_quota(session_id)
+                
+            elif action_type == "read_file":
+                file_path = params.get("path", "")
+                # 相対パスの場合は作業ディレクトリからの相対パスとして解釈
+                if not os.path.isabs(file_path):
+                    file_path = os.path.join(work_dir, file_path)
+                result = await AgentTools.read_file(file_path)
+                
+            elif action_type == "write_file":
+                file_path = params.get("path", "")
+                content = params.get("content", "")
+                # 相対パスの場合は作業ディレクトリからの相対パスとして解釈
+                if not os.path.isabs(file_path):
+                    file_path = os.path.join(work_dir, file_path)
+                
+                # シンボリックリンクを解決したうえで、ワークスペースの外への書き込みは拒否する
+                # （外に書き込むとクォータで使用量を数えられない）
+                file_path = os.path.realpath(file_path)
+                if not file_path.startswith(os.path.realpath(work_dir) + os.sep):
+                    result = {
+                        "success": False,
+                        "error": f"ワークスペースの外には書き込めません: {params.get('path', '')}"
+                    }
+                else:
+                    # クォータを確認してから書き込む
+                    old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+                    new_size = len(content.encode("utf-8"))
+                    workspaces.check_quota(session_id, new_size - old_size)
+                    
+                    existed = os.path.exists(file_path)
+                    result = await AgentTools.write_file(file_path, content)
+                    if result.get("success"):
+                        workspaces.record_write(session_id, old_size, new_size, new_file=not existed)
+                        usage_tracker.add(workspace_bytes_written=new_size)
+                
+            elif action_type == "web_fetch":
+                url = params.get("url", "")
+                max_tokens = parse_web_max_tokens(params.get("max_tokens"))
+                bytes_before = workspace.bytes_used
+                result = await AgentTools.fetch_web_content(
+                    url,
+                    cache_dir=os.path.join(work_dir, ".web_cache"),
+                    max_tokens=max_tokens
+                )
+                if result.get("success") and not result.get("cached"):
+                    # 取得内容はワークスペースのキャッシュにも書き込まれる
+                    rescanned = await workspaces.rescan(session_id)
+                    usage_tracker.add(
+                        web_fetch_bytes=result.get("content_bytes", 0),
+                        workspace_bytes_written=max(0, rescanned.bytes_used - bytes_before)
+                    )
+                
+            else:
+                result = {
+                    "success": False,
+                    "error": f"不明なアクションタイプ: {action_type}"
+                }
+    except WorkspaceQuotaExceeded as e:
+        logger.warning("ワークスペースのクォータ超過 - セッションID: %s: %s", session_id, e)
+        result = {
+            **result,
+            "success": False,
+            "error": str(e),
+            "quota_exceeded": True
+        }
     except Exception as e:
         result = {
             "success": False,
             "error": f"ステップ実行中にエラーが発生しました: {str(e)}"
         }
     
+    elapsed = time.monotonic() - started
+    step_seconds.observe(elapsed, action=action_type or "unknown")
+    process_usage = result.get("usage") or {}
+    usage_tracker.add(
+        tool_calls=1,
+        tool_seconds=elapsed,
+        subprocess_cpu_seconds=process_usage.get("user_cpu_time", 0) + process_usage.get("system_cpu_time", 0)
+    )
+    tracer.record(f"tool.{action_type or 'unknown'}", trace_started, success=bool(result.get("success")))
     return result
 
+class SpeculativeStep:
+    """
+    計画の生成中に先行実行するステップ
+
+    最終的な計画で同じ内容のステップが確定した場合はその結果を使い、
+    異なる場合は結果を破棄して、write_fileによる変更を元に戻す。
+    """
+    def __init__(self, session_id, step_data):
+        self.session_id = session_id
+        self.step_data = step_data
+        self.task = None
+        # write_fileの書き込み先と、書き込み前の内容（存在しなかった場合はNone）
+        self.backup_path = None
+        self.backup_content = None
+    
+    @staticmethod
+    def can_speculate(session_id, step_data):
+        action_type = (step_data.get("action") or "").lower()
+        if action_type not in SPECULATIVE_ACTIONS:
+            return False
+        # ワークスペース外への書き込みは元に戻せる保証がないため先行実行しない
+        # （"../" やシンボリックリンクで外を指す相対パスも、解決したパスで判定する）
+        if action_type == "write_file":
+            path = step_data.get("params", {}).get("path", "")
+            if not isinstance(path, str) or not path:
+                return False
+            try:
+                work_dir = os.path.realpath(workspaces.path_for(session_id))
+            except ValueError:
+                return False
+            if not os.path.realpath(os.path.join(work_dir, path)).startswith(work_dir + os.sep):
+                return False
+        return True
+    
+    def start(self):
+        if (self.step_data.get("action") or "").lower() == "write_file":
+            path = os.path.join(workspaces.path_for(self.session_id), self.step_data.get("params", {}).get("path", ""))
+            self.backup_path = path
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    self.backup_content = f.read()
+        self.task = asyncio.create_task(execute_step(self.step_data, self.session_id))
+    
+    def matches(self, step_data):
+        return step_data == self.step_data
+    
+    async def result(self):
+        return await self.task
+    
+    async def discard(self):
+        """
+        先行実行の結果を破棄し、ファイルの変更を元に戻す
+        """
+        try:
+            await self.task
+        except Exception as e:
+            logger.warning("先行実行したステップでエラーが発生しました: %s", e)
+        if self.backup_path is None:
+            return
+        try:
+            if self.backup_content is None:
+                if os.path.exists(self.backup_path):
+                    os.remove(self.backup_path)
+            else:
+                with open(self.backup_path, 'wb') as f:
+                    f.write(self.backup_content)
+            await workspaces.rescan(self.session_id)
+        except OSError as e:
+            logger.warning("先行実行したステップの取り消しに失敗しました: %s", e)
+
+# シェルコマンドのリソース制限
+sandbox_limits = ResourceLimits.from_env() if SANDBOX_ENABLED else None
+# 1つのコマンドでディスクを埋められないよう、ファイルサイズの上限は未指定ならクォータに揃える
+if sandbox_limits is not None and sandbox_limits.file_size_mb <= 0 and WORKSPACE_QUOTA_MB > 0:
+    sandbox_limits.file_size_mb = WORKSPACE_QUOTA_MB
+sandbox_cgroups = CgroupManager() if SANDBOX_ENABLED else None
+
+# セッションごとの常駐シェル
+shell_sessions = ShellSessionManager(
+    idle_timeout=PERSISTENT_SHELL_IDLE_TIMEOUT,
+    limits=sandbox_limits,
+    cgroups=sandbox_cgroups
+)
+
+# セッションごとのワークスペース（回収時は常駐シェルも終了する）
+workspaces = WorkspaceManager(
+    root=WORKSPACE_ROOT,
+    quota_bytes=WORKSPACE_QUOTA_MB * 1024 * 1024,
+    ttl=WORKSPACE_TTL,
+    sweep_interval=WORKSPACE_SWEEP_INTERVAL,
+    on_reclaim=shell_sessions.close
+)
+
 # エージェント実行ユーティリティ
 class AgentTools:
     @staticmethod
-    async def execute_shell_command(command, cwd=None):
+    @interactions.tool("shell_command")
+    async def execute_shell_command(command, cwd=None, session_id=None, timeout=None):
         """
         シェルコマンドを安全に実行する
+
+        session_idを指定するとセッションの常駐シェルで実行し、
+        cdや環境変数の変更を次のコマンドに引き継ぐ。
         """
+        if session_id is not None and PERSISTENT_SHELL_ENABLED:
+            # 常駐シェルが使えない場合だけ通常の実行に切り替える
+            # （コマンドを送った後の失敗で切り替えると、同じコマンドを2回実行してしまう）
+            try:
+                return await shell_sessions.run(session_id, command, cwd=cwd or ".", timeout=timeout)
+            except ShellSessionError as e:
+                logger.warning("常駐シェルでの実行に失敗したため、通常の実行に切り替えます: %s", e)
+            except Exception as e:
+                logger.exception("常駐シェルでのコマンド実行中にエラーが発生しました: %s", e)
+                return {
+                    "success": False,
+                    "error": f"常駐シェルでのコマンド実行中にエラーが発生しました: {str(e)}"
+                }
+        
         try:
-            # Windowsの場合はPowerShellを使用
-            if sys.platform == 'win32':
-                # PowerShellでコマンドを実行するようにする
-                full_command = ["powershell", "-Command", command]
-                process = subprocess.Popen(
-                    full_command,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    cwd=cwd,
-                    text=True
-                )
-            else:
-                # Linuxの場合はbashを使用
-                process = subprocess.Popen(
+            if sys.platform != 'win32':
+                # 独立したプロセスグループでリソース制限をかけて実行し、
+                # イベントループを止めないよう別スレッドで終了を待つ
+                return await asyncio.to_thread(
+                    run_limited,
                     ["bash", "-c", command],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
                     cwd=cwd,
-                    text=True
+                    timeout=timeout,
+                    limits=sandbox_limits,
+                    cgroups=sandbox_cgroups
                 )
             
-            stdout, stderr = process.communicate()
+            # Windowsの場合はPowerShellを使用（rlimitが使えないためタイムアウトのみ適用）
+            full_command = ["powershell", "-Command", command]
+            process = subprocess.Popen(
+                full_command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+                text=True
+            )
+            
+            try:
+                stdout, stderr = await asyncio.to_thread(process.communicate, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                stdout, stderr = process.communicate()
+                return {
+                    "success": False,
+                    "error": f"タイムアウト: {timeout}秒",
+                    "stdout": stdout,
+                    "stderr": stderr,
+                    "returncode": process.returncode,
+                    "timed_out": True
+                }
             return {
                 "success": process.returncode == 0,
                 "stdout": stdout,
@@ -505,6 +1350,7 @@ class AgentTools:
             }
     
     @staticmethod
+    @interactions.tool("read_file")
     async def read_file(file_path):
         """
         ファイルを読み込む
@@ -523,6 +1369,7 @@ class AgentTools:
             }
     
     @staticmethod
+    @interactions.tool("write_file")
     async def write_file(file_path, content):
         """
         ファイルに書き込む
@@ -546,38 +1393,211 @@ class AgentTools:
             }
     
     @staticmethod
-    async def fetch_web_content(url):
+    @interactions.tool("web_fetch", omit_result_keys=("content",))
+    async def fetch_web_content(url, cache_dir=None, max_tokens=WEB_EXTRACT_MAX_TOKENS):
         """
-        Webコンテンツを取得する
+        Webコンテンツを取得し、LLM向けのテキストを抽出する
+
+        受信しながらHTMLを逐次パースし、スクリプトやナビゲーションを除いた
+        テキストを "text" に格納する。cache_dirを指定すると生のレスポンスと
+        抽出結果を並べて保存し、有効期間内の再取得ではパースを省略する。
         """
+        cache_key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        raw_path = os.path.join(cache_dir, f"{cache_key}.raw") if cache_dir else None
+        text_path = os.path.join(cache_dir, f"{cache_key}.json") if cache_dir else None
+        
+        # キャッシュの確認
+        if raw_path and os.path.exists(raw_path) and os.path.exists(text_path):
+            if time.time() - os.path.getmtime(raw_path) < WEB_CACHE_TTL:
+                try:
+                    with open(text_path, 'r', encoding='utf-8') as f:
+                        cached = json.load(f)
+                    if cached.get("max_tokens") == max_tokens:
+                        with open(raw_path, 'r', encoding='utf-8') as f:
+                            cached["content"] = f.read()
+                        cached["content_bytes"] = len(cached["content"].encode("utf-8"))
+                        cached["cached"] = True
+                        return cached
+                except (OSError, ValueError) as e:
+                    logger.warning("web_fetchキャッシュ読み込みエラー: %s", e)
+        
         try:
             async with aiohttp.ClientSession() as session:
                 async with session.get(url) as response:
-                    if response.status == 200:
-                        text = await response.text()
-                        return {
-                            "success": True,
-                            "content": text,
-                            "status": response.status
-                        }
-                    else:
+                    if response.status != 200:
                         return {
                             "success": False,
                             "status": response.status,
                             "error": f"HTTPエラー: {response.status}"
                         }
+                    
+                    content_type = response.headers.get("Content-Type", "")
+                    is_html = "html" in content_type.lower() or not content_type
+                    decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+                    extractor = HTMLTextExtractor(base_url=str(response.url), max_tokens=max_tokens)
+                    raw_chunks = []
+                    
+                    # チャンクごとにデコードしてパーサーへ流し込む
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        text_chunk = decoder.decode(chunk)
+                        raw_chunks.append(text_chunk)
+                        if is_html and not extractor.done:
+                            extractor.feed(text_chunk)
+                    tail = decoder.decode(b"", final=True)
+                    raw_chunks.append(tail)
+                    raw = "".join(raw_chunks)
+                    
+                    if is_html:
+                        extractor.feed(tail)
+                        extractor.close()
+                        title = extractor.title.strip()
+                        text = extractor.get_text()
+                        links = extractor.links
+                        truncated = extractor.truncated
+                    else:
+                        # HTML以外（JSONやプレーンテキスト）はそのまま上限まで切り詰める
+                        title = ""
+                        text = truncate_to_tokens(raw, max_tokens)
+                        links = []
+                        truncated = len(text) < len(raw)
+                    
+                    result = {
+                        "success": True,
+                        "status": response.status,
+                        "url": str(response.url),
+                        "title": title,
+                        "text": text,
+                        "links": links,
+                        "truncated": truncated,
+                        "max_tokens": max_tokens
+                    }
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e)
             }
+        
+        # 生のレスポンスと抽出結果を並べてキャッシュする
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(raw_path, 'w', encoding='utf-8') as f:
+                    f.write(raw)
+                with open(text_path, 'w', encoding='utf-8') as f:
+                    json.dump(result, f, ensure_ascii=False)
+            except OSError as e:
+                logger.warning("web_fetchキャッシュ書き込みエラー: %s", e)
+        
+        result["content"] = raw
+        # 取得した量は記録・再生でも分かるよう、生のレスポンスとは別に持つ
+        result["content_bytes"] = len(raw.encode("utf-8"))
+        result["cached"] = False
+        return result
+
+class ReplanBudget:
+    """
+    1つのタスクで再計画に使える回数とトークン数の残り
+    """
+    
+    # 再計画のプロンプトの指示・タスク・失敗の内容に最低限必要なトークン数
+    MIN_PROMPT_TOKENS = 500
+    
+    def __init__(self, retries=TASK_REPLAN_RETRIES, tokens=TASK_REPLAN_TOKEN_BUDGET):
+        self.retries = retries
+        self.tokens = tokens
+    
+    def available(self):
+        # 最低限のプロンプトと再計画の出力の分が残っていなければ試みない
+        required = self.MIN_PROMPT_TOKENS + PLAN_MAX_TOKENS + estimate_tokens(SYSTEM_PROMPT)
+        return self.retries > 0 and self.tokens >= required
+    
+    def consume(self, tokens):
+        self.retries -= 1
+        self.tokens -= tokens
+
+async def replan_remaining_steps(model_id, task_description, steps_results, failed_step, failed_result, remaining_steps, budget):
+    """
+    失敗したステップ以降の代わりとなるステップを生成する（生成できなければNone）
+
+    完了したステップの結果と失敗の内容を渡し、失敗したステップと
+    まだ実行していないステップを置き換える新しいステップを求める。
+    """
+    context_length = await get_model_context_length(model_id)
+    builder = PromptBuilder(
+        min(context_length, budget.tokens),
+        reserved_tokens=PLAN_MAX_TOKENS + estimate_tokens(SYSTEM_PROMPT)
+    )
+    head = f"""
+次のタスクを実行中に、あるステップが失敗しました。失敗したステップとそれ以降の未実行のステップを
+置き換える新しいステップを、最大5つまで考えてください。完了済みのステップは繰り返さないでください。
+
+タスク:
+{task_description}
+"""
+    failed = f"""
+失敗したステップ: {failed_step.get('title', '不明なステップ')}（{failed_step.get('action', '')}）
+パラメータ: {json.dumps(failed_step.get('params', {}), ensure_ascii=False)}
+エラー: {failed_result.get('error', '不明なエラー')}
+"""
+    failed_output = step_output_text(failed_result) or failed_result.get("stderr", "").strip()
+    remaining = "\n".join(
+        f"- {step.get('title', '')}: {step.get('description', '')}" for step in remaining_steps
+    ) or "（なし）"
+    tail = f"""
+未実行のステップ:
+{remaining}
+
+以下のJSON形式で返してください。他の説明は不要です：
+{{"thought": "失敗の原因と対処方針", "steps": [{{"title": "...", "description": "...", "action": "shell_command, read_file, write_file, web_fetch のいずれか", "params": {{}}}}]}}
+"""
+    # 完了済みのステップの出力と失敗時の出力に残りの予算を配分する
+    completed_headers = [
+        f"- {step.get('title', '不明なステップ')}: {'成功' if result.get('success', False) else '失敗'}\n"
+        for step, result in steps_results
+    ]
+    outputs = [step_output_text(result) for _, result in steps_results] + [failed_output]
+    fixed_tokens = sum(estimate_tokens(text) for text in [head, failed, tail] + completed_headers)
+    if fixed_tokens > builder.budget:
+        # 指示と失敗の内容すら入らない場合は、切り詰めたプロンプトで試みても役に立たない
+        logger.warning("再計画のプロンプトが予算に収まりません: %d / %d トークン", fixed_tokens, builder.budget)
+        return None
+    outputs = allocate_evenly(outputs, max(0, builder.budget - fixed_tokens))
+    completed = "".join(
+        header + (f"  出力: {output}\n" if output else "")
+        for header, output in zip(completed_headers, outputs)
+    )
+    builder.add(
+        head + "\n完了済みのステップ:\n" + (completed or "（なし）\n") + failed
+        + (f"失敗時の出力: {outputs[-1]}\n" if outputs[-1] else "") + tail,
+        required=True
+    )
+    prompt = builder.build()
+    
+    try:
+        response = await get_ollama_response(
+            model_id, prompt, max_tokens=PLAN_MAX_TOKENS, format=plan_output_format(), num_ctx=context_length
+        )
+    except OllamaError as e:
+        logger.warning("再計画リクエストエラー: %s", e)
+        budget.consume(estimate_tokens(prompt))
+        return None
+    budget.consume(estimate_tokens(prompt) + estimate_tokens(response))
+    
+    plan, error = validate_plan(response)
+    if plan is None or not plan.steps:
+        logger.warning("再計画の結果が不正です: %.200s", error or 'ステップがありません')
+        return None
+    return [step.model_dump(mode="json") for step in plan.steps]
 
 # ステップ実行の結果を分析し次のアクションを決定する
-async def analyze_step_result(model_id, step, result):
+async def analyze_step_result(model_id, step, result, task_description=None, steps_results=None, remaining_steps=None, budget=None):
     """
     ステップ実行結果を分析し、次のアクションを決定する
+
+    budgetを指定すると、失敗した場合にその範囲で残りのステップを再計画し、
+    置き換えるステップを "replan" に入れて返す。
     """
-    print(f"ステップ実行結果の分析 - ステップ: {step.get('title', '不明なステップ')}")
+    logger.debug("ステップ実行結果の分析 - ステップ: %s", step.get('title', '不明なステップ'))
     
     # 成功した場合は単に成功を報告
     if result.get("success", False):
@@ -587,8 +1607,21 @@ async def analyze_step_result(model_id, step, result):
             "message": f"ステップ「{step.get('title', '不明なステップ')}」は正常に完了しました。"
         }
     
-    # 失敗した場合は、エラーの詳細を含めて報告
+    # 失敗した場合は、予算が残っていれば失敗したステップ以降を立て直す
     error_msg = result.get("error", "不明なエラー")
+    if budget is not None and budget.available():
+        new_steps = await replan_remaining_steps(
+            model_id, task_description or "", steps_results or [], step, result, remaining_steps or [], budget
+        )
+        if new_steps:
+            return {
+                "success": False,
+                "continue": True,
+                "replan": new_steps,
+                "message": f"ステップ「{step.get('title', '不明なステップ')}」が失敗したため、残りのステップを再計画しました: {error_msg}"
+            }
+    
+    # 立て直せない場合は、エラーの詳細を含めて報告
     return {
         "success": False,
         "continue": False,  # エラーが発生したため処理を停止
@@ -596,43 +1629,310 @@ async def analyze_step_result(model_id, step, result):
     }
 
 # タスク完了後の要約を生成
-async def generate_task_summary(model_id, task_description, steps_results):
+async def generate_task_summary(model_id, task_description, steps_results, session_id=None):
     """
     タスク完了後の要約を生成する
+
+    各ステップの出力はコンテキスト長の残りを公平に分け合う長さまで含める。
     """
-    print(f"タスク要約生成開始 - モデル: {model_id}")
-    
-    # 各ステップの実行結果を整形
-    steps_summary = ""
-    for i, (step, result) in enumerate(steps_results):
-        status = "成功" if result.get("success", False) else "失敗"
-        steps_summary += f"ステップ {i+1}: {step.get('title', '不明なステップ')} - {status}\n"
-        if "stdout" in result:
-            output = result.get("stdout", "").strip()
-            if output:
-                steps_summary += f"出力: {output[:500]}{'...' if len(output) > 500 else ''}\n"
-        if "error" in result and result["error"]:
-            steps_summary += f"エラー: {result.get('error', '')}\n"
-        steps_summary += "\n"
+    logger.info("タスク要約生成開始 - モデル: %s", model_id)
     
-    prompt = f"""
+    context_length = await get_model_context_length(model_id)
+    conversation_tokens = session_conversation_tokens(session_id, model_id)
+    builder = PromptBuilder(
+        context_length,
+        reserved_tokens=SUMMARY_MAX_TOKENS + estimate_tokens(SYSTEM_PROMPT) + conversation_tokens
+    )
+    head = f"""
 以下のタスクとその実行結果を要約してください：
 
 タスク: {task_description}
 
 実行結果:
-{steps_summary}
-
+"""
+    tail = """
 要約とユーザーへのフィードバックを簡潔に記述してください。
 """
     
-    response = await get_ollama_response(model_id, prompt)
-    if not response.startswith("エラー: ") and not response.startswith("例外発生: "):
-        return response
-    else:
+    # 各ステップの実行結果を整形
+    step_headers = []
+    step_outputs = []
+    for i, (step, result) in enumerate(steps_results):
+        status = "成功" if result.get("success", False) else "失敗"
+        header = f"ステップ {i+1}: {step.get('title', '不明なステップ')} - {status}\n"
+        if "error" in result and result["error"]:
+            header += f"エラー: {result.get('error', '')}\n"
+        output = ""
+        if "stdout" in result:
+            output = result.get("stdout", "").strip()
+            label = "出力"
+        elif "text" in result:
+            # web_fetchの結果は生のHTMLではなく抽出済みテキストを使う
+            output = result.get("text", "").strip()
+            label = "取得内容"
+        step_headers.append(header)
+        step_outputs.append(f"{label}: {output}\n" if output else "")
+    
+    # 固定部分を除いた予算のうち、会話履歴には最大1/4を使い、残りをステップの出力に配分する
+    fixed_tokens = estimate_tokens(head) + estimate_tokens(tail) + sum(estimate_tokens(h) + 1 for h in step_headers)
+    available = max(0, builder.budget - fixed_tokens)
+    history = "" if conversation_tokens else build_history_section(session_id, model_id, available // 4)
+    outputs = allocate_evenly(step_outputs, available - estimate_tokens(history))
+    steps_summary = "".join(
+        header + output + "\n" for header, output in zip(step_headers, outputs)
+    )
+    
+    builder.add(history, priority=1)
+    builder.add(head + steps_summary + tail, required=True)
+    prompt = builder.build()
+    
+    try:
+        return await get_ollama_response(
+            model_id, prompt, max_tokens=SUMMARY_MAX_TOKENS, num_ctx=context_length,
+            session_id=session_id, priority=Priority.background
+        )
+    except OllamaError:
         return "タスク実行は完了しましたが、要約の生成中にエラーが発生しました。詳細はログを確認してください。"
 
+def step_output_text(result):
+    """
+    ステップの実行結果から要約に使う出力テキストを取り出す
+    """
+    if "stdout" in result:
+        return result.get("stdout", "").strip()
+    if "text" in result:
+        return result.get("text", "").strip()
+    return ""
+
+def is_trivial_task(steps_results):
+    """
+    LLMで要約するまでもない単純なタスクかどうか（少数のステップがすべて成功し、出力が短い）
+    """
+    if not steps_results or len(steps_results) > SUMMARY_TRIVIAL_MAX_STEPS:
+        return False
+    if not all(result.get("success", False) for _, result in steps_results):
+        return False
+    # 取得したWebページの内容は要約しないと伝わらない
+    if any(step.get("action", "").lower() == "web_fetch" for step, _ in steps_results):
+        return False
+    output_tokens = sum(estimate_tokens(step_output_text(result)) for _, result in steps_results)
+    return output_tokens <= SUMMARY_TRIVIAL_MAX_OUTPUT_TOKENS
+
+def build_template_summary(steps_results):
+    """
+    実行結果から定型文の要約を作成する（LLMを使わない）
+    """
+    succeeded = sum(1 for _, result in steps_results if result.get("success", False))
+    lines = [f"{len(steps_results)}個のステップのうち{succeeded}個が正常に完了しました。"]
+    for i, (step, result) in enumerate(steps_results):
+        status = "成功" if result.get("success", False) else "失敗"
+        lines.append(f"{i+1}. {step.get('title', '不明なステップ')}（{status}）")
+        output = step_output_text(result)
+        if output:
+            lines.append(f"   出力: {truncate_to_tokens(output, 100)}")
+    return "\n".join(lines)
+
+async def summarize_task(task):
+    """
+    完了したタスクのLLMによる要約を生成し、タスクに記録して配信する（生成済みならそれを返す）
+    """
+    if task.summary is not None:
+        return task.summary
+    job = task_summary_jobs.get(task.id)
+    if job is None:
+        job = asyncio.create_task(_summarize_task(task))
+        task_summary_jobs[task.id] = job
+    return await asyncio.shield(job)
+
+def store_task_results(task_id, model_id, steps_results):
+    """
+    要約の生成用に実行結果を保持する（web_fetchの本文なども含むため件数と保持時間を制限する）
+    """
+    task_results_db[task_id] = {
+        "model_id": model_id,
+        "steps_results": steps_results,
+        "stored_at": time.monotonic()
+    }
+    task_results_db.move_to_end(task_id)
+    expire_task_results()
+
+def expire_task_results():
+    now = time.monotonic()
+    while task_results_db:
+        task_id, record = next(iter(task_results_db.items()))
+        expired = TASK_RESULTS_TTL > 0 and now - record["stored_at"] > TASK_RESULTS_TTL
+        if not expired and len(task_results_db) <= TASK_RESULTS_MAX_ENTRIES:
+            break
+        del task_results_db[task_id]
+
+def get_task_results(task_id):
+    """
+    保持している実行結果を返す（期限切れならNone）
+    """
+    expire_task_results()
+    return task_results_db.get(task_id)
+
+async def _summarize_task(task):
+    try:
+        bind(session_id=task.session_id, task_id=task.id)
+        record = get_task_results(task.id)
+        if record is None:
+            return None
+        # 元のタスクの制限時間とは別に、要約の生成だけの制限時間を設ける
+        current_deadline.set(Deadline(AGENT_JOB_TIMEOUT))
+        with tracer.span("summary", steps=len(record["steps_results"])):
+            summary = await generate_task_summary(
+                record["model_id"], task.description, record["steps_results"], session_id=task.session_id
+            )
+        task.summary = summary
+        task.updated_at = datetime.now()
+        # 要約を作成したら実行結果は不要
+        task_results_db.pop(task.id, None)
+        if task.session_id not in sessions_db:
+            return summary
+        
+        summary_message = MessageRecord(
+            id=str(uuid.uuid4()),
+            role="assistant",
+            content=f"タスク「{task.title}」の要約:\n\n{summary}",
+            timestamp=datetime.now(),
+            files=None
+        )
+        messages_db[task.session_id].append(summary_message)
+        await manager.broadcast(
+            task.session_id,
+            {"type": "message", "data": summary_message.to_json()}
+        )
+        await manager.broadcast(
+            task.session_id,
+            {"type": "task", "data": task.to_json()}
+        )
+        return summary
+    finally:
+        task_summary_jobs.pop(task.id, None)
+
 # WebSocket接続を管理するクラス
+# イベントログに保存する配信イベント（エージェントの状態は復元時にすべて待機中に戻すため保存しない）
+PERSISTED_EVENT_TYPES = {"message", "agent_action", "task", "task_step", "task_steps", "session_updated"}
+
+def persist_session_event(session_id, event_type, data):
+    """
+    セッションの状態の変更をイベントログに積む（data は配信用に作ったもので、以降変更しないこと）
+    """
+    if session_log is not None and session_id in sessions_db and is_valid_session_id(session_id):
+        session_log.append(session_id, event_type, data)
+
+def session_state(session_id):
+    """
+    セッションの状態全体をJSONにできる形で返す（スナップショット用）
+    """
+    if session_id not in sessions_db:
+        return None
+    tasks = tasks_db.get(session_id, [])
+    return {
+        "session": json.loads(sessions_db[session_id].json()),
+        "messages": [message.to_json() for message in messages_db.get(session_id, [])],
+        "tasks": [task.to_json() for task in tasks],
+        "task_steps": [step.to_json() for task in tasks for step in task_steps_db.get(task.id, [])],
+        "agent_actions": [action.to_json() for action in agent_actions_db.get(session_id, [])]
+    }
+
+def load_session_state(session_id, state):
+    sessions_db[session_id] = ChatSession(**state["session"])
+    messages_db[session_id] = [MessageRecord.from_json(message) for message in state["messages"]]
+    tasks_db[session_id] = [TaskRecord.from_json(task) for task in state["tasks"]]
+    for task in tasks_db[session_id]:
+        task_steps_db[task.id] = []
+    for step in state["task_steps"]:
+        task_steps_db.setdefault(step["task_id"], []).append(TaskStepRecord.from_json(step))
+    agent_actions_db[session_id] = [AgentActionRecord.from_json(action) for action in state["agent_actions"]]
+    agent_state_db[session_id] = AgentState.idle
+
+def upsert_by_id(items, item):
+    for i, existing in enumerate(items):
+        if existing.id == item.id:
+            items[i] = item
+            return
+    items.append(item)
+
+def apply_session_event(session_id, event_type, data):
+    """
+    イベントログの1件をインメモリのストアに反映する
+    """
+    if event_type == "session_created":
+        load_session_state(session_id, {
+            "session": data["session"], "messages": data["messages"],
+            "tasks": [], "task_steps": [], "agent_actions": []
+        })
+    elif session_id not in sessions_db:
+        logger.warning("作成されていないセッションのイベントを無視します: %s (%s)", session_id, event_type)
+    elif event_type == "session_updated":
+        sessions_db[session_id] = ChatSession(**data)
+    elif event_type == "message":
+        messages_db[session_id].append(MessageRecord.from_json(data))
+    elif event_type == "agent_action":
+        agent_actions_db[session_id].append(AgentActionRecord.from_json(data))
+    elif event_type == "task":
+        upsert_by_id(tasks_db[session_id], TaskRecord.from_json(data))
+        task_steps_db.setdefault(data["id"], [])
+    elif event_type == "task_step":
+        upsert_by_id(task_steps_db.setdefault(data["task_id"], []), TaskStepRecord.from_json(data))
+    elif event_type == "task_steps":
+        # セッションのすべてのステップの一覧で置き換える
+        steps_by_task = {}
+        for step in data:
+            steps_by_task.setdefault(step["task_id"], []).append(TaskStepRecord.from_json(step))
+        for task in tasks_db[session_id]:
+            task_steps_db[task.id] = steps_by_task.get(task.id, [])
+
+async def restore_sessions():
+    """
+    イベントログからセッションを復元する（スナップショットの後のイベントだけを適用する）
+
+    停止時に実行中だったタスクとステップは失敗として扱う。
+    """
+    started = time.monotonic()
+    restored = await asyncio.to_thread(session_log.load)
+    event_count = 0
+    for entry in restored:
+        try:
+            if entry.snapshot is not None:
+                load_session_state(entry.session_id, entry.snapshot)
+            for event in entry.events:
+                apply_session_event(entry.session_id, event["type"], event["data"])
+        except (KeyError, TypeError, ValidationError) as e:
+            logger.error("セッションを復元できません: %s - %s", entry.session_id, e)
+            for task in tasks_db.pop(entry.session_id, []):
+                task_steps_db.pop(task.id, None)
+            for store in (sessions_db, messages_db, agent_actions_db, agent_state_db):
+                store.pop(entry.session_id, None)
+            continue
+        event_count += len(entry.events)
+        
+        for task in tasks_db.get(entry.session_id, []):
+            for step in task_steps_db.get(task.id, []):
+                if step.status == TaskStepStatus.in_progress:
+                    step.status = TaskStepStatus.failed
+                    step.updated_at = datetime.now()
+                    persist_session_event(entry.session_id, "task_step", step.to_json())
+            if task.status == TaskStatus.in_progress:
+                task.status = TaskStatus.failed
+                task.updated_at = datetime.now()
+                persist_session_event(entry.session_id, "task", task.to_json())
+        # 次回の起動ではこのスナップショットから読めばよい
+        if entry.events and entry.session_id in sessions_db:
+            session_log.snapshot(entry.session_id)
+        # 全文検索の索引は保存していないため作り直す
+        for message in messages_db.get(entry.session_id, []):
+            search_index.submit(entry.session_id, {"type": "message", "data": message.to_json()})
+        for action in agent_actions_db.get(entry.session_id, []):
+            search_index.submit(entry.session_id, {"type": "agent_action", "data": action.to_json()})
+    if restored:
+        logger.info(
+            "セッションを復元しました: %d件（イベント %d件、%.2f秒）",
+            sum(entry.session_id in sessions_db for entry in restored), event_count, time.monotonic() - started
+        )
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, List[WebSocket]] = {}
@@ -650,9 +1950,18 @@ class ConnectionManager:
                 del self.active_connections[session_id]
 
     async def broadcast(self, session_id: str, message: Dict[str, Any]):
+        # メッセージとアクションは全文検索の索引に追加する（キューに積むだけ）
+        search_index.submit(session_id, message)
+        if message.get("type") in PERSISTED_EVENT_TYPES:
+            persist_session_event(session_id, message["type"], message["data"])
         if session_id in self.active_connections:
-            for connection in self.active_connections[session_id]:
+            started = time.monotonic()
+            trace_started = time.time_ns()
+            connections = self.active_connections[session_id]
+            for connection in connections:
                 await connection.send_json(message)
+            broadcast_seconds.observe(time.monotonic() - started)
+            tracer.record("broadcast", trace_started, type=message.get("type"), connections=len(connections))
 
 manager = ConnectionManager()
 
@@ -678,7 +1987,7 @@ async def create_chat_session(model_id: str, title: str):
     
     sessions_db[session_id] = session
     messages_db[session_id] = [
-        Message(
+        MessageRecord(
             id=str(uuid.uuid4()),
             role="assistant",
             content="こんにちは！AIエージェントのManusクローンです。どのようなタスクをお手伝いしましょうか？",
@@ -689,9 +1998,63 @@ async def create_chat_session(model_id: str, title: str):
     tasks_db[session_id] = []
     agent_actions_db[session_id] = []
     agent_state_db[session_id] = AgentState.idle
+    persist_session_event(session_id, "session_created", {
+        "session": json.loads(session.json()),
+        "messages": [message.to_json() for message in messages_db[session_id]]
+    })
+    
+    # 最初のタスクでロード時間を待たないよう、モデルを事前ロードする
+    model_residency.warm(model_id)
     
     return session
 
+@app.get("/api/models/resident")
+async def get_resident_models():
+    await model_residency.refresh()
+    return model_residency.status()
+
+@app.get("/api/ollama/backends")
+async def get_ollama_backends():
+    return ollama_pool.status()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def require_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="管理用のAPIは無効です（ADMIN_TOKENが未設定）")
+    if not token or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="管理用のトークンが正しくありません")
+
+@app.get("/api/admin/profile", response_class=PlainTextResponse)
+async def get_profile(
+    seconds: float = 10,
+    interval: float = 0.005,
+    mode: str = "all",
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    指定した秒数だけプロセスをサンプリングし、collapsed形式のスタックを返す
+    （mode: all / threads / tasks）
+    """
+    require_admin(x_admin_token)
+    if mode not in ("all", "threads", "tasks"):
+        raise HTTPException(status_code=400, detail=f"不明なモードです: {mode}")
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="プロファイリングを実行中です")
+    logger.info("プロファイリングを開始します: %.1f秒 (%s)", seconds, mode)
+    result = await profiler.profile(
+        seconds, interval, include_threads=mode != "tasks", include_tasks=mode != "threads"
+    )
+    return PlainTextResponse(
+        result, headers={"Content-Disposition": f'attachment; filename="profile-{int(time.time())}.folded"'}
+    )
+
+@app.get("/api/ollama/scheduler")
+async def get_ollama_scheduler():
+    return llm_scheduler.status()
+
 @app.get("/api/chat/sessions", response_model=List[ChatSession])
 async def get_chat_sessions():
     return list(sessions_db.values())
@@ -702,11 +2065,82 @@ async def get_chat_session(session_id: str):
         return {"error": "Session not found"}
     return sessions_db[session_id]
 
+@app.get("/api/chat/sessions/{session_id}/workspace")
+async def get_workspace_usage(session_id: str):
+    if session_id not in sessions_db:
+        return {"error": "Session not found"}
+    
+    # 未使用のワークスペースは使用量0として返す
+    usage = workspaces.usage(session_id)
+    if usage is None:
+        return {
+            "session_id": session_id,
+            "path": workspaces.path_for(session_id) if is_valid_session_id(session_id) else None,
+            "bytes_used": 0,
+            "file_count": 0,
+            "quota_bytes": workspaces.quota_bytes,
+            "last_used": None,
+            "active": False
+        }
+    return usage
+
+@app.get("/api/chat/sessions/{session_id}/usage")
+async def get_session_usage(session_id: str):
+    """
+    セッションとそのタスクごとのリソース使用量と、上限に対する残り
+    """
+    if session_id not in sessions_db:
+        return {"error": "Session not found"}
+    return usage_tracker.report(session_id)
+
+@app.get("/api/search")
+async def search(q: str, session_id: Optional[str] = None, kind: Optional[str] = None, limit: int = 20, offset: int = 0):
+    """
+    メッセージとアクションを全文検索する（kind: message / action）
+    """
+    if kind is not None and kind not in ("message", "action"):
+        raise HTTPException(status_code=400, detail=f"不明な種類です: {kind}")
+    limit = min(max(limit, 1), 100)
+    offset = max(offset, 0)
+    result = search_index.search(q, session_id=session_id, kind=kind, limit=limit, offset=offset)
+    return {"query": q, "limit": limit, "offset": offset, **result}
+
+@app.get("/api/workspaces")
+async def get_workspaces_usage():
+    return workspaces.all_usage()
+
+@app.delete("/api/chat/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    if session_id not in sessions_db:
+        return {"error": "Session not found"}
+    
+    # セッションのデータを削除
+    del sessions_db[session_id]
+    for task in tasks_db.pop(session_id, []):
+        task_steps_db.pop(task.id, None)
+        task_results_db.pop(task.id, None)
+    messages_db.pop(session_id, None)
+    agent_actions_db.pop(session_id, None)
+    agent_state_db.pop(session_id, None)
+    history_compactor.invalidate(session_id)
+    ollama_sessions.invalidate(session_id)
+    tracer.drop_session(session_id)
+    usage_tracker.drop_session(session_id)
+    search_index.drop_session(session_id)
+    if session_log is not None and is_valid_session_id(session_id):
+        session_log.delete(session_id)
+    
+    # 常駐シェルとワークスペースを削除（ディレクトリ名にできないIDにはワークスペースがない）
+    if is_valid_session_id(session_id):
+        await workspaces.remove(session_id)
+    
+    return {"status": "success"}
+
 @app.get("/api/chat/sessions/{session_id}/messages", response_model=List[Message])
 async def get_messages(session_id: str):
     if session_id not in messages_db:
         return []
-    return messages_db[session_id]
+    return [message.to_model() for message in messages_db[session_id]]
 
 @app.post("/api/chat/sessions/{session_id}/messages", response_model=Message)
 async def send_message(
@@ -740,7 +2174,7 @@ async def send_message(
             )
     
     # メッセージを作成
-    message = Message(
+    message = MessageRecord(
         id=str(uuid.uuid4()),
         role="user",
         content=content,
@@ -753,7 +2187,7 @@ async def send_message(
     # WebSocket経由でメッセージを配信
     await manager.broadcast(
         session_id,
-        {"type": "message", "data": json.loads(message.json())}
+        {"type": "message", "data": message.to_json()}
     )
     
     # エージェントの状態を「計画中」に変更
@@ -766,17 +2200,98 @@ async def send_message(
     # 非同期でエージェントのレスポンスをシミュレート
     asyncio.create_task(simulate_agent_response(session_id, content))
     
-    return message
+    return message.to_model()
+
+def create_task_step(task_id, index, step_data):
+    """
+    実行計画のステップからTaskStepを作成する
+    """
+    now = datetime.now()
+    return TaskStepRecord(
+        id=str(uuid.uuid4()),
+        task_id=task_id,
+        title=step_data.get("title") or f"ステップ {index+1}",
+        description=step_data.get("description") or f"タスクのステップ {index+1} を実行します",
+        status=TaskStepStatus.pending,
+        created_at=now,
+        updated_at=now
+    )
+
+async def sync_task_steps(session_id, task, steps):
+    """
+    タスクのステップを最終的な実行計画に合わせて更新・追加・削除する
+    """
+    task_steps = task_steps_db.setdefault(task.id, [])
+    for i, step_data in enumerate(steps):
+        if i < len(task_steps):
+            step = task_steps[i]
+            expected = create_task_step(task.id, i, step_data)
+            if step.title == expected.title and step.description == expected.description:
+                continue
+            step.title = expected.title
+            step.description = expected.description
+            step.updated_at = datetime.now()
+        else:
+            step = create_task_step(task.id, i, step_data)
+            task_steps.append(step)
+        await manager.broadcast(
+            session_id,
+            {"type": "task_step", "data": step.to_json()}
+        )
+    
+    # 計画から外れたステップを削除し、ステップ一覧を送り直す
+    if len(task_steps) > len(steps):
+        del task_steps[len(steps):]
+        session_steps = []
+        for session_task in tasks_db.get(session_id, []):
+            session_steps.extend(task_steps_db.get(session_task.id, []))
+        await manager.broadcast(
+            session_id,
+            {"type": "task_steps", "data": [step.to_json() for step in session_steps]}
+        )
+
+def describe_budget_exceeded(session_id):
+    """
+    セッションが上限に達した使用量の項目を説明する文字列を返す（達していなければ空文字列）
+    """
+    return "、".join(
+        f"{name}: {round(used, 2)} / {limit}" for name, used, limit in usage_tracker.exceeded(session_id)
+    )
+
+async def notify_budget_exceeded(session_id, content):
+    """
+    使用量の上限に達したことをユーザーに通知し、エージェントを待機状態に戻す
+    """
+    budget_message = MessageRecord(
+        id=str(uuid.uuid4()),
+        role="assistant",
+        content=content,
+        timestamp=datetime.now(),
+        files=None
+    )
+    messages_db[session_id].append(budget_message)
+    await manager.broadcast(
+        session_id,
+        {"type": "message", "data": budget_message.to_json()}
+    )
+    agent_state_db[session_id] = AgentState.idle
+    await manager.broadcast(
+        session_id,
+        {"type": "agent_state", "data": AgentState.idle}
+    )
 
 async def simulate_agent_response(session_id: str, user_content: str):
     """
     AIエージェントがタスクを実行するメイン処理
     """
     if session_id not in sessions_db:
-        print(f"エラー: セッションID {session_id} が見つかりません")
+        logger.error("セッションID %s が見つかりません", session_id)
         return
 
     session = sessions_db[session_id]
+    bind(session_id=session_id)
+    # このタスク内のリソース使用量をセッション（とタスクの作成後はタスク）に計上する
+    usage_tracker.bind(session_id)
     
     # エージェントの状態を更新
     agent_state_db[session_id] = AgentState.thinking
@@ -784,15 +2299,36 @@ async def simulate_agent_response(session_id: str, user_content: str):
         session_id,
         {"type": "agent_state", "data": AgentState.thinking}
     )
+    
+    # 計画の生成中に先行実行したステップ（使われなかった場合は最後に破棄する）
+    speculation = None
+    # このタスク内のOllamaへのリクエスト（再試行を含む）はすべてこの制限時間内に収める
+    current_deadline.set(Deadline(AGENT_JOB_TIMEOUT))
+    agent_jobs_running.inc()
+    # このタスクの処理全体を1つのトレースとして記録する
+    job_span, job_token = tracer.start("agent_job", session_id=session_id, root=True, model=session.model_id)
+    job_error = None
+    # Ollamaとのやり取りとツールの実行結果をこのタスクの記録として扱う
+    interactions.begin(user_content, session.model_id)
 
     try:
-        # 簡単なテストリクエストでOllamaの接続を確認
-        test_success = await test_ollama_simple_request()
+        # 使用量の上限に達したセッションでは新しいタスクを始めない
+        budget_notice = describe_budget_exceeded(session_id)
+        if budget_notice:
+            logger.warning("使用量の上限に達しているためタスクを開始しません: %s", budget_notice)
+            await notify_budget_exceeded(
+                session_id,
+                f"このセッションのリソース使用量が上限に達したため、タスクを実行できません（{budget_notice}）。"
+            )
+            return
+        
+        # セッションのモデルがロードされているか確認（事前ロード中ならその完了を待つ）
+        test_success = await model_residency.ensure_loaded(session.model_id)
         if not test_success:
-            print("警告: Ollamaテストリクエストが失敗しました。処理を継続しますが注意が必要です。")
+            logger.warning("Ollamaテストリクエストが失敗しました。処理を継続しますが注意が必要です。")
             
             # テスト失敗の通知アクションを記録
-            notification_action = AgentAction(
+            notification_action = AgentActionRecord(
                 id=str(uuid.uuid4()),
                 session_id=session_id,
                 type=AgentActionType.notify,
@@ -805,11 +2341,11 @@ async def simulate_agent_response(session_id: str, user_content: str):
             agent_actions_db[session_id].append(notification_action)
             await manager.broadcast(
                 session_id,
-                {"type": "agent_action", "data": json.loads(notification_action.json())}
+                {"type": "agent_action", "data": notification_action.to_json()}
             )
         
         # タスク解析アクションを記録
-        analysis_action = AgentAction(
+        analysis_action = AgentActionRecord(
             id=str(uuid.uuid4()),
             session_id=session_id,
             type=AgentActionType.analysis,
@@ -823,45 +2359,122 @@ async def simulate_agent_response(session_id: str, user_content: str):
         agent_actions_db[session_id].append(analysis_action)
         await manager.broadcast(
             session_id,
-            {"type": "agent_action", "data": json.loads(analysis_action.json())}
+            {"type": "agent_action", "data": analysis_action.to_json()}
         )
         
         # タスクを解析して実行ステップに分解
-        print(f"タスク解析開始 - モデル: {session.model_id}, タスク: {user_content[:50]}...")
-        result = await analyze_task(session.model_id, user_content)
+        # 計画の生成中に完成したステップから順にタスクとステップを作成して配信する
+        task = None
+        
+        async def ensure_task(title):
+            nonlocal task
+            if task is None:
+                now = datetime.now()
+                task = TaskRecord(
+                    id=str(uuid.uuid4()),
+                    session_id=session_id,
+                    title=title[:50],
+                    description=user_content,
+                    status=TaskStatus.in_progress,
+                    created_at=now,
+                    updated_at=now
+                )
+                tasks_db[session_id].append(task)
+                task_steps_db[task.id] = []
+                bind(task_id=task.id)
+                tracer.link_task(task.id)
+                usage_tracker.set_task(task.id)
+                interactions.set_task(task.id)
+                await manager.broadcast(
+                    session_id,
+                    {"type": "task", "data": task.to_json()}
+                )
+            return task
+        
+        async def on_plan_thought(thought):
+            await ensure_task(thought or "新しいタスク")
+        
+        async def on_plan_step(index, step_data):
+            nonlocal speculation
+            # 最初のステップは計画の生成完了を待たずに実行を始める
+            if index == 0 and SPECULATIVE_EXECUTION_ENABLED and SpeculativeStep.can_speculate(session_id, step_data):
+                logger.info("ステップ 1 を先行実行します: %s", step_data.get('title', ''))
+                speculation = SpeculativeStep(session_id, step_data)
+                speculation.start()
+            current_task = await ensure_task(user_content)
+            step = create_task_step(current_task.id, index, step_data)
+            task_steps_db[current_task.id].append(step)
+            await manager.broadcast(
+                session_id,
+                {"type": "task_step", "data": step.to_json()}
+            )
+        
+        logger.debug("タスク解析を依頼 - モデル: %s", session.model_id)
+        with tracer.span("plan", model=session.model_id) as plan_span:
+            result = await analyze_task(
+                session.model_id,
+                user_content,
+                on_thought=on_plan_thought,
+                on_step=on_plan_step,
+                session_id=session_id
+            )
+            if plan_span is not None:
+                plan_span.set(success=result["success"], steps=len(result["plan"]["steps"]) if result["success"] else 0)
         
         if not result["success"]:
             # タスク解析に失敗した場合
-            print(f"タスク解析失敗: {result.get('error', '不明なエラー')}")
+            logger.warning("タスク解析失敗: %s", result.get('error', '不明なエラー'))
+            
+            # 生成途中で作成したタスクは失敗として扱う
+            if task is not None:
+                task.status = TaskStatus.failed
+                task.updated_at = datetime.now()
+                task.usage = usage_tracker.task(task.id)
+                await manager.broadcast(
+                    session_id,
+                    {"type": "task", "data": task.to_json()}
+                )
+            
+            # 失敗の原因（Ollama側の過負荷・停止か、モデルの出力の問題か）に応じて案内する
+            error_kind = result.get("error_kind", OllamaError.kind)
+            if error_kind == OllamaUnavailableError.kind:
+                error_hint = "Ollamaサーバーが混雑しているか応答していません。しばらく待ってから再度お試しください。"
+            elif error_kind == DeadlineExceeded.kind:
+                error_hint = "制限時間内にタスクの解析が完了しませんでした。"
+            elif error_kind == OllamaOutputError.kind:
+                error_hint = "モデルが有効な実行計画を生成できませんでした。指示を具体的にするか、別のモデルをお試しください。"
+            else:
+                error_hint = "タスクの解析に失敗しました。"
             
             # エラー通知アクションを記録
-            error_action = AgentAction(
+            error_action = AgentActionRecord(
                 id=str(uuid.uuid4()),
                 session_id=session_id,
                 type=AgentActionType.notify,
                 description="タスク解析失敗",
                 details={
-                    "error": result.get('error', '不明なエラー')
+                    "error": result.get('error', '不明なエラー'),
+                    "error_kind": error_kind
                 },
                 created_at=datetime.now()
             )
             agent_actions_db[session_id].append(error_action)
             await manager.broadcast(
                 session_id,
-                {"type": "agent_action", "data": json.loads(error_action.json())}
+                {"type": "agent_action", "data": error_action.to_json()}
             )
             
-            error_message = Message(
+            error_message = MessageRecord(
                 id=str(uuid.uuid4()),
                 role="assistant",
-                content=f"申し訳ありませんが、タスクの解析に失敗しました。\n\nエラー詳細: {result.get('error', '不明なエラー')}",
+                content=f"申し訳ありませんが、タスクの解析に失敗しました。{error_hint}\n\nエラー詳細: {result.get('error', '不明なエラー')}",
                 timestamp=datetime.now(),
                 files=None
             )
             messages_db[session_id].append(error_message)
             await manager.broadcast(
                 session_id,
-                {"type": "message", "data": json.loads(error_message.json())}
+                {"type": "message", "data": error_message.to_json()}
             )
             
             # エージェントの状態を更新
@@ -878,7 +2491,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
         steps = plan.get("steps", [])
         
         # タスク解析成功のアクションを記録
-        analysis_success_action = AgentAction(
+        analysis_success_action = AgentActionRecord(
             id=str(uuid.uuid4()),
             session_id=session_id,
             type=AgentActionType.analysis,
@@ -892,29 +2505,21 @@ async def simulate_agent_response(session_id: str, user_content: str):
         agent_actions_db[session_id].append(analysis_success_action)
         await manager.broadcast(
             session_id,
-            {"type": "agent_action", "data": json.loads(analysis_success_action.json())}
-        )
-        
-        # タスクを作成
-        now = datetime.now()
-        task = Task(
-            id=str(uuid.uuid4()),
-            session_id=session_id,
-            title=task_title,
-            description=user_content,
-            status=TaskStatus.in_progress,
-            created_at=now,
-            updated_at=now
+            {"type": "agent_action", "data": analysis_success_action.to_json()}
         )
         
-        tasks_db[session_id].append(task)
-        await manager.broadcast(
-            session_id,
-            {"type": "task", "data": json.loads(task.json())}
-        )
+        # タスクを作成（生成中に作成済みの場合はタイトルを確定する）
+        await ensure_task(task_title)
+        if task.title != task_title:
+            task.title = task_title
+            task.updated_at = datetime.now()
+            await manager.broadcast(
+                session_id,
+                {"type": "task", "data": task.to_json()}
+            )
         
         # 確認メッセージを送信
-        confirm_message = Message(
+        confirm_message = MessageRecord(
             id=str(uuid.uuid4()),
             role="assistant",
             content=f"タスク「{task_title}」を実行します。以下のステップで進めます：\n\n" + 
@@ -925,27 +2530,11 @@ async def simulate_agent_response(session_id: str, user_content: str):
         messages_db[session_id].append(confirm_message)
         await manager.broadcast(
             session_id,
-            {"type": "message", "data": json.loads(confirm_message.json())}
+            {"type": "message", "data": confirm_message.to_json()}
         )
         
-        # タスクステップを作成
-        task_steps_db[task.id] = []
-        for i, step_data in enumerate(steps):
-            step = TaskStep(
-                id=str(uuid.uuid4()),
-                task_id=task.id,
-                title=step_data.get("title", f"ステップ {i+1}"),
-                description=step_data.get("description", f"タスクのステップ {i+1} を実行します"),
-                status=TaskStepStatus.pending,
-                created_at=now,
-                updated_at=now
-            )
-            task_steps_db[task.id].append(step)
-            await manager.broadcast(
-                session_id,
-                {"type": "task_step", "data": json.loads(step.json())}
-            )
-            await asyncio.sleep(0.5)
+        # 生成中に作成したステップを最終的な計画に合わせる
+        await sync_task_steps(session_id, task, steps)
             
         # ここから実際のタスク実行ループを開始
         # エージェントの状態を「実行中」に変更
@@ -957,13 +2546,19 @@ async def simulate_agent_response(session_id: str, user_content: str):
         
         # ステップごとの実行結果を保存するリスト
         steps_results = []
+        # 失敗したステップ以降を立て直すための予算
+        replan_budget = ReplanBudget()
         
-        # タスクのステップを順番に実行
-        for i, (step_obj, step_data) in enumerate(zip(task_steps_db[task.id], steps)):
+        # タスクのステップを順番に実行（再計画でstepsが差し替わることがある）
+        i = 0
+        while i < len(steps):
+            step_obj = task_steps_db[task.id][i]
+            step_data = steps[i]
+            bind(step_id=step_obj.id)
             # 中断確認
             if agent_state_db[session_id] == AgentState.waiting_for_user:
                 # ユーザーによる停止
-                pause_message = Message(
+                pause_message = MessageRecord(
                     id=str(uuid.uuid4()),
                     role="assistant",
                     content=f"タスクの実行が一時停止されました。再開するには「再開」ボタンをクリックしてください。",
@@ -973,12 +2568,12 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 messages_db[session_id].append(pause_message)
                 await manager.broadcast(
                     session_id,
-                    {"type": "message", "data": json.loads(pause_message.json())}
+                    {"type": "message", "data": pause_message.to_json()}
                 )
                 return
             elif agent_state_db[session_id] == AgentState.idle:
                 # ユーザーによる停止
-                stop_message = Message(
+                stop_message = MessageRecord(
                     id=str(uuid.uuid4()),
                     role="assistant",
                     content=f"タスクの実行が停止されました。",
@@ -988,7 +2583,24 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 messages_db[session_id].append(stop_message)
                 await manager.broadcast(
                     session_id,
-                    {"type": "message", "data": json.loads(stop_message.json())}
+                    {"type": "message", "data": stop_message.to_json()}
+                )
+                return
+            
+            # 使用量の上限に達した場合は残りのステップを実行せずにタスクを失敗として終える
+            budget_notice = describe_budget_exceeded(session_id)
+            if budget_notice:
+                logger.warning("使用量の上限に達したためタスクを中止します: %s", budget_notice)
+                task.status = TaskStatus.failed
+                task.updated_at = datetime.now()
+                task.usage = usage_tracker.task(task.id)
+                await manager.broadcast(
+                    session_id,
+                    {"type": "task", "data": task.to_json()}
+                )
+                await notify_budget_exceeded(
+                    session_id,
+                    f"このセッションのリソース使用量が上限に達したため、ステップ {i+1} 以降の実行を中止します（{budget_notice}）。"
                 )
                 return
             
@@ -997,11 +2609,11 @@ async def simulate_agent_response(session_id: str, user_content: str):
             step_obj.updated_at = datetime.now()
             await manager.broadcast(
                 session_id,
-                {"type": "task_step", "data": json.loads(step_obj.json())}
+                {"type": "task_step", "data": step_obj.to_json()}
             )
             
             # ステップの実行開始をユーザーに通知
-            running_message = Message(
+            running_message = MessageRecord(
                 id=str(uuid.uuid4()),
                 role="assistant",
                 content=f"ステップ {i+1} を実行中: {step_obj.title}",
@@ -1011,7 +2623,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
             messages_db[session_id].append(running_message)
             await manager.broadcast(
                 session_id,
-                {"type": "message", "data": json.loads(running_message.json())}
+                {"type": "message", "data": running_message.to_json()}
             )
             
             # アクションタイプをMapする関数
@@ -1026,7 +2638,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
             
             # アクションを記録
             action_type = map_action_type(step_data.get("action", ""))
-            action = AgentAction(
+            action = AgentActionRecord(
                 id=str(uuid.uuid4()),
                 session_id=session_id,
                 type=action_type,
@@ -1037,26 +2649,47 @@ async def simulate_agent_response(session_id: str, user_content: str):
             agent_actions_db[session_id].append(action)
             await manager.broadcast(
                 session_id,
-                {"type": "agent_action", "data": json.loads(action.json())}
+                {"type": "agent_action", "data": action.to_json()}
             )
             
-            # ステップを実行
-            print(f"ステップ {i+1} 実行: {step_obj.title}")
-            step_result = await execute_step(step_data, session_id)
+            with tracer.span("step", index=i, step_id=step_obj.id, action=step_data.get("action", "")) as step_span:
+                # ステップを実行（先行実行の内容が確定した計画と一致すればその結果を使う）
+                logger.info("ステップ %d 実行: %s", i + 1, step_obj.title)
+                if i == 0 and speculation is not None:
+                    current_speculation, speculation = speculation, None
+                    if current_speculation.matches(step_data):
+                        step_result = await current_speculation.result()
+                    else:
+                        logger.info("先行実行したステップが最終的な計画と異なるため破棄します")
+                        await current_speculation.discard()
+                        step_result = await execute_step(step_data, session_id)
+                else:
+                    step_result = await execute_step(step_data, session_id)
+            
+                # ステップの実行結果を分析（失敗した場合は残りのステップの再計画を試みる）
+                analysis = await analyze_step_result(
+                    session.model_id,
+                    step_data,
+                    step_result,
+                    task_description=user_content,
+                    steps_results=steps_results,
+                    remaining_steps=steps[i+1:],
+                    budget=replan_budget
+                )
+            
+                if step_span is not None:
+                    step_span.set(success=bool(step_result.get("success")), replanned="replan" in analysis)
             
             # 実行結果を保存
             steps_results.append((step_data, step_result))
             
-            # ステップの実行結果を分析
-            analysis = await analyze_step_result(session.model_id, step_data, step_result)
-            
             if step_result["success"]:
                 # 成功の場合はステップの状態を「完了」に更新
                 step_obj.status = TaskStepStatus.completed
                 step_obj.updated_at = datetime.now()
                 
                 # 成功のアクションを記録
-                success_action = AgentAction(
+                success_action = AgentActionRecord(
                     id=str(uuid.uuid4()),
                     session_id=session_id,
                     type=action_type,
@@ -1071,11 +2704,11 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 agent_actions_db[session_id].append(success_action)
                 await manager.broadcast(
                     session_id,
-                    {"type": "agent_action", "data": json.loads(success_action.json())}
+                    {"type": "agent_action", "data": success_action.to_json()}
                 )
                 
                 # 成功メッセージをユーザーに通知
-                success_message = Message(
+                success_message = MessageRecord(
                     id=str(uuid.uuid4()),
                     role="assistant",
                     content=f"ステップ {i+1} が正常に完了しました: {step_obj.title}",
@@ -1085,12 +2718,12 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 messages_db[session_id].append(success_message)
                 await manager.broadcast(
                     session_id,
-                    {"type": "message", "data": json.loads(success_message.json())}
+                    {"type": "message", "data": success_message.to_json()}
                 )
                 
                 # 実行結果の詳細をユーザーに通知（シェルコマンドの場合は出力を表示）
                 if "stdout" in step_result and step_result["stdout"].strip():
-                    output_message = Message(
+                    output_message = MessageRecord(
                         id=str(uuid.uuid4()),
                         role="assistant",
                         content=f"出力結果:\n```\n{step_result['stdout']}\n```",
@@ -1100,7 +2733,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
                     messages_db[session_id].append(output_message)
                     await manager.broadcast(
                         session_id,
-                        {"type": "message", "data": json.loads(output_message.json())}
+                        {"type": "message", "data": output_message.to_json()}
                     )
             else:
                 # 失敗の場合はステップの状態を「失敗」に更新
@@ -1108,7 +2741,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 step_obj.updated_at = datetime.now()
                 
                 # 失敗のアクションを記録
-                error_action = AgentAction(
+                error_action = AgentActionRecord(
                     id=str(uuid.uuid4()),
                     session_id=session_id,
                     type=action_type,
@@ -1123,11 +2756,11 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 agent_actions_db[session_id].append(error_action)
                 await manager.broadcast(
                     session_id,
-                    {"type": "agent_action", "data": json.loads(error_action.json())}
+                    {"type": "agent_action", "data": error_action.to_json()}
                 )
                 
                 # エラーメッセージをユーザーに通知
-                error_message = Message(
+                error_message = MessageRecord(
                     id=str(uuid.uuid4()),
                     role="assistant",
                     content=f"ステップ {i+1} の実行中にエラーが発生しました: {step_result.get('error', '不明なエラー')}",
@@ -1137,21 +2770,40 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 messages_db[session_id].append(error_message)
                 await manager.broadcast(
                     session_id,
-                    {"type": "message", "data": json.loads(error_message.json())}
+                    {"type": "message", "data": error_message.to_json()}
                 )
                 
+                # 再計画できた場合は、失敗したステップの後ろを新しいステップで置き換えて続行する
+                if analysis.get("replan"):
+                    steps = steps[:i+1] + analysis["replan"]
+                    await sync_task_steps(session_id, task, steps)
+                    replan_message = MessageRecord(
+                        id=str(uuid.uuid4()),
+                        role="assistant",
+                        content="残りのステップを次のように立て直して続行します：\n\n" +
+                               "\n".join([f"{j+1}. {step['description']}" for j, step in enumerate(steps) if j > i]),
+                        timestamp=datetime.now(),
+                        files=None
+                    )
+                    messages_db[session_id].append(replan_message)
+                    await manager.broadcast(
+                        session_id,
+                        {"type": "message", "data": replan_message.to_json()}
+                    )
+                
                 # ステップのエラーでタスク全体を中断する場合
-                if not analysis.get("continue", False):
+                elif not analysis.get("continue", False):
                     # タスクの状態を「失敗」に更新
                     task.status = TaskStatus.failed
                     task.updated_at = datetime.now()
+                    task.usage = usage_tracker.task(task.id)
                     await manager.broadcast(
                         session_id,
-                        {"type": "task", "data": json.loads(task.json())}
+                        {"type": "task", "data": task.to_json()}
                     )
                     
                     # 停止メッセージをユーザーに通知
-                    abort_message = Message(
+                    abort_message = MessageRecord(
                         id=str(uuid.uuid4()),
                         role="assistant",
                         content=f"エラーが発生したため、タスクの実行を中止します。",
@@ -1161,7 +2813,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
                     messages_db[session_id].append(abort_message)
                     await manager.broadcast(
                         session_id,
-                        {"type": "message", "data": json.loads(abort_message.json())}
+                        {"type": "message", "data": abort_message.to_json()}
                     )
                     
                     # エージェントの状態を「アイドル」に更新
@@ -1175,22 +2827,24 @@ async def simulate_agent_response(session_id: str, user_content: str):
             # ステップの状態を更新
             await manager.broadcast(
                 session_id,
-                {"type": "task_step", "data": json.loads(step_obj.json())}
+                {"type": "task_step", "data": step_obj.to_json()}
             )
             
             # 次のステップに進む前に少し待機
             await asyncio.sleep(1)
+            i += 1
         
         # すべてのステップが完了した場合、タスクの完了処理
         task.status = TaskStatus.completed
         task.updated_at = datetime.now()
+        task.usage = usage_tracker.task(task.id)
         await manager.broadcast(
             session_id,
-            {"type": "task", "data": json.loads(task.json())}
+            {"type": "task", "data": task.to_json()}
         )
         
         # 完了アクションを記録
-        complete_action = AgentAction(
+        complete_action = AgentActionRecord(
             id=str(uuid.uuid4()),
             session_id=session_id,
             type=AgentActionType.notify,
@@ -1199,21 +2853,29 @@ async def simulate_agent_response(session_id: str, user_content: str):
                 "task_id": task.id,
                 "task_title": task_title,
                 "total_steps": len(steps),
-                "success": True
+                "success": True,
+                "usage": task.usage
             },
             created_at=datetime.now()
         )
         agent_actions_db[session_id].append(complete_action)
         await manager.broadcast(
             session_id,
-            {"type": "agent_action", "data": json.loads(complete_action.json())}
+            {"type": "agent_action", "data": complete_action.to_json()}
         )
         
-        # タスク完了の要約を生成
-        summary = await generate_task_summary(session.model_id, user_content, steps_results)
+        # 完了の通知はLLMによる要約を待たずに送る
+        # 単純なタスクは定型文の要約で済ませ、それ以外は要約を後から生成する
+        summary = build_template_summary(steps_results)
+        if is_trivial_task(steps_results):
+            task.summary = summary
+        else:
+            store_task_results(task.id, session.model_id, steps_results)
+            if TASK_SUMMARY_MODE == "background":
+                summary += "\n\n詳しい要約を作成しています..."
         
         # 完了メッセージをユーザーに通知
-        complete_message = Message(
+        complete_message = MessageRecord(
             id=str(uuid.uuid4()),
             role="assistant",
             content=f"タスク「{task_title}」が完了しました。\n\n{summary}",
@@ -1223,7 +2885,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
         messages_db[session_id].append(complete_message)
         await manager.broadcast(
             session_id,
-            {"type": "message", "data": json.loads(complete_message.json())}
+            {"type": "message", "data": complete_message.to_json()}
         )
         
         # エージェントの状態を更新
@@ -1233,11 +2895,15 @@ async def simulate_agent_response(session_id: str, user_content: str):
             {"type": "agent_state", "data": AgentState.idle}
         )
         
+        if task.id in task_results_db and TASK_SUMMARY_MODE == "background":
+            asyncio.create_task(summarize_task(task))
+        
     except Exception as e:
-        print(f"エージェント応答の生成中にエラーが発生しました: {str(e)}\n{traceback.format_exc()}")
+        logger.exception("エージェント応答の生成中にエラーが発生しました: %s", e)
+        job_error = e
         
         # エラーアクションを記録
-        error_action = AgentAction(
+        error_action = AgentActionRecord(
             id=str(uuid.uuid4()),
             session_id=session_id,
             type=AgentActionType.notify,
@@ -1251,11 +2917,11 @@ async def simulate_agent_response(session_id: str, user_content: str):
         agent_actions_db[session_id].append(error_action)
         await manager.broadcast(
             session_id,
-            {"type": "agent_action", "data": json.loads(error_action.json())}
+            {"type": "agent_action", "data": error_action.to_json()}
         )
         
         # エラーメッセージを送信
-        error_message = Message(
+        error_message = MessageRecord(
             id=str(uuid.uuid4()),
             role="assistant",
             content=f"申し訳ありませんが、処理中にエラーが発生しました: {str(e)}",
@@ -1265,7 +2931,7 @@ async def simulate_agent_response(session_id: str, user_content: str):
         messages_db[session_id].append(error_message)
         await manager.broadcast(
             session_id,
-            {"type": "message", "data": json.loads(error_message.json())}
+            {"type": "message", "data": error_message.to_json()}
         )
         
         # 実行中のタスクがあれば、状態を「失敗」に更新
@@ -1274,9 +2940,10 @@ async def simulate_agent_response(session_id: str, user_content: str):
             if task.status == TaskStatus.in_progress:
                 task.status = TaskStatus.failed
                 task.updated_at = datetime.now()
+                task.usage = usage_tracker.task(task.id)
                 await manager.broadcast(
                     session_id,
-                    {"type": "task", "data": json.loads(task.json())}
+                    {"type": "task", "data": task.to_json()}
                 )
         
         # エージェントの状態を更新
@@ -1285,24 +2952,49 @@ async def simulate_agent_response(session_id: str, user_content: str):
             session_id,
             {"type": "agent_state", "data": AgentState.idle}
         )
+    
+    finally:
+        agent_jobs_running.dec()
+        # 計画の失敗や中断で使われなかった先行実行を取り消す
+        if speculation is not None:
+            await speculation.discard()
+        await interactions.finish()
+        tracer.end(job_span, job_token, job_error)
 
 @app.get("/api/tasks", response_model=List[Task])
 async def get_tasks(session_id: str):
     if session_id not in tasks_db:
         return []
-    return tasks_db[session_id]
+    return [task.to_model() for task in tasks_db[session_id]]
 
 @app.get("/api/tasks/{task_id}/steps", response_model=List[TaskStep])
 async def get_task_steps(task_id: str):
     if task_id not in task_steps_db:
         return []
-    return task_steps_db[task_id]
+    return [step.to_model() for step in task_steps_db[task_id]]
+
+@app.post("/api/tasks/{task_id}/summary")
+async def get_task_summary(task_id: str):
+    task = next((task for tasks in tasks_db.values() for task in tasks if task.id == task_id), None)
+    if task is None:
+        return {"error": "Task not found"}
+    if task.summary is None and get_task_results(task.id) is None:
+        return {"error": "Summary not available"}
+    summary = await summarize_task(task)
+    return {"task_id": task.id, "summary": summary}
+
+@app.get("/api/tasks/{task_id}/trace")
+async def get_task_trace(task_id: str):
+    trace = tracer.task_trace(task_id)
+    if trace is None:
+        return {"error": "Trace not found"}
+    return trace
 
 @app.get("/api/sessions/{session_id}/actions", response_model=List[AgentAction])
 async def get_agent_actions(session_id: str):
     if session_id not in agent_actions_db:
         return []
-    return agent_actions_db[session_id]
+    return [action.to_model() for action in agent_actions_db[session_id]]
 
 @app.post("/api/sessions/{session_id}/pause")
 async def pause_agent(session_id: str):
@@ -1348,24 +3040,30 @@ async def stop_agent(session_id: str):
             task.updated_at = datetime.now()
             await manager.broadcast(
                 session_id,
-                {"type": "task", "data": json.loads(task.json())}
+                {"type": "task", "data": task.to_json()}
             )
     
     return {"status": "success"}
 
 @app.websocket("/ws/chat/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
-    print(f"WebSocket接続リクエスト - セッションID: {session_id}")
+    bind(session_id=session_id)
+    logger.info("WebSocket接続リクエスト - セッションID: %s", session_id)
+    # セッションIDはディレクトリ名にも使うため、任意の文字列ではセッションを作成しない
+    if not is_valid_session_id(session_id):
+        logger.warning("不正なセッションIDのため接続を拒否します: %s", session_id)
+        await websocket.close(code=1008)
+        return
     try:
         await manager.connect(websocket, session_id)
         
         # セッションが存在しない場合は作成
         if session_id not in sessions_db:
-            print(f"新規セッション作成: {session_id}")
+            logger.info("新規セッション作成: %s", session_id)
             # モデル一覧を取得して最初のモデルをデフォルトとして使用
             models = await fetch_ollama_models()
             default_model = "llama3" if not models else models[0].id
-            print(f"デフォルトモデルを設定: {default_model}")
+            logger.info("デフォルトモデルを設定: %s", default_model)
             
             session = ChatSession(
                 id=session_id,
@@ -1379,6 +3077,8 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             tasks_db[session_id] = []
             agent_actions_db[session_id] = []
             agent_state_db[session_id] = AgentState.idle
+            persist_session_event(session_id, "session_created", {"session": json.loads(session.json()), "messages": []})
+            model_residency.warm(default_model)
             
             await websocket.send_json({
                 "type": "session_created",
@@ -1390,7 +3090,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             for message in messages_db[session_id]:
                 await websocket.send_json({
                     "type": "message",
-                    "data": json.loads(message.json())
+                    "data": message.to_json()
                 })
         
         # 既存のタスクを送信
@@ -1398,7 +3098,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             for task in tasks_db[session_id]:
                 await websocket.send_json({
                     "type": "task",
-                    "data": json.loads(task.json())
+                    "data": task.to_json()
                 })
                 
                 # タスクステップを送信
@@ -1406,7 +3106,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                     for step in task_steps_db[task.id]:
                         await websocket.send_json({
                             "type": "task_step",
-                            "data": json.loads(step.json())
+                            "data": step.to_json()
                         })
         
         # エージェントアクションを送信
@@ -1414,7 +3114,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
             for action in agent_actions_db[session_id]:
                 await websocket.send_json({
                     "type": "agent_action",
-                    "data": json.loads(action.json())
+                    "data": action.to_json()
                 })
         
         # エージェントの状態を送信
@@ -1427,14 +3127,14 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
         try:
             while True:
                 message = await websocket.receive_text()
-                print(f"WebSocket受信: {message[:50]}...")
+                logger.debug("WebSocket受信: %.50s...", message)
                 data = json.loads(message)
                 
                 if data["type"] == "message":
                     user_content = data["content"]
-                    print(f"ユーザーメッセージ受信: {user_content[:50]}...")
+                    logger.info("ユーザーメッセージ受信: %.50s...", user_content)
                     # メッセージをデータベースに保存
-                    message = Message(
+                    message = MessageRecord(
                         id=str(uuid.uuid4()),
                         role="user",
                         content=user_content,
@@ -1445,7 +3145,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                     messages_db[session_id].append(message)
                     await manager.broadcast(
                         session_id,
-                        {"type": "message", "data": json.loads(message.json())}
+                        {"type": "message", "data": message.to_json()}
                     )
                     
                     # エージェントの応答を生成
@@ -1455,7 +3155,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                     # モデル変更リクエスト
                     model_id = data.get("model_id")
                     if model_id:
-                        print(f"モデル変更リクエスト: {model_id}")
+                        logger.info("モデル変更リクエスト: %s", model_id)
                         # 現在のセッションを取得
                         session = sessions_db[session_id]
                         # モデルIDを更新
@@ -1463,6 +3163,10 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                         session.updated_at = datetime.now()
                         # 変更を保存
                         sessions_db[session_id] = session
+                        # 以前のモデルとの会話は引き継げないため破棄する
+                        ollama_sessions.invalidate(session_id)
+                        # 次のタスクでロード時間を待たないよう、新しいモデルを事前ロードする
+                        model_residency.warm(model_id)
                         
                         # 更新されたセッション情報をブロードキャスト
                         await manager.broadcast(
@@ -1471,7 +3175,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                         )
                         
                         # システムメッセージを追加
-                        system_message = Message(
+                        system_message = MessageRecord(
                             id=str(uuid.uuid4()),
                             role="system",
                             content=f"モデルが {model_id} に変更されました。",
@@ -1481,20 +3185,51 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
                         messages_db[session_id].append(system_message)
                         await manager.broadcast(
                             session_id,
-                            {"type": "message", "data": json.loads(system_message.json())}
+                            {"type": "message", "data": system_message.to_json()}
                         )
         
         except WebSocketDisconnect:
-            print(f"WebSocket切断: {session_id}")
+            logger.info("WebSocket切断: %s", session_id)
             manager.disconnect(websocket, session_id)
         
     except Exception as e:
-        print(f"WebSocketエラー: {str(e)}")
+        logger.warning("WebSocketエラー: %s", e)
         try:
             await websocket.close()
         except:
             pass
 
+@app.on_event("startup")
+async def startup_event():
+    # 前回の停止時のセッションをイベントログから復元し、以降の変更の書き込みを開始
+    if session_log is not None:
+        await restore_sessions()
+        session_log.start()
+    # 期限切れワークスペースの回収とイベントループの監視を開始
+    workspaces.start()
+    loop_lag_monitor.start()
+    search_index.start()
+    # Ollamaにロード済みのモデルを取得し、バックエンドのヘルスチェックを開始
+    if not interactions.replaying:
+        await model_residency.refresh()
+        ollama_pool.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 常駐シェルをすべて終了
+    await workspaces.stop()
+    await ollama_pool.stop()
+    await shell_sessions.close_all()
+    await loop_lag_monitor.stop()
+    await search_index.stop()
+    # 書き込み待ちのイベントを書き出す
+    if session_log is not None:
+        await session_log.stop()
+    # 書き出し待ちのトレースとキューに残っているログを書き出す
+    if tracer.exporter is not None:
+        tracer.exporter.close()
+    log_listener.stop()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
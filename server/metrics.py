@@ -0,0 +1,176 @@
+"""
+Prometheusのテキスト形式でメトリクスを出力するための最小限の実装
+
+カウンター・ゲージ・ヒストグラムをラベル付きで記録し、/metricsで
+まとめて出力する。ストアの件数のように出力時に求める値は、
+コールバックとして登録したゲージで扱う。
+"""
+
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 処理時間（秒）用のヒストグラムの既定のバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ラベルが一致しません: {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        (サフィックス, ラベル値, 追加ラベル, 値) のリストを返す
+        """
+        with self._lock:
+            return [("", key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackGauge(Metric):
+    """
+    出力時にコールバックで値を求めるゲージ（コールバックは {ラベル値のタプル: 値} を返す）
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames, callback):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning("メトリクスの取得に失敗しました: %s - %s", self.name, e)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", tuple(str(v) for v in key), None, value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, state["counts"]):
+                    cumulative += count
+                    samples.append(("_bucket", key, ("le", _format_value(float(bound))), cumulative))
+                samples.append(("_sum", key, None, state["sum"]))
+                samples.append(("_count", key, None, state["count"]))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(name, help, labelnames))
+
+    def callback_gauge(self, name, help, callback, labelnames=()):
+        return self._register(CallbackGauge(name, help, labelnames, callback))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """
+        Prometheusのテキスト形式（version 0.0.4）で出力する
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,167 @@
+"""
+Ollamaにロードしておくモデルを管理するモジュール
+
+モデルの切り替え直後の最初のリクエストでロード時間を待たないよう、
+model_changeやセッション作成の時点でバックグラウンドでモデルをロードしておく。
+ロード済みのモデルは最終使用順に記録し、常駐させる数の上限を超えた場合は
+最も長く使われていないモデルをkeep_alive=0でアンロードする。
+Ollamaサーバーが複数ある場合、ロード先はバックエンドプールが選び、
+以降のリクエストはそのモデルをロード済みのバックエンドに優先して送られる。
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+from ollama_pool import BackendError, NoBackendAvailable, normalize_model_name
+
+logger = logging.getLogger(__name__)
+
+
+class ModelResidencyManager:
+    """
+    常駐させるモデルをLRUで管理し、事前ロードとアンロードを行う
+    """
+
+    def __init__(self, pool, max_resident=1, keep_alive="30m", load_timeout=300.0, enabled=True):
+        self.pool = pool
+        # Falseの場合はロード・アンロードを行わない（Ollamaを使わずに記録を再生する場合など）
+        self.enabled = enabled
+        # 同時に常駐させるモデル数（0以下は上限なし）
+        self.max_resident = max_resident
+        self.keep_alive = keep_alive
+        self.load_timeout = load_timeout
+        # モデルID -> 最終使用時刻（古い順、IDは/api/psと比べられるようタグ付きにそろえる）
+        self.resident = OrderedDict()
+        self._loading = {}
+
+    def touch(self, model_id):
+        """
+        モデルが使われたことを記録する（リクエスト送信時に呼ぶ）
+        """
+        model_id = normalize_model_name(model_id)
+        is_new = model_id not in self.resident
+        self.resident[model_id] = time.time()
+        self.resident.move_to_end(model_id)
+        # 事前ロードを経ずに使われたモデルで上限を超えた場合もアンロードする
+        if self.enabled and is_new and 0 < self.max_resident < len(self.resident):
+            asyncio.create_task(self._evict())
+
+    def warm(self, model_id):
+        """
+        モデルのロードをバックグラウンドで開始する（ロード中・ロード済みなら何もしない）
+        """
+        if not self.enabled:
+            return None
+        model_id = normalize_model_name(model_id)
+        if not model_id or model_id in self.resident:
+            if model_id:
+                self.touch(model_id)
+            return self._loading.get(model_id)
+        task = self._loading.get(model_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self._load(model_id))
+            self._loading[model_id] = task
+        return task
+
+    async def ensure_loaded(self, model_id):
+        """
+        モデルがロードされるまで待つ（事前ロード中ならその完了を待つ）
+        """
+        model_id = normalize_model_name(model_id)
+        if model_id in self.resident:
+            self.touch(model_id)
+            return True
+        task = self.warm(model_id)
+        return await task if task is not None else True
+
+    async def _load(self, model_id):
+        started = time.monotonic()
+
+        async def load(backend):
+            # プロンプトなしの生成リクエストでモデルだけをロードさせる
+            async with httpx.AsyncClient(timeout=self.load_timeout) as client:
+                response = await client.post(
+                    f"{backend.url}/api/generate",
+                    json={"model": model_id, "keep_alive": self.keep_alive}
+                )
+            if response.status_code != 200:
+                raise BackendError(f"{response.status_code} {response.text[:200]}", response.status_code)
+            return backend
+
+        try:
+            backend = await self.pool.call(model_id, load)
+            logger.info("モデルを事前ロードしました: %s @ %s（%.1f秒）", model_id, backend.url, time.monotonic() - started)
+            self.touch(model_id)
+            await self._evict()
+            return True
+        except (httpx.HTTPError, NoBackendAvailable) as e:
+            logger.warning("モデルの事前ロードに失敗しました: %s - %s", model_id, e)
+            return False
+        finally:
+            self._loading.pop(model_id, None)
+
+    async def _evict(self):
+        """
+        常駐数の上限を超えた分を、最も長く使われていないモデルからアンロードする
+        """
+        if self.max_resident <= 0:
+            return
+        while len(self.resident) > self.max_resident:
+            model_id, _ = self.resident.popitem(last=False)
+            await self.unload(model_id)
+
+    async def unload(self, model_id):
+        """
+        モデルをアンロードする
+        """
+        model_id = normalize_model_name(model_id)
+        self.resident.pop(model_id, None)
+        # ロードしているバックエンドが分からない場合はすべてに送る
+        backends = [backend for backend in self.pool.backends if model_id in backend.loaded_models]
+        for backend in backends or self.pool.backends:
+            try:
+                async with httpx.AsyncClient(timeout=30.0) as client:
+                    await client.post(
+                        f"{backend.url}/api/generate",
+                        json={"model": model_id, "keep_alive": 0}
+                    )
+                logger.info("モデルをアンロードしました: %s @ %s", model_id, backend.url)
+            except httpx.HTTPError as e:
+                logger.warning("モデルのアンロードに失敗しました: %s @ %s - %s", model_id, backend.url, e)
+        self.pool.mark_unloaded(model_id)
+
+    async def refresh(self):
+        """
+        各バックエンドの/api/psから実際にロードされているモデルを取得して記録を同期する
+        """
+        results = await self.pool.probe_all()
+        if not any(results):
+            logger.warning("ロード済みモデルの取得に失敗しました")
+            return list(self.resident.keys())
+        loaded = []
+        for backend in self.pool.backends:
+            loaded.extend(model_id for model_id in backend.loaded_models if model_id not in loaded)
+        # Ollama側でアンロードされたモデルを記録から除き、未記録のものを古い扱いで追加する
+        for model_id in list(self.resident.keys()):
+            if model_id not in loaded:
+                del self.resident[model_id]
+        for model_id in loaded:
+            if model_id not in self.resident:
+                self.resident[model_id] = 0
+                self.resident.move_to_end(model_id, last=False)
+        return loaded
+
+    def status(self):
+        return {
+            "resident": [
+                {"model_id": model_id, "last_used": last_used}
+                for model_id, last_used in self.resident.items()
+            ],
+            "loading": list(self._loading.keys()),
+            "max_resident": self.max_resident,
+            "keep_alive": self.keep_alive
+        }
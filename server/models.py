@@ -0,0 +1,99 @@
+"""
+APIで送受信するデータモデル（HTTPのレスポンスとWebSocketで配信するイベントの形式）
+
+ストアにはrecords.pyの省メモリの記録を保持し、外部へ返す時点でこれらのモデルに変換する。
+"""
+
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+class ModelInfo(BaseModel):
+    id: str
+    name: str
+    description: str
+    context_length: int
+
+class FileAttachment(BaseModel):
+    id: str
+    name: str
+    type: str
+    url: str
+    size: int
+
+class Message(BaseModel):
+    id: str
+    role: str
+    content: str
+    timestamp: datetime
+    files: Optional[List[FileAttachment]] = None
+
+class ChatSession(BaseModel):
+    id: str
+    model_id: str
+    title: str
+    created_at: datetime
+    updated_at: datetime
+
+class TaskStatus(str, Enum):
+    pending = "pending"
+    in_progress = "in_progress"
+    completed = "completed"
+    failed = "failed"
+
+class Task(BaseModel):
+    id: str
+    session_id: str
+    title: str
+    description: str
+    status: TaskStatus
+    created_at: datetime
+    updated_at: datetime
+    summary: Optional[str] = None
+    # 完了・失敗の時点でのリソース使用量
+    usage: Optional[Dict[str, Any]] = None
+
+class TaskStepStatus(str, Enum):
+    pending = "pending"
+    in_progress = "in_progress"
+    completed = "completed"
+    failed = "failed"
+
+class TaskStep(BaseModel):
+    id: str
+    task_id: str
+    title: str
+    description: str
+    status: TaskStepStatus
+    created_at: datetime
+    updated_at: datetime
+
+class AgentActionType(str, Enum):
+    command = "command"
+    file_operation = "file_operation"
+    network_request = "network_request"
+    analysis = "analysis"
+    other = "other"
+    browser = "browser"
+    file = "file"
+    notify = "notify"
+    ask = "ask"
+
+class AgentAction(BaseModel):
+    id: str
+    session_id: str
+    type: AgentActionType
+    description: str
+    details: Optional[Dict[str, Any]] = None
+    created_at: datetime
+
+class AgentState(str, Enum):
+    idle = "idle"
+    thinking = "thinking"  # 思考中の状態を追加
+    planning = "planning"
+    executing = "executing"
+    waiting_for_user = "waiting_for_user"
+    error = "error"
+    completed = "completed"
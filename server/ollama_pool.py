@@ -0,0 +1,289 @@
+"""
+複数のOllamaサーバーへリクエストを振り分けるバックエンドプールのモジュール
+
+処理中のリクエスト数が最も少ないバックエンドを選び、対象のモデルを
+ロード済みのバックエンドがあればそちらを優先する。失敗が続いたバックエンドは
+サーキットブレーカーで一時的に切り離し、ヘルスチェックで復旧を確認する。
+失敗したリクエストは別のバックエンドで再試行する。
+"""
+
+import asyncio
+import logging
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 別のバックエンドで再試行するHTTPステータス（404はモデルが存在しない場合）
+RETRYABLE_STATUS_CODES = {404, 429, 500, 502, 503, 504}
+# 再試行はするが、バックエンドの障害としては数えないHTTPステータス
+NOT_FAULT_STATUS_CODES = {404}
+
+
+class BackendError(Exception):
+    """
+    バックエンドが正常に応答しなかったことを示す例外（別のバックエンドで再試行できる）
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def normalize_model_name(model_id):
+    """
+    タグのないモデル名に既定のタグ ":latest" を付ける（/api/psの名前とモデルIDを比べるため）
+
+    "host:port/名前" のようにレジストリのポートを含む名前もあるため、最後の "/" より後だけを見る。
+    """
+    if not model_id:
+        return model_id
+    if ":" in model_id.rsplit("/", 1)[-1]:
+        return model_id
+    return f"{model_id}:latest"
+
+
+def is_backend_fault(error):
+    """
+    サーキットブレーカーで失敗として数えるエラーかどうか
+    """
+    return not (isinstance(error, BackendError) and error.status_code in NOT_FAULT_STATUS_CODES)
+
+
+class NoBackendAvailable(Exception):
+    """
+    利用できるバックエンドがない、またはすべてのバックエンドで失敗したことを示す例外
+    """
+
+
+class CircuitState:
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class OllamaBackend:
+    """
+    1台のOllamaサーバーの状態
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.loaded_models = set()
+        self.state = CircuitState.closed
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        # 半開状態で試行中のリクエストがあるかどうか
+        self._trial_in_flight = False
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "loaded_models": sorted(self.loaded_models),
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures
+        }
+
+
+class OllamaBackendPool:
+    """
+    Ollamaバックエンドの選択・失敗の記録・ヘルスチェックを行う
+    """
+
+    def __init__(self, urls, failure_threshold=3, reset_timeout=30.0, probe_interval=15.0, max_load_skew=4):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        # モデルをロード済みのバックエンドが他よりこの件数以上混んでいれば、ロード済みでなくても振り分ける
+        self.max_load_skew = max_load_skew
+        self._prober = None
+
+    @property
+    def primary_url(self):
+        return self.backends[0].url
+
+    def _selectable(self, backend, now):
+        if backend.state == CircuitState.closed:
+            return True
+        if backend.state == CircuitState.open and now - backend.opened_at >= self.reset_timeout:
+            # 一定時間経過したら半開状態にして1件だけ試す
+            backend.state = CircuitState.half_open
+            backend._trial_in_flight = False
+        return backend.state == CircuitState.half_open and not backend._trial_in_flight
+
+    def choose(self, model_id=None, exclude=()):
+        """
+        リクエストを送るバックエンドを選ぶ（なければNone）
+        """
+        now = time.monotonic()
+        candidates = [
+            backend for backend in self.backends
+            if backend.url not in exclude and self._selectable(backend, now)
+        ]
+        if not candidates:
+            return None
+        least_busy = min(candidates, key=lambda backend: backend.outstanding)
+        # 対象のモデルをロード済みのバックエンドを優先する
+        if model_id:
+            model_name = normalize_model_name(model_id)
+            loaded = [backend for backend in candidates if model_name in backend.loaded_models]
+            if loaded:
+                best_loaded = min(loaded, key=lambda backend: backend.outstanding)
+                if best_loaded.outstanding - least_busy.outstanding < self.max_load_skew:
+                    return best_loaded
+        return least_busy
+
+    def acquire(self, model_id=None, exclude=()):
+        """
+        バックエンドを選んで処理中として数える（release()で必ず解放する）
+        """
+        backend = self.choose(model_id, exclude)
+        if backend is None:
+            return None
+        backend.outstanding += 1
+        backend.total_requests += 1
+        if backend.state == CircuitState.half_open:
+            backend._trial_in_flight = True
+        return backend
+
+    def release(self, backend, success, model_id=None):
+        """
+        リクエストの終了を記録する（successがNoneの場合は成否を記録しない）
+        """
+        backend.outstanding -= 1
+        backend._trial_in_flight = False
+        if success is None:
+            return
+        if success:
+            self._record_success(backend)
+            if model_id:
+                backend.loaded_models.add(normalize_model_name(model_id))
+        else:
+            self._record_failure(backend)
+
+    def _record_success(self, backend):
+        backend.consecutive_failures = 0
+        if backend.state != CircuitState.closed:
+            logger.info("Ollamaバックエンドが復旧しました: %s", backend.url)
+        backend.state = CircuitState.closed
+
+    def _record_failure(self, backend):
+        """
+        失敗を数え、連続した失敗が閾値に達した（または半開状態で失敗した）バックエンドを切り離す
+        """
+        backend.consecutive_failures += 1
+        backend.total_failures += 1
+        if backend.state == CircuitState.half_open or backend.consecutive_failures >= self.failure_threshold:
+            if backend.state != CircuitState.open:
+                logger.warning("Ollamaバックエンドを切り離します: %s", backend.url)
+            backend.state = CircuitState.open
+            backend.opened_at = time.monotonic()
+
+    async def call_backend(self, backend, fn, model_id=None):
+        """
+        指定したバックエンドでfn(backend)を実行し、成否を記録する（再試行はしない）
+        """
+        backend.outstanding += 1
+        backend.total_requests += 1
+        try:
+            result = await fn(backend)
+        except (httpx.TransportError, BackendError) as e:
+            self.release(backend, False if is_backend_fault(e) else None)
+            raise
+        except BaseException:
+            self.release(backend, None)
+            raise
+        self.release(backend, True, model_id)
+        return result
+
+    async def call(self, model_id, fn):
+        """
+        バックエンドを選んでfn(backend)を実行し、失敗した場合は別のバックエンドで再試行する
+
+        fnはhttpx.TransportErrorまたはBackendErrorで再試行可能な失敗を示す。
+        """
+        tried = set()
+        last_error = None
+        for _ in range(len(self.backends)):
+            backend = self.acquire(model_id, exclude=tried)
+            if backend is None:
+                break
+            tried.add(backend.url)
+            try:
+                result = await fn(backend)
+            except (httpx.TransportError, BackendError) as e:
+                self.release(backend, False if is_backend_fault(e) else None)
+                last_error = e
+                logger.warning("Ollamaバックエンドでの処理に失敗しました: %s - %s", backend.url, e)
+                continue
+            except BaseException:
+                self.release(backend, None)
+                raise
+            self.release(backend, True, model_id)
+            return result
+        if last_error is not None:
+            raise NoBackendAvailable(f"すべてのOllamaバックエンドで失敗しました: {str(last_error)}") from last_error
+        raise NoBackendAvailable("利用可能なOllamaバックエンドがありません")
+
+    def mark_unloaded(self, model_id):
+        model_name = normalize_model_name(model_id)
+        for backend in self.backends:
+            backend.loaded_models.discard(model_name)
+
+    async def probe(self, backend):
+        """
+        バックエンドの死活とロード済みモデルを確認する
+        """
+        try:
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                response = await client.get(f"{backend.url}/api/ps")
+            if response.status_code >= 500:
+                raise BackendError(f"HTTPエラー: {response.status_code}", response.status_code)
+            # /api/psに対応していないサーバーは応答があれば稼働中とみなす
+            if response.status_code == 200:
+                backend.loaded_models = {
+                    normalize_model_name(model.get("name")) for model in response.json().get("models", [])
+                    if model.get("name")
+                }
+            self._record_success(backend)
+            return True
+        except (httpx.HTTPError, BackendError, ValueError) as e:
+            if backend.state != CircuitState.open:
+                logger.warning("Ollamaバックエンドのヘルスチェックに失敗しました: %s - %s", backend.url, e)
+            # 1回の失敗ですぐには切り離さず、リクエストの失敗と同じく連続した失敗として数える
+            self._record_failure(backend)
+            return False
+
+    async def probe_all(self):
+        return await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+
+    def start(self):
+        """
+        定期的なヘルスチェックを開始する
+        """
+        if self.probe_interval > 0 and (self._prober is None or self._prober.done()):
+            self._prober = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._prober is not None:
+            self._prober.cancel()
+            self._prober = None
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.exception("Ollamaバックエンドのヘルスチェック中にエラーが発生しました: %s", e)
+
+    def status(self):
+        return [backend.to_dict() for backend in self.backends]
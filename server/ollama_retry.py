@@ -0,0 +1,181 @@
+"""
+Ollamaへのリクエストの失敗を分類し、再試行と期限を管理するモジュール
+
+失敗は「再試行すれば成功しうるもの（過負荷・接続失敗・タイムアウト）」と
+「再試行しても変わらないもの（不正なリクエスト・存在しないモデル）」に分け、
+前者のみジッター付きの指数バックオフで再試行する。エージェントの処理全体の
+期限はコンテキスト変数で引き継ぎ、個々のリクエストのタイムアウトや
+再試行前の待機が期限を超えないようにする。
+"""
+
+import asyncio
+import contextvars
+import logging
+import random
+import time
+
+import httpx
+
+from ollama_pool import BackendError, NoBackendAvailable, NOT_FAULT_STATUS_CODES
+
+logger = logging.getLogger(__name__)
+
+# 再試行する価値があるHTTPステータス（過負荷・一時的な障害）
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class OllamaError(Exception):
+    """
+    Ollamaとの通信に失敗したことを示す例外
+    """
+    kind = "error"
+    retryable = False
+
+
+class OllamaUnavailableError(OllamaError):
+    """
+    Ollamaが過負荷・停止中・応答しないなど、時間をおけば成功しうる失敗
+    """
+    kind = "unavailable"
+    retryable = True
+
+
+class OllamaRequestError(OllamaError):
+    """
+    不正なリクエストや存在しないモデルなど、再試行しても成功しない失敗
+    """
+    kind = "request"
+
+
+class OllamaOutputError(OllamaError):
+    """
+    モデルの出力が期待した形式でなかったことを示す例外
+    """
+    kind = "output"
+
+
+class DeadlineExceeded(OllamaError):
+    """
+    エージェントの処理全体の期限を過ぎたことを示す例外
+    """
+    kind = "deadline"
+
+
+def error_from_kind(kind, detail):
+    """
+    種類（OllamaError.kind）から例外を作る（記録した失敗の再生に使う）
+    """
+    for error_type in (OllamaUnavailableError, OllamaRequestError, OllamaOutputError, DeadlineExceeded):
+        if error_type.kind == kind:
+            return error_type(detail)
+    return OllamaError(detail)
+
+
+def error_from_status(status_code, detail):
+    if status_code in TRANSIENT_STATUS_CODES:
+        return OllamaUnavailableError(detail)
+    return OllamaRequestError(detail)
+
+
+def error_from_exception(error):
+    """
+    httpxやバックエンドプールの例外を分類済みの例外に変換する
+    """
+    if isinstance(error, OllamaError):
+        return error
+    if isinstance(error, NoBackendAvailable):
+        cause = error.__cause__
+        # すべてのバックエンドにモデルがなかった場合は再試行しない
+        if isinstance(cause, BackendError) and cause.status_code in NOT_FAULT_STATUS_CODES:
+            return OllamaRequestError(str(error))
+        return OllamaUnavailableError(str(error))
+    if isinstance(error, BackendError):
+        return error_from_status(error.status_code, str(error))
+    if isinstance(error, httpx.TimeoutException):
+        return OllamaUnavailableError(f"タイムアウトエラー: {str(error)}")
+    if isinstance(error, httpx.TransportError):
+        return OllamaUnavailableError(f"リクエストエラー: {str(error)}")
+    return OllamaError(str(error))
+
+
+class Deadline:
+    """
+    処理全体の期限（secondsが0以下またはNoneなら期限なし）
+    """
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds if seconds and seconds > 0 else None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+
+# 現在のエージェントの処理の期限（asyncioのタスクにも引き継がれる）
+current_deadline = contextvars.ContextVar("ollama_deadline", default=None)
+
+
+def request_timeout(default):
+    """
+    期限までの残り時間で切り詰めたリクエストのタイムアウトを返す
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    remaining = deadline.remaining()
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise DeadlineExceeded("タスクの制限時間を超えました")
+    return min(default, remaining)
+
+
+class RetryPolicy:
+    """
+    再試行の回数と、ジッター付き指数バックオフの待機時間
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """
+        attempt回目の失敗後の待機時間（0から上限までの一様乱数、いわゆるフルジッター）
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def should_retry(self, error, attempt):
+        return error.retryable and attempt < self.max_attempts
+
+    async def backoff(self, attempt):
+        """
+        再試行前に待機する（期限までに再試行できない場合はDeadlineExceededを送出する）
+        """
+        delay = self.delay(attempt)
+        deadline = current_deadline.get()
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None and remaining <= delay:
+            raise DeadlineExceeded("タスクの制限時間内に再試行できません")
+        await asyncio.sleep(delay)
+
+    async def run(self, fn):
+        """
+        fn()を実行し、再試行できる失敗の場合は待機してから再試行する
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await fn()
+            except OllamaError as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                logger.info("Ollamaへのリクエストを再試行します（%d/%d）: %.200s", attempt, self.max_attempts - 1, e)
+                await self.backoff(attempt)
@@ -0,0 +1,110 @@
+"""
+セッションごとのOllamaとの会話状態を保持するモジュール
+
+/api/chatに同じメッセージ列を先頭に付けて送ると、モデルがロードされたままなら
+Ollama側でプロンプトの共通部分のKVキャッシュが再利用され、システムプロンプトや
+過去のやり取りを毎回評価し直さずに済む。ここではセッションごとのメッセージ列を
+上限付きで保持し、モデルの変更やアイドル時間の経過で破棄する。
+
+上限を超えたときに古いやり取りを1つずつ削除すると、以降の呼び出しのたびに先頭が変わって
+キャッシュが使えなくなるため、直近のやり取りだけを残して会話を一度に作り直す。
+作り直した後は再び末尾に追加していくだけなので、次に上限を超えるまで先頭は変わらない。
+"""
+
+import time
+from collections import OrderedDict
+
+from tokens import estimate_tokens
+
+
+class OllamaConversation:
+    """
+    1セッション分の会話（システムプロンプトとユーザー・アシスタントのやり取り）
+    """
+
+    def __init__(self, model_id, system_prompt):
+        self.model_id = model_id
+        self.system_prompt = system_prompt
+        self.turns = []
+        self.tokens = 0
+        self.last_used = time.monotonic()
+        # 上限を超えて作り直した回数
+        self.resets = 0
+
+    def messages(self, prompt):
+        """
+        新しいプロンプトを末尾に付けた/api/chat用のメッセージ列を返す
+        """
+        messages = [{"role": "system", "content": self.system_prompt}]
+        for user, assistant in self.turns:
+            messages.append({"role": "user", "content": user})
+            messages.append({"role": "assistant", "content": assistant})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def add_turn(self, prompt, response):
+        self.turns.append((prompt, response))
+        self.tokens += estimate_tokens(prompt) + estimate_tokens(response)
+        self.last_used = time.monotonic()
+
+    def trim(self, max_tokens, max_turns):
+        """
+        上限を超えた場合は直近のやり取りだけを残して会話を作り直す（収まらなければ空にする）
+        """
+        if len(self.turns) <= max_turns and self.tokens <= max_tokens:
+            return
+        prompt, response = self.turns[-1]
+        tokens = estimate_tokens(prompt) + estimate_tokens(response)
+        if max_turns >= 1 and tokens <= max_tokens // 2:
+            self.turns = [(prompt, response)]
+            self.tokens = tokens
+        else:
+            self.turns = []
+            self.tokens = 0
+        self.resets += 1
+
+
+class OllamaSessionStore:
+    """
+    セッションIDごとの会話を、セッション数・トークン数・アイドル時間の上限付きで保持する
+    """
+
+    def __init__(self, max_sessions=100, max_tokens=4000, max_turns=8, ttl=1800):
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.conversations = OrderedDict()
+
+    def get(self, session_id, model_id, system_prompt):
+        """
+        セッションの会話を取得する（モデルやシステムプロンプトが変わった場合は作り直す）
+        """
+        self._evict_expired()
+        conversation = self.conversations.get(session_id)
+        if conversation is None or conversation.model_id != model_id or conversation.system_prompt != system_prompt:
+            conversation = OllamaConversation(model_id, system_prompt)
+            self.conversations[session_id] = conversation
+        self.conversations.move_to_end(session_id)
+        # 最も長く使われていない会話から破棄する
+        while len(self.conversations) > self.max_sessions:
+            self.conversations.popitem(last=False)
+        return conversation
+
+    def record(self, session_id, conversation, prompt, response):
+        """
+        やり取りを会話に追加する（途中で破棄・作り直しされた会話には追加しない）
+        """
+        if self.conversations.get(session_id) is not conversation:
+            return
+        conversation.add_turn(prompt, response)
+        conversation.trim(self.max_tokens, self.max_turns)
+
+    def invalidate(self, session_id):
+        self.conversations.pop(session_id, None)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for session_id, conversation in list(self.conversations.items()):
+            if now - conversation.last_used > self.ttl:
+                del self.conversations[session_id]
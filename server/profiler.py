@@ -0,0 +1,201 @@
+"""
+動作中のサーバーのサンプリングプロファイラーと、イベントループの停止の監視
+
+SamplingProfiler は指定した時間だけ、全スレッドの実行中のスタックと、
+イベントループ上のタスクが待っている処理（awaitの連なり）を一定間隔で記録し、
+flamegraph.pl や speedscope で読める collapsed 形式（1行に「スタック 回数」）で返す。
+
+LoopLagMonitor はイベントループが一定時間以上応答しなくなったことを別スレッドで
+検知し、その間にループのスレッドが実行していた呼び出し（同期的なサブプロセスの
+起動やファイルI/Oなど）をログに出す。
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_stack(frame):
+    """
+    フレームから呼び出し元をたどり、外側から順のラベルのリストを返す
+    """
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def await_stack(coro):
+    """
+    コルーチンからawaitしている先をたどり、外側から順のラベルのリストを返す
+    """
+    labels = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            if isinstance(coro, asyncio.Future):
+                labels.append(f"<{type(coro).__name__}>")
+            break
+        labels.append(frame_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return labels
+
+
+def describe_stack(frame, limit=8):
+    """
+    ログ用に、実行中の位置から呼び出し元へ向かって数フレームを行番号付きで並べる
+    """
+    parts = []
+    while frame is not None and len(parts) < limit:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return " <- ".join(parts)
+
+
+class SamplingProfiler:
+    """
+    一定時間のサンプリングでスタックごとの出現回数を数える（同時に1つまで）
+    """
+
+    def __init__(self, max_seconds=60.0):
+        self.max_seconds = max_seconds
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    async def profile(self, seconds, interval=0.005, include_threads=True, include_tasks=True):
+        """
+        seconds秒間サンプリングし、collapsed形式のテキストを返す
+
+        スレッドのスタックは別スレッドから記録するため、イベントループが止まっている間の
+        呼び出しも記録される。タスクの待ち先はループ上で記録するため、ループが止まっている
+        間は記録されない。
+        """
+        seconds = min(max(seconds, 0.1), self.max_seconds)
+        interval = max(interval, 0.001)
+        async with self._lock:
+            counts = Counter()
+            stop = threading.Event()
+            sampler = None
+            if include_threads:
+                sampler = threading.Thread(
+                    target=self._sample_threads, args=(counts, interval, stop), name="profiler", daemon=True
+                )
+                sampler.start()
+            try:
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    if include_tasks:
+                        self._sample_tasks(counts)
+                    await asyncio.sleep(max(interval, 0.01))
+            finally:
+                stop.set()
+                if sampler is not None:
+                    await asyncio.to_thread(sampler.join)
+            return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    def _sample_threads(self, counts, interval, stop):
+        names = {}
+        own_id = threading.get_ident()
+        while not stop.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                name = names.get(thread_id)
+                if name is None:
+                    thread = next((t for t in threading.enumerate() if t.ident == thread_id), None)
+                    name = names[thread_id] = thread.name if thread is not None else str(thread_id)
+                counts[";".join([f"thread:{name}"] + thread_stack(frame))] += 1
+            stop.wait(interval)
+
+    def _sample_tasks(self, counts):
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is current or task.done():
+                continue
+            stack = await_stack(task.get_coro())
+            if stack:
+                counts[";".join(["task"] + stack)] += 1
+
+
+class LoopLagMonitor:
+    """
+    イベントループの停止を検知し、その間に実行されていた呼び出しをログに出す
+
+    ループ上のタスクが interval ごとに時刻を更新し、監視スレッドが更新の途絶えを
+    threshold 秒以上検知した時点のループのスレッドのスタックを記録する。ループが
+    再開した時点で停止していた時間とともにログに出す。
+    """
+
+    def __init__(self, threshold=0.1, interval=0.05, on_lag=None):
+        self.threshold = threshold
+        self.interval = interval
+        # 1回ごとの遅延（秒）を受け取るコールバック（メトリクス用）
+        self.on_lag = on_lag
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._blocked = None
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.threshold <= 0 or self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self._watchdog.join)
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            if self.on_lag is not None:
+                self.on_lag(lag)
+            blocked, self._blocked = self._blocked, None
+            if blocked is not None and lag >= self.threshold:
+                self.stalls += 1
+                logger.warning("イベントループが%.3f秒停止していました。実行中の呼び出し: %s", lag, blocked)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            if self._blocked is not None or time.monotonic() - self._beat < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._blocked = describe_stack(frame)
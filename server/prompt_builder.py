@@ -0,0 +1,216 @@
+"""
+モデルのコンテキスト長に合わせてプロンプトを組み立てるモジュール
+
+プロンプトを優先度付きのセクションに分け、概算トークン数で予算を配分する。
+会話履歴は新しいものから予算の範囲で含め、古い履歴はセッションごとに
+キャッシュした要約（ローリングサマリー）に置き換える。
+"""
+
+import asyncio
+import logging
+
+from tokens import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# 切り詰めてまで含める意味がないセクションの最小トークン数
+MIN_SECTION_TOKENS = 32
+
+ROLE_LABELS = {
+    "user": "ユーザー",
+    "assistant": "アシスタント",
+    "system": "システム",
+}
+
+
+class PromptSection:
+    def __init__(self, text, priority=0, required=False):
+        self.text = text
+        self.priority = priority
+        self.required = required
+
+
+class PromptBuilder:
+    """
+    優先度の高いセクションから順に予算を割り当ててプロンプトを組み立てる
+    """
+
+    def __init__(self, context_length, reserved_tokens=0):
+        # 出力用とシステムプロンプト用の分を差し引いた入力の予算
+        self.budget = max(0, context_length - reserved_tokens)
+        self.sections = []
+
+    def add(self, text, priority=0, required=False):
+        """
+        セクションを追加する（requiredのセクションは予算を超えても切り詰めて必ず含める）
+        """
+        if text:
+            self.sections.append(PromptSection(text, priority, required))
+        return self
+
+    def used_tokens(self):
+        return sum(estimate_tokens(section.text) for section in self.sections if section.required)
+
+    def remaining_tokens(self):
+        """
+        必須セクションを含めた後に残る予算
+        """
+        return max(0, self.budget - self.used_tokens())
+
+    def build(self):
+        """
+        予算内に収まるようにセクションを選択・切り詰めて、追加した順に連結する
+        """
+        remaining = self.budget
+        allocated = {}
+        # 必須セクションを先に、その後は優先度の高い順に割り当てる
+        order = sorted(
+            range(len(self.sections)),
+            key=lambda i: (not self.sections[i].required, -self.sections[i].priority, i)
+        )
+        for i in order:
+            section = self.sections[i]
+            cost = estimate_tokens(section.text)
+            if cost <= remaining:
+                allocated[i] = section.text
+                remaining -= cost
+            elif section.required or remaining >= MIN_SECTION_TOKENS:
+                allocated[i] = truncate_to_tokens(section.text, remaining)
+                remaining = 0
+        return "\n".join(allocated[i] for i in range(len(self.sections)) if i in allocated)
+
+
+def allocate_evenly(texts, budget):
+    """
+    複数のテキストに予算を公平に配分し、それぞれを切り詰める
+
+    短いテキストはそのまま残し、余った予算を長いテキストで均等に分け合う。
+    """
+    costs = [estimate_tokens(text) for text in texts]
+    limits = [0] * len(texts)
+    pending = sorted(range(len(texts)), key=lambda i: costs[i])
+    remaining = budget
+    while pending:
+        share = remaining // len(pending)
+        i = pending[0]
+        if costs[i] <= share:
+            limits[i] = costs[i]
+            remaining -= costs[i]
+            pending.pop(0)
+        else:
+            for j in pending:
+                limits[j] = share
+            break
+    return [
+        text if costs[i] <= limits[i] else truncate_to_tokens(text, limits[i])
+        for i, text in enumerate(texts)
+    ]
+
+
+def format_message(message, max_tokens=None):
+    """
+    会話履歴の1メッセージを「役割: 内容」の形式にする
+    """
+    content = message.content
+    if max_tokens is not None and estimate_tokens(content) > max_tokens:
+        content = truncate_to_tokens(content, max_tokens) + "..."
+    return f"{ROLE_LABELS.get(message.role, message.role)}: {content}"
+
+
+class HistoryCompactor:
+    """
+    セッションごとの会話履歴を、直近のメッセージと古いメッセージの要約にまとめる
+    """
+
+    def __init__(self, max_message_tokens=300):
+        # 履歴中の1メッセージあたりの最大トークン数
+        self.max_message_tokens = max_message_tokens
+        # セッションID -> {"summary": 要約, "covered": 要約済みのメッセージ数}
+        self.summaries = {}
+        self._locks = {}
+        self._pending = set()
+
+    def build_history(self, session_id, messages, budget):
+        """
+        予算内の会話履歴テキストと、要約が追いついていないかどうかを返す
+
+        新しいメッセージから順に含め、入りきらない古いメッセージは
+        キャッシュ済みの要約で置き換える。要約されていないまま溢れた
+        メッセージがある場合は needs_compaction が True になる。
+        """
+        state = self.summaries.get(session_id, {"summary": "", "covered": 0})
+        summary_text = f"これまでの会話の要約: {state['summary']}" if state["summary"] else ""
+        remaining = budget - estimate_tokens(summary_text)
+
+        lines = []
+        oldest = len(messages)
+        for index in range(len(messages) - 1, state["covered"] - 1, -1):
+            line = format_message(messages[index], self.max_message_tokens)
+            cost = estimate_tokens(line) + 1
+            if cost > remaining:
+                break
+            lines.append(line)
+            remaining -= cost
+            oldest = index
+        lines.reverse()
+
+        needs_compaction = oldest > state["covered"]
+        parts = ([summary_text] if summary_text else []) + lines
+        return "\n".join(parts), needs_compaction
+
+    def schedule_compaction(self, session_id, messages, keep_recent, summarize, chunk_tokens=None):
+        """
+        古いメッセージの要約をバックグラウンドで更新する
+
+        summarizeは (これまでの要約, 新たに要約するメッセージのテキスト) を受け取り、
+        新しい要約を返すコルーチン関数。chunk_tokensを指定すると、要約するメッセージを
+        その量ずつに分けて順に要約に取り込む（1回のプロンプトがコンテキスト長を超えないように）。
+        """
+        if session_id in self._pending:
+            return
+        self._pending.add(session_id)
+        asyncio.create_task(self._compact(session_id, list(messages), keep_recent, summarize, chunk_tokens))
+
+    def _chunks(self, lines, chunk_tokens):
+        chunk, used = [], 0
+        for line in lines:
+            cost = estimate_tokens(line) + 1
+            if chunk and chunk_tokens is not None and used + cost > chunk_tokens:
+                yield chunk
+                chunk, used = [], 0
+            chunk.append(line)
+            used += cost
+        if chunk:
+            yield chunk
+
+    async def _compact(self, session_id, messages, keep_recent, summarize, chunk_tokens=None):
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        try:
+            async with lock:
+                state = self.summaries.get(session_id, {"summary": "", "covered": 0})
+                # 直近keep_recent件を残して、それより古い未要約のメッセージを要約に取り込む
+                upto = max(state["covered"], len(messages) - keep_recent)
+                if upto <= state["covered"]:
+                    return
+                lines = [
+                    format_message(message, self.max_message_tokens)
+                    for message in messages[state["covered"]:upto]
+                ]
+                covered = state["covered"]
+                summary = state["summary"]
+                for chunk in self._chunks(lines, chunk_tokens):
+                    summary = await summarize(summary, "\n".join(chunk))
+                    if not summary:
+                        return
+                    # 途中で失敗しても取り込めた分は残す（要約中にセッションが削除されたら書き戻さない）
+                    covered += len(chunk)
+                    if session_id in self._locks:
+                        self.summaries[session_id] = {"summary": summary, "covered": covered}
+        except Exception as e:
+            logger.exception("会話履歴の要約中にエラーが発生しました: %s", e)
+        finally:
+            self._pending.discard(session_id)
+
+    def invalidate(self, session_id):
+        self.summaries.pop(session_id, None)
+        self._locks.pop(session_id, None)
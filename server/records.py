@@ -0,0 +1,188 @@
+"""
+ストアに保持するメッセージ・タスク・ステップ・アクションの省メモリの記録
+
+Pydanticのモデルはインスタンスごとに辞書を持ち、IDを36文字の文字列、日時をdatetimeで
+保持するため、セッションの履歴が長くなるとメモリの大半を占める。記録は __slots__ で
+属性を固定し、UUIDのIDを16バイト、日時を1970年1月1日からのマイクロ秒の整数で持つ。
+状態や送信者のように種類の限られた値は列挙型のメンバーや共有した文字列を参照する。
+
+属性は元のモデルと同じ名前・型で読み書きできる（IDは文字列、日時はdatetimeに変換する）。
+HTTPのレスポンスやWebSocketで配信する時点で to_model() / to_json() でモデルに変換する。
+"""
+
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+from models import AgentAction, Message, Task, TaskStep
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def pack_id(value):
+    """
+    UUIDの文字列は16バイトにする（UUIDでなければ文字列のまま）
+    """
+    if isinstance(value, str) and len(value) == 36:
+        try:
+            packed = uuid.UUID(value)
+        except ValueError:
+            return value
+        if str(packed) == value:
+            return packed.bytes
+    return value
+
+
+def unpack_id(value):
+    return str(uuid.UUID(bytes=value)) if isinstance(value, bytes) else value
+
+
+def to_micros(value):
+    # タイムゾーン付きの日時はローカル時刻に揃える（ストアの日時はdatetime.now()）
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def from_micros(value):
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def id_property(slot):
+    return property(
+        lambda self: unpack_id(getattr(self, slot)),
+        lambda self, value: setattr(self, slot, pack_id(value))
+    )
+
+
+def time_property(slot):
+    return property(
+        lambda self: from_micros(getattr(self, slot)),
+        lambda self, value: setattr(self, slot, to_micros(value))
+    )
+
+
+class Record:
+    """
+    記録の共通の変換処理（model にAPIのモデルを指定する）
+    """
+
+    __slots__ = ()
+    model = None
+
+    def fields(self):
+        raise NotImplementedError
+
+    def to_model(self):
+        # 記録の値は作成時に型が揃っているため検証を省く
+        return self.model.model_construct(**self.fields())
+
+    def to_json(self):
+        return self.to_model().model_dump(mode="json")
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(**dict(model))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_model(cls.model(**data))
+
+
+class MessageRecord(Record):
+    __slots__ = ("_id", "role", "content", "_timestamp", "files")
+    model = Message
+
+    id = id_property("_id")
+    timestamp = time_property("_timestamp")
+
+    def __init__(self, id, role, content, timestamp, files=None):
+        self.id = id
+        self.role = sys.intern(role)
+        self.content = content
+        self.timestamp = timestamp
+        self.files = files
+
+    def fields(self):
+        return {
+            "id": self.id, "role": self.role, "content": self.content,
+            "timestamp": self.timestamp, "files": self.files
+        }
+
+
+class TaskRecord(Record):
+    __slots__ = ("_id", "session_id", "title", "description", "status", "_created_at", "_updated_at", "summary", "usage")
+    model = Task
+
+    id = id_property("_id")
+    created_at = time_property("_created_at")
+    updated_at = time_property("_updated_at")
+
+    def __init__(self, id, session_id, title, description, status, created_at, updated_at, summary=None, usage=None):
+        self.id = id
+        self.session_id = sys.intern(session_id)
+        self.title = title
+        self.description = description
+        self.status = status
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.summary = summary
+        self.usage = usage
+
+    def fields(self):
+        return {
+            "id": self.id, "session_id": self.session_id, "title": self.title,
+            "description": self.description, "status": self.status,
+            "created_at": self.created_at, "updated_at": self.updated_at,
+            "summary": self.summary, "usage": self.usage
+        }
+
+
+class TaskStepRecord(Record):
+    __slots__ = ("_id", "_task_id", "title", "description", "status", "_created_at", "_updated_at")
+    model = TaskStep
+
+    id = id_property("_id")
+    task_id = id_property("_task_id")
+    created_at = time_property("_created_at")
+    updated_at = time_property("_updated_at")
+
+    def __init__(self, id, task_id, title, description, status, created_at, updated_at):
+        self.id = id
+        self.task_id = task_id
+        self.title = title
+        self.description = description
+        self.status = status
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def fields(self):
+        return {
+            "id": self.id, "task_id": self.task_id, "title": self.title,
+            "description": self.description, "status": self.status,
+            "created_at": self.created_at, "updated_at": self.updated_at
+        }
+
+
+class AgentActionRecord(Record):
+    __slots__ = ("_id", "session_id", "type", "description", "details", "_created_at")
+    model = AgentAction
+
+    id = id_property("_id")
+    created_at = time_property("_created_at")
+
+    def __init__(self, id, session_id, type, description, created_at, details=None):
+        self.id = id
+        self.session_id = sys.intern(session_id)
+        self.type = type
+        self.description = description
+        self.details = details
+        self.created_at = created_at
+
+    def fields(self):
+        return {
+            "id": self.id, "session_id": self.session_id, "type": self.type,
+            "description": self.description, "details": self.details,
+            "created_at": self.created_at
+        }
@@ -0,0 +1,408 @@
+"""
+シェルコマンドをリソース制限付きで実行するためのモジュール
+
+エージェントのコマンドはサーバーと同じプロセスツリーで動くため、
+暴走したビルドやフォーク爆弾がAPIや他のセッションを巻き込まないよう、
+rlimit（CPU時間・アドレス空間・ファイルサイズ・オープンファイル数・プロセス数）と、
+利用可能であればcgroup v2（メモリ・CPU帯域・プロセス数）で制限をかける。
+"""
+
+import logging
+import math
+import os
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:
+    # Windowsではrlimitを利用できない
+    resource = None
+
+# timeoutが未指定・不正な場合に使うコマンドの実行時間の上限（秒）
+DEFAULT_TIMEOUT = float(os.environ.get("SHELL_COMMAND_TIMEOUT", "300"))
+
+CGROUP_V2_MOUNT = "/sys/fs/cgroup"
+CGROUP_CONTROLLERS = ("cpu", "memory", "pids")
+
+
+class ResourceLimits:
+    """
+    1コマンドあたりのリソース制限値（0以下は無制限）
+    """
+
+    def __init__(self, cpu_seconds=0, memory_mb=0, open_files=0, max_processes=0, cpu_quota=0.0, file_size_mb=0):
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        # 1ファイルあたりの最大サイズ（ワークスペースのクォータはコマンドの終了後にしか確認できないため）
+        self.file_size_mb = file_size_mb
+        self.open_files = open_files
+        self.max_processes = max_processes
+        # cgroupで割り当てるCPUコア数（例: 1.0 = 1コア分）
+        self.cpu_quota = cpu_quota
+
+    @classmethod
+    def from_env(cls):
+        """
+        環境変数から制限値を読み込む
+        """
+        return cls(
+            cpu_seconds=int(os.environ.get("SANDBOX_CPU_SECONDS", "120")),
+            memory_mb=int(os.environ.get("SANDBOX_MEMORY_MB", "2048")),
+            open_files=int(os.environ.get("SANDBOX_OPEN_FILES", "1024")),
+            max_processes=int(os.environ.get("SANDBOX_MAX_PROCESSES", "256")),
+            cpu_quota=float(os.environ.get("SANDBOX_CPU_QUOTA", "1.0")),
+            file_size_mb=int(os.environ.get("SANDBOX_FILE_SIZE_MB", "0"))
+        )
+
+    def to_dict(self):
+        return {
+            "cpu_seconds": self.cpu_seconds,
+            "memory_mb": self.memory_mb,
+            "open_files": self.open_files,
+            "max_processes": self.max_processes,
+            "cpu_quota": self.cpu_quota,
+            "file_size_mb": self.file_size_mb
+        }
+
+
+def parse_timeout(value, maximum=DEFAULT_TIMEOUT):
+    """
+    コマンドのタイムアウトを (0, maximum] の秒数にする（数値でない・0以下・未指定ならmaximum）
+
+    LLMが指定した値（"30" などの文字列を含む）もそのまま受け取るため、実行を始める前に必ず通す。
+    """
+    if isinstance(value, bool):
+        return float(maximum)
+    try:
+        value = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return float(maximum)
+    if not math.isfinite(value) or value <= 0:
+        return float(maximum)
+    return min(value, float(maximum))
+
+
+def _set_rlimit(kind, value):
+    _, hard = resource.getrlimit(kind)
+    # ハードリミットを超える値は設定できないため、小さい方に揃える
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(kind, (value, hard))
+
+
+def current_thread_count():
+    """
+    このプロセスのスレッド数（RLIMIT_NPROCの基準にする）
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return threading.active_count()
+
+
+def apply_rlimits(limits, max_processes=None):
+    """
+    現在のプロセスにrlimitを設定する（子プロセスのpreexec_fnから呼ぶ）
+
+    RLIMIT_NPROCはユーザー単位の制限で、サーバー自身のスレッドやプロセスも数に含まれる
+    （rootでは効かない）。そのためmax_processesには、起動時点のスレッド数を足した値を
+    呼び出し側で求めて渡す（Noneの場合は設定しない）。
+    """
+    if resource is None:
+        return
+    if limits.cpu_seconds > 0:
+        _set_rlimit(resource.RLIMIT_CPU, limits.cpu_seconds)
+    if limits.memory_mb > 0:
+        _set_rlimit(resource.RLIMIT_AS, limits.memory_mb * 1024 * 1024)
+    if limits.file_size_mb > 0:
+        _set_rlimit(resource.RLIMIT_FSIZE, limits.file_size_mb * 1024 * 1024)
+        # 上限を超えた書き込みでシェルごと終了しないよう、SIGXFSZを無視してEFBIGで失敗させる
+        signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    if limits.open_files > 0:
+        _set_rlimit(resource.RLIMIT_NOFILE, limits.open_files)
+    if max_processes is not None and max_processes > 0:
+        _set_rlimit(resource.RLIMIT_NPROC, max_processes)
+
+
+class Cgroup:
+    """
+    コマンド（または常駐シェル）ごとに作成するcgroup v2のグループ
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(value)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name), "r") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def configure(self, limits):
+        if limits.memory_mb > 0:
+            self._write("memory.max", str(limits.memory_mb * 1024 * 1024))
+            if os.path.exists(os.path.join(self.path, "memory.swap.max")):
+                self._write("memory.swap.max", "0")
+        if limits.max_processes > 0:
+            self._write("pids.max", str(limits.max_processes))
+        if limits.cpu_quota > 0:
+            period = 100000
+            self._write("cpu.max", f"{int(limits.cpu_quota * period)} {period}")
+
+    def enter(self):
+        """
+        現在のプロセスをこのグループへ移動する（子プロセスのpreexec_fnから呼ぶ）
+        """
+        self._write("cgroup.procs", "0")
+
+    def usage(self):
+        """
+        グループ全体のCPU時間・メモリ使用量のピーク・プロセス数のピークを返す
+        """
+        stats = {}
+        cpu_stat = self._read("cpu.stat")
+        if cpu_stat:
+            for line in cpu_stat.splitlines():
+                key, _, value = line.partition(" ")
+                if key in ("usage_usec", "user_usec", "system_usec", "nr_throttled"):
+                    stats[f"cgroup_{key}"] = int(value)
+        for name in ("memory.peak", "pids.peak"):
+            value = self._read(name)
+            if value and value.strip().isdigit():
+                stats["cgroup_" + name.replace(".", "_")] = int(value)
+        events = self._read("memory.events")
+        if events:
+            for line in events.splitlines():
+                key, _, value = line.partition(" ")
+                if key == "oom_kill" and int(value) > 0:
+                    stats["cgroup_oom_kill"] = int(value)
+        return stats
+
+    def destroy(self):
+        """
+        グループ内の残存プロセスを終了してグループを削除する
+        """
+        try:
+            if os.path.exists(os.path.join(self.path, "cgroup.kill")):
+                self._write("cgroup.kill", "1")
+            else:
+                procs = self._read("cgroup.procs") or ""
+                for pid in procs.split():
+                    try:
+                        os.kill(int(pid), signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+            # プロセスがいなくなるまで少し待ってから削除する
+            for _ in range(50):
+                try:
+                    os.rmdir(self.path)
+                    return
+                except OSError:
+                    time.sleep(0.02)
+        except OSError as e:
+            logger.warning("cgroupの削除に失敗しました: %s - %s", self.path, e)
+
+
+class CgroupManager:
+    """
+    cgroup v2が利用可能な場合に、委譲されたディレクトリ配下にグループを作成する
+    """
+
+    def __init__(self, root=None):
+        self.root = root or os.environ.get("SANDBOX_CGROUP_ROOT", os.path.join(CGROUP_V2_MOUNT, "manus"))
+        self._available = None
+
+    @property
+    def available(self):
+        if self._available is None:
+            self._available = self._setup()
+        return self._available
+
+    def _setup(self):
+        if os.environ.get("SANDBOX_CGROUP_ENABLED", "1") != "1":
+            return False
+        if not os.path.exists(os.path.join(CGROUP_V2_MOUNT, "cgroup.controllers")):
+            return False
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, "cgroup.controllers"), "r") as f:
+                controllers = f.read().split()
+            enable = " ".join(f"+{c}" for c in CGROUP_CONTROLLERS if c in controllers)
+            if enable:
+                with open(os.path.join(self.root, "cgroup.subtree_control"), "w") as f:
+                    f.write(enable)
+            return True
+        except OSError as e:
+            logger.warning("cgroup v2を利用できないため、rlimitのみで制限します: %s", e)
+            return False
+
+    def create(self, limits, name=None):
+        """
+        制限値を設定したグループを作成する（利用できない場合はNone）
+        """
+        if not self.available:
+            return None
+        group = Cgroup(os.path.join(self.root, name or uuid.uuid4().hex))
+        try:
+            os.makedirs(group.path)
+            group.configure(limits)
+            return group
+        except OSError as e:
+            logger.warning("cgroupの作成に失敗しました: %s", e)
+            group.destroy()
+            return None
+
+
+def make_preexec_fn(limits, cgroup=None):
+    """
+    子プロセス起動時にcgroupへの移動とrlimitの設定を行う関数を作る
+    """
+    # プロセス数はcgroupのpids.maxで制限できればそちらに任せる。使えない場合のRLIMIT_NPROCは
+    # ユーザー全体の数で判定されるため、サーバー自身のスレッド数の分を上乗せする
+    # （同じユーザーで動く他のプロセスの分は含まれないため、専用のユーザーで動かすこと）
+    max_processes = None
+    if cgroup is None and limits.max_processes > 0:
+        max_processes = limits.max_processes + current_thread_count()
+
+    def preexec():
+        if cgroup is not None:
+            cgroup.enter()
+        apply_rlimits(limits, max_processes)
+    return preexec
+
+
+def _read_stream(stream, chunks):
+    for chunk in iter(lambda: stream.read(65536), b""):
+        chunks.append(chunk)
+    stream.close()
+
+
+def _describe_exit(status):
+    """
+    wait4のステータスを終了コードと終了理由に変換する
+    """
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        reason = {
+            signal.SIGXCPU: "CPU時間の上限に達しました",
+            signal.SIGKILL: "強制終了されました",
+        }.get(signum, f"シグナル {signal.Signals(signum).name} で終了しました")
+        return -signum, reason
+    return os.WEXITSTATUS(status), None
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_limited(argv, cwd=None, timeout=None, limits=None, cgroups=None):
+    """
+    リソース制限付きでコマンドを実行し、結果と使用量を返す（ブロッキング）
+
+    コマンドは新しいプロセスグループで起動し、タイムアウト時は
+    グループごと終了する。使用量はwait4のrusageと、cgroupが
+    使える場合はグループ全体の統計から取得する。
+    """
+    limits = limits or ResourceLimits()
+    # 不正な値で起動後に失敗しないよう、プロセスを起動する前にタイムアウトを確定する
+    timeout = parse_timeout(timeout)
+    cgroup = cgroups.create(limits) if cgroups is not None else None
+    started = time.monotonic()
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
+            preexec_fn=make_preexec_fn(limits, cgroup)
+        )
+        reaped = False
+        try:
+            stdout_chunks, stderr_chunks = [], []
+            readers = [
+                threading.Thread(target=_read_stream, args=(process.stdout, stdout_chunks), daemon=True),
+                threading.Thread(target=_read_stream, args=(process.stderr, stderr_chunks), daemon=True),
+            ]
+            for reader in readers:
+                reader.start()
+
+            # rusageを取得するためにPopen.waitではなくwait4で回収する
+            timed_out = False
+            deadline = started + timeout
+            while True:
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid != 0:
+                    break
+                if time.monotonic() > deadline:
+                    timed_out = True
+                    _kill_group(process.pid)
+                    pid, status, rusage = os.wait4(process.pid, 0)
+                    break
+                time.sleep(0.01)
+            reaped = True
+            process.returncode = os.waitstatus_to_exitcode(status)
+
+            # グループ内に残った子プロセスも終了させる（パイプを開いたままの孫プロセス対策）
+            _kill_group(process.pid)
+            for reader in readers:
+                reader.join(timeout=5)
+
+            returncode, reason = _describe_exit(status)
+            usage = {
+                "wall_time": round(time.monotonic() - started, 4),
+                "user_cpu_time": round(rusage.ru_utime, 4),
+                "system_cpu_time": round(rusage.ru_stime, 4),
+                "max_rss_kb": rusage.ru_maxrss,
+            }
+            if cgroup is not None:
+                usage.update(cgroup.usage())
+
+            stderr = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+            result = {
+                "success": returncode == 0 and not timed_out,
+                "stdout": b"".join(stdout_chunks).decode("utf-8", errors="replace"),
+                "stderr": stderr,
+                "returncode": returncode,
+                "usage": usage,
+                "limits": limits.to_dict()
+            }
+            if timed_out:
+                result["timed_out"] = True
+                result["error"] = f"タイムアウト: {timeout}秒"
+            elif usage.get("cgroup_oom_kill"):
+                result["error"] = "メモリ使用量の上限に達したため強制終了されました"
+            elif reason:
+                result["error"] = reason
+            return result
+        except BaseException:
+            # 途中で例外が起きてもプロセスグループを終了・回収してからcgroupを削除する
+            _kill_group(process.pid)
+            if not reaped:
+                try:
+                    os.wait4(process.pid, 0)
+                except ChildProcessError:
+                    pass
+            raise
+    finally:
+        if cgroup is not None:
+            cgroup.destroy()
@@ -0,0 +1,317 @@
+"""
+セッションのメッセージとエージェントのアクションの全文検索
+
+メッセージの本文とアクションの説明・詳細を転置インデックスに追加し、BM25で順位を付けて
+検索する。日本語（ひらがな・カタカナ・漢字）の連なりは2文字ずつのn-gramに、それ以外は
+単語に分割する。1文字の日本語の検索語は、その文字を含むn-gramすべてに一致させる。
+
+配信のたびに分割・追加すると配信が遅れるため、submit() はキューに積むだけで、
+インデックスへの追加はバックグラウンドのタスクで少しずつ行う。そのため配信の直後は
+検索結果に含まれないことがある。
+"""
+
+import asyncio
+import logging
+import math
+import re
+import unicodedata
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_CJK = "\u3005\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN_PATTERN = re.compile(rf"([{_CJK}]+)|([^\W{_CJK}]+)")
+# 単語として扱う最大の文字数（長い文字列はハッシュ値などで検索に使われない）
+MAX_WORD_LENGTH = 64
+# 索引に含めないアクションの詳細の項目
+SKIPPED_DETAIL_KEYS = {"id", "step_id", "task_id", "traceback"}
+
+# BM25のパラメーター
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text):
+    """
+    文字列を検索語のリストに分割する（日本語は2文字ずつのn-gram、それ以外は単語）
+    """
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(normalize(text)):
+        cjk, word = match.groups()
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        elif len(word) <= MAX_WORD_LENGTH:
+            tokens.append(word)
+    return tokens
+
+
+def detail_text(details):
+    """
+    アクションの詳細から文字列の値を取り出して連結する（IDやトレースバックは除く）
+    """
+    parts = []
+
+    def collect(value):
+        if isinstance(value, str):
+            parts.append(value)
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                if key not in SKIPPED_DETAIL_KEYS:
+                    collect(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+
+    collect(details)
+    return "\n".join(parts)
+
+
+class Document:
+    __slots__ = ("doc_id", "session_id", "kind", "ref_id", "label", "timestamp", "text", "length")
+
+    def __init__(self, doc_id, session_id, kind, ref_id, label, timestamp, text, length):
+        self.doc_id = doc_id
+        self.session_id = session_id
+        self.kind = kind
+        self.ref_id = ref_id
+        # メッセージの送信者（role）またはアクションの種類
+        self.label = label
+        self.timestamp = timestamp
+        self.text = text
+        self.length = length
+
+
+class SearchIndex:
+    """
+    メッセージとアクションの転置インデックス
+    """
+
+    def __init__(self, max_document_chars=20000, snippet_chars=120):
+        # 1件あたり索引に含める文字数（長い出力の末尾は検索できない）
+        self.max_document_chars = max_document_chars
+        self.snippet_chars = snippet_chars
+        self.documents = {}
+        # 検索語 -> {文書ID: 出現回数}
+        self.postings = {}
+        # 文字 -> その文字を含む日本語のn-gram（1文字の検索語の展開用）
+        self._by_char = {}
+        self._by_ref = {}
+        self._by_session = {}
+        self._total_length = 0
+        self._next_id = 1
+        self._queue = asyncio.Queue()
+        self._worker = None
+        self.indexed = 0
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    # --- 追加・削除の受け付け（配信の処理から呼ばれるため、キューに積むだけ） ---
+
+    def submit(self, session_id, event):
+        """
+        配信するイベントのうち、メッセージとアクションを索引に追加する
+        """
+        event_type, data = event.get("type"), event.get("data")
+        if event_type not in ("message", "agent_action") or not isinstance(data, dict) or not data.get("id"):
+            return
+        self._queue.put_nowait(("add", session_id, event_type, data))
+
+    def drop_session(self, session_id):
+        self._queue.put_nowait(("drop", session_id, None, None))
+
+    async def _run(self):
+        while True:
+            operation, session_id, event_type, data = await self._queue.get()
+            try:
+                if operation == "add":
+                    self._add_event(session_id, event_type, data)
+                else:
+                    self._remove_session(session_id)
+            except Exception:
+                logger.exception("検索インデックスの更新に失敗しました")
+            finally:
+                self._queue.task_done()
+            # 積まれた分を一度に処理してイベントループを占有しないよう、1件ごとに譲る
+            await asyncio.sleep(0)
+
+    # --- インデックスの更新 ---
+
+    def _add_event(self, session_id, event_type, data):
+        if event_type == "message":
+            self.add(session_id, "message", data["id"], data.get("role", ""), data.get("timestamp"), data.get("content") or "")
+        else:
+            text = "\n".join(part for part in (data.get("description") or "", detail_text(data.get("details") or {})) if part)
+            self.add(session_id, "action", data["id"], data.get("type", ""), data.get("created_at"), text)
+
+    def add(self, session_id, kind, ref_id, label, timestamp, text):
+        """
+        文書を追加する（同じIDの文書があれば置き換える）
+        """
+        self.remove(kind, ref_id)
+        text = text[:self.max_document_chars]
+        counts = Counter(tokenize(text))
+        doc_id = self._next_id
+        self._next_id += 1
+        length = sum(counts.values())
+        self.documents[doc_id] = Document(doc_id, session_id, kind, ref_id, label, timestamp, text, length)
+        self._by_ref[(kind, ref_id)] = doc_id
+        self._by_session.setdefault(session_id, set()).add(doc_id)
+        self._total_length += length
+        for token, count in counts.items():
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = {}
+                if len(token) == 2 and _TOKEN_PATTERN.fullmatch(token).group(1):
+                    for char in set(token):
+                        self._by_char.setdefault(char, set()).add(token)
+            postings[doc_id] = count
+        self.indexed += 1
+
+    def remove(self, kind, ref_id):
+        doc_id = self._by_ref.pop((kind, ref_id), None)
+        if doc_id is not None:
+            self._remove_document(doc_id)
+
+    def _remove_session(self, session_id):
+        for doc_id in self._by_session.pop(session_id, ()):
+            document = self.documents.get(doc_id)
+            if document is not None:
+                self._by_ref.pop((document.kind, document.ref_id), None)
+            self._remove_document(doc_id, keep_session=True)
+
+    def _remove_document(self, doc_id, keep_session=False):
+        document = self.documents.pop(doc_id, None)
+        if document is None:
+            return
+        if not keep_session:
+            session_docs = self._by_session.get(document.session_id)
+            if session_docs is not None:
+                session_docs.discard(doc_id)
+                if not session_docs:
+                    del self._by_session[document.session_id]
+        self._total_length -= document.length
+        for token in set(tokenize(document.text)):
+            postings = self.postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[token]
+                for char in set(token):
+                    expansions = self._by_char.get(char)
+                    if expansions is not None:
+                        expansions.discard(token)
+                        if not expansions:
+                            del self._by_char[char]
+
+    # --- 検索 ---
+
+    def _term_postings(self, token):
+        """
+        検索語に一致する文書と出現回数（1文字の日本語はその文字を含むn-gramをまとめる）
+        """
+        postings = self.postings.get(token)
+        expansions = self._by_char.get(token) if len(token) == 1 else None
+        if not expansions:
+            return postings or {}
+        merged = dict(postings or {})
+        for expansion in expansions:
+            for doc_id, count in self.postings[expansion].items():
+                merged[doc_id] = merged.get(doc_id, 0) + count
+        return merged
+
+    def search(self, query, session_id=None, kind=None, limit=20, offset=0):
+        """
+        すべての検索語を含む文書をスコアの高い順に返す（同じスコアなら新しい順）
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.documents:
+            return {"total": 0, "results": []}
+        term_postings = sorted((self._term_postings(term) for term in terms), key=len)
+        if not term_postings[0]:
+            return {"total": 0, "results": []}
+
+        # 最も絞り込める検索語から順に共通する文書を求める
+        candidates = set(term_postings[0])
+        for postings in term_postings[1:]:
+            candidates.intersection_update(postings)
+            if not candidates:
+                return {"total": 0, "results": []}
+
+        total_documents = len(self.documents)
+        average_length = self._total_length / total_documents if total_documents else 1.0
+        scored = []
+        for doc_id in candidates:
+            document = self.documents[doc_id]
+            if session_id is not None and document.session_id != session_id:
+                continue
+            if kind is not None and document.kind != kind:
+                continue
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * document.length / (average_length or 1.0))
+            score = 0.0
+            for postings in term_postings:
+                count = postings[doc_id]
+                idf = math.log(1 + (total_documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                score += idf * count * (BM25_K1 + 1) / (count + norm)
+            scored.append((score, doc_id))
+        scored.sort(reverse=True)
+
+        results = []
+        for score, doc_id in scored[offset:offset + limit]:
+            document = self.documents[doc_id]
+            results.append({
+                "session_id": document.session_id,
+                "kind": document.kind,
+                "id": document.ref_id,
+                "label": document.label,
+                "timestamp": document.timestamp,
+                "score": round(score, 4),
+                "snippet": self.snippet(document.text, query, terms)
+            })
+        return {"total": len(scored), "results": results}
+
+    def snippet(self, text, query, terms):
+        """
+        検索語が最初に現れる位置の前後を切り出す
+        """
+        lowered = text.lower()
+        position = lowered.find(query.strip().lower())
+        for term in terms:
+            if position >= 0:
+                break
+            position = lowered.find(term)
+        position = max(position, 0)
+        start = max(0, position - self.snippet_chars // 3)
+        end = start + self.snippet_chars
+        return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
+
+    def status(self):
+        return {
+            "documents": len(self.documents),
+            "terms": len(self.postings),
+            "pending": self.pending,
+            "indexed": self.indexed
+        }
@@ -0,0 +1,43 @@
+"""
+セッションIDの検証
+
+セッションIDはワークスペースやイベントログのディレクトリ名にそのまま使うため、
+URLから受け取ったIDは uuid4 で作成した形式（小文字・ハイフン区切りの36文字）だけを受け付ける。
+".." や "/" を含むIDでディレクトリを作成・削除すると、ルートの外を操作してしまう。
+"""
+
+import os
+import uuid
+
+
+class InvalidSessionId(ValueError):
+    """
+    セッションIDの形式が正しくないことを示す例外
+    """
+
+
+def is_valid_session_id(session_id):
+    if not isinstance(session_id, str) or len(session_id) != 36:
+        return False
+    try:
+        return str(uuid.UUID(session_id)) == session_id
+    except ValueError:
+        return False
+
+
+def check_session_id(session_id):
+    if not is_valid_session_id(session_id):
+        raise InvalidSessionId(f"セッションIDの形式が正しくありません: {session_id!r}")
+    return session_id
+
+
+def session_path(root, session_id):
+    """
+    root配下のセッションのディレクトリのパスを返す（root直下に収まらない場合は例外）
+    """
+    check_session_id(session_id)
+    path = os.path.join(root, session_id)
+    real_root = os.path.realpath(root)
+    if os.path.dirname(os.path.realpath(path)) != real_root:
+        raise InvalidSessionId(f"セッションのディレクトリがルートの外を指しています: {session_id!r}")
+    return path
@@ -0,0 +1,287 @@
+"""
+セッションごとに常駐するシェルを管理するモジュール
+
+shell_commandごとに新しいbashを起動すると、cdや環境変数、virtualenvの
+有効化などが次のステップに引き継がれず、プロセス起動のコストも毎回かかる。
+ここではセッションごとに1つのbashをパイプ経由で起動したままにし、
+コマンドの前後に区切りマーカーを出力させて結果と終了コードを切り出す。
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shlex
+import signal
+import time
+import uuid
+
+from sandbox import make_preexec_fn, parse_timeout
+
+logger = logging.getLogger(__name__)
+
+# 1コマンドの出力として読み取る1行の最大長
+STREAM_LIMIT = 16 * 1024 * 1024
+
+# bashのtimes組み込みコマンドの出力（例: 0m0.012s 0m0.004s）
+TIMES_PATTERN = re.compile(r"(\d+)m([\d.]+)s\s+(\d+)m([\d.]+)s")
+
+
+class ShellSessionError(Exception):
+    """
+    常駐シェルが利用できない状態になったことを示す例外
+    """
+
+
+class ShellSession:
+    """
+    パイプ経由で操作する常駐bashプロセス
+    """
+
+    def __init__(self, session_id, cwd, limits=None, cgroups=None):
+        self.session_id = session_id
+        self.cwd = cwd
+        self.limits = limits
+        self.cgroups = cgroups
+        self.cgroup = None
+        self.process = None
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+        # 出力の読み取りが途中で中断され、次のコマンドに使えなくなったかどうか
+        self.broken = False
+        # 子プロセスの累積CPU時間（コマンドごとの差分を求めるため）
+        self._children_cpu = (0.0, 0.0)
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None and not self.broken
+
+    async def start(self):
+        """
+        bashを起動する
+        """
+        os.makedirs(self.cwd, exist_ok=True)
+        preexec_fn = None
+        if self.limits is not None:
+            # シェルとその子プロセス全体を1つのcgroupにまとめ、rlimitは子プロセスに継承させる
+            if self.cgroups is not None:
+                self.cgroup = self.cgroups.create(self.limits, name=f"shell-{self.session_id}")
+            preexec_fn = make_preexec_fn(self.limits, self.cgroup)
+        self.process = await asyncio.create_subprocess_exec(
+            "bash", "--noprofile", "--norc",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=self.cwd,
+            limit=STREAM_LIMIT,
+            # タイムアウト時にコマンドの子プロセスごと終了できるよう独立したプロセスグループにする
+            start_new_session=True,
+            preexec_fn=preexec_fn
+        )
+
+    async def _read_until(self, stream, marker, trailing_lines=0):
+        """
+        マーカー行が現れるまでストリームを読み、(出力, マーカー行の残り, 後続行) を返す
+        """
+        lines = []
+        while True:
+            line = await stream.readline()
+            if not line:
+                raise ShellSessionError("シェルプロセスが終了しました")
+            text = line.decode("utf-8", errors="replace")
+            if text.startswith(marker):
+                output = "".join(lines)
+                # 区切りのために追加した改行を取り除く
+                if output.endswith("\n"):
+                    output = output[:-1]
+                trailing = []
+                for _ in range(trailing_lines):
+                    trailing.append((await stream.readline()).decode("utf-8", errors="replace"))
+                return output, text[len(marker):].strip(), trailing
+            lines.append(text)
+
+    async def run(self, command, timeout=None):
+        """
+        常駐シェルでコマンドを実行し、標準出力・標準エラー・終了コードを返す
+        """
+        if not self.alive:
+            raise ShellSessionError("シェルプロセスが起動していません")
+        # 不正なタイムアウトで書き込み後に失敗しないよう、コマンドを送る前に確かめる
+        timeout = parse_timeout(timeout)
+
+        marker = f"__MANUS_CMD_END_{uuid.uuid4().hex}__"
+        # evalで現在のシェル上で実行し、cdやexportの効果を残す
+        # 標準入力は/dev/nullにして、区切り用のパイプを読み込まれないようにする
+        script = (
+            f"eval {shlex.quote(command)} < /dev/null\n"
+            f"__manus_rc=$?\n"
+            f"printf '\\n{marker}%d\\n' \"$__manus_rc\"\n"
+            f"times\n"
+            f"printf '\\n{marker}\\n' >&2\n"
+        )
+        self.last_used = time.monotonic()
+        started = time.monotonic()
+        self.process.stdin.write(script.encode("utf-8"))
+        await self.process.stdin.drain()
+
+        try:
+            (stdout, rc_text, times_lines), (stderr, _, _) = await asyncio.wait_for(
+                asyncio.gather(
+                    self._read_until(self.process.stdout, marker, trailing_lines=2),
+                    self._read_until(self.process.stderr, marker)
+                ),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            await self.close()
+            return {
+                "success": False,
+                "stdout": "",
+                "stderr": f"コマンドが{timeout}秒以内に終了しなかったため、シェルを再起動します",
+                "error": f"タイムアウト: {timeout}秒",
+                "returncode": -1,
+                "timed_out": True,
+                "usage": {"wall_time": round(time.monotonic() - started, 4)}
+            }
+        except ShellSessionError:
+            # コマンド中のexitなどでシェル自体が終了した場合
+            await self.close()
+            returncode = self.process.returncode if self.process else -1
+            return {
+                "success": False,
+                "stdout": "",
+                "stderr": "シェルプロセスが終了しました",
+                "error": "シェルプロセスが終了しました",
+                "returncode": returncode if returncode is not None else -1,
+                "usage": {"wall_time": round(time.monotonic() - started, 4)}
+            }
+        except BaseException:
+            # キャンセルなどで読み取りを中断した場合、残った出力が次のコマンドに混ざるためシェルは使わない
+            self.broken = True
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            raise
+        finally:
+            self.last_used = time.monotonic()
+
+        returncode = int(rc_text) if rc_text.lstrip("-").isdigit() else -1
+        return {
+            "success": returncode == 0,
+            "stdout": stdout,
+            "stderr": stderr,
+            "returncode": returncode,
+            "usage": self._usage_delta(times_lines, time.monotonic() - started),
+            "limits": self.limits.to_dict() if self.limits is not None else None
+        }
+
+    def _usage_delta(self, times_lines, wall_time):
+        """
+        times出力の2行目（子プロセスの累積CPU時間）から今回のコマンド分を求める
+        """
+        usage = {"wall_time": round(wall_time, 4)}
+        match = TIMES_PATTERN.search(times_lines[1]) if len(times_lines) > 1 else None
+        if match:
+            user = int(match.group(1)) * 60 + float(match.group(2))
+            system = int(match.group(3)) * 60 + float(match.group(4))
+            prev_user, prev_system = self._children_cpu
+            self._children_cpu = (user, system)
+            usage["user_cpu_time"] = round(user - prev_user, 4)
+            usage["system_cpu_time"] = round(system - prev_system, 4)
+        return usage
+
+    async def close(self):
+        """
+        シェルとその子プロセスを終了する
+        """
+        process = self.process
+        if process is not None and process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                logger.warning("常駐シェルの終了待ちがタイムアウトしました - セッションID: %s", self.session_id)
+        if self.cgroup is not None:
+            await asyncio.to_thread(self.cgroup.destroy)
+            self.cgroup = None
+
+
+class ShellSessionManager:
+    """
+    セッションIDごとの常駐シェルを管理し、アイドル状態のシェルを回収する
+    """
+
+    def __init__(self, idle_timeout=600, sweep_interval=60, limits=None, cgroups=None):
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.limits = limits
+        self.cgroups = cgroups
+        self.sessions = {}
+        # セッションごとのシェル起動のロック（最初のコマンドが同時に来てもシェルを1つだけ起動する）
+        self._start_locks = {}
+        self._sweeper = None
+
+    def _ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while self.sessions:
+            await asyncio.sleep(self.sweep_interval)
+            await self.reap_idle()
+
+    async def reap_idle(self):
+        """
+        一定時間使われていないシェルを終了する
+        """
+        now = time.monotonic()
+        for session_id, shell in list(self.sessions.items()):
+            if shell.lock.locked():
+                continue
+            if not shell.alive or now - shell.last_used > self.idle_timeout:
+                logger.info("アイドル状態の常駐シェルを回収します - セッションID: %s", session_id)
+                await self.close(session_id)
+
+    async def run(self, session_id, command, cwd, timeout=None):
+        """
+        セッションの常駐シェルでコマンドを実行する（必要に応じてシェルを起動する）
+        """
+        async with self._start_locks.setdefault(session_id, asyncio.Lock()):
+            shell = self.sessions.get(session_id)
+            if shell is None or not shell.alive:
+                if shell is not None:
+                    # 終了した（または使えなくなった）シェルのプロセスとcgroupを片付けてから起動し直す
+                    await shell.close()
+                shell = ShellSession(session_id, cwd, limits=self.limits, cgroups=self.cgroups)
+                try:
+                    await shell.start()
+                except OSError as e:
+                    raise ShellSessionError(f"常駐シェルを起動できません: {e}") from e
+                self.sessions[session_id] = shell
+                self._ensure_sweeper()
+
+        # 同じシェルへのコマンドは1つずつ実行する
+        async with shell.lock:
+            return await shell.run(command, timeout=timeout)
+
+    async def close(self, session_id):
+        """
+        セッションの常駐シェルを終了する
+        """
+        shell = self.sessions.pop(session_id, None)
+        lock = self._start_locks.get(session_id)
+        if lock is not None and not lock.locked():
+            del self._start_locks[session_id]
+        if shell is not None:
+            await shell.close()
+
+    async def close_all(self):
+        """
+        すべての常駐シェルを終了する
+        """
+        for session_id in list(self.sessions.keys()):
+            await self.close(session_id)
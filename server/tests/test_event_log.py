@@ -0,0 +1,144 @@
+"""
+event_log.py のテスト（途中で途切れたイベントの切り捨て・コンパクション・復元）
+
+    cd server && python -m pytest -q tests
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from event_log import SEGMENT_SUFFIX, SNAPSHOT_NAME, EventLog, read_frames
+from session_ids import InvalidSessionId
+
+
+class EventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directory = os.path.join(self.root, "session_logs")
+        self.states = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def make_log(self, snapshot_every=0):
+        return EventLog(self.directory, snapshot_every=snapshot_every, snapshot_fn=self.states.get)
+
+    def write(self, log, session_id, count, start=1):
+        for i in range(start, start + count):
+            self.states[session_id] = {"count": i}
+            log.append(session_id, "message", {"index": i})
+        asyncio.run(log.flush())
+
+    def segments(self, session_id):
+        return sorted(name for name in os.listdir(os.path.join(self.directory, session_id)) if name.endswith(SEGMENT_SUFFIX))
+
+    def test_restore_events(self):
+        session_id = str(uuid.uuid4())
+        self.write(self.make_log(), session_id, 3)
+
+        restored = self.make_log().load()
+        self.assertEqual(len(restored), 1)
+        self.assertEqual(restored[0].session_id, session_id)
+        self.assertIsNone(restored[0].snapshot)
+        self.assertEqual([event["data"]["index"] for event in restored[0].events], [1, 2, 3])
+        self.assertEqual([event["seq"] for event in restored[0].events], [1, 2, 3])
+
+    def test_truncate_torn_frame(self):
+        session_id = str(uuid.uuid4())
+        self.write(self.make_log(), session_id, 2)
+        path = os.path.join(self.directory, session_id, self.segments(session_id)[0])
+        valid_size = os.path.getsize(path)
+        # 書き込みの途中で終了した状態（ヘッダーと本文の一部だけ）を再現する
+        with open(path, "ab") as f:
+            f.write(b"\x40\x00\x00\x00\x00\x00\x00\x00{\"seq\":3")
+
+        log = self.make_log()
+        restored = log.load()
+        self.assertEqual([event["seq"] for event in restored[0].events], [1, 2])
+        self.assertEqual(os.path.getsize(path), valid_size)
+
+        # 切り捨てた後の追記は続きの番号で読める
+        self.write(log, session_id, 1, start=3)
+        restored = self.make_log().load()
+        self.assertEqual([event["seq"] for event in restored[0].events], [1, 2, 3])
+
+    def test_corrupted_frame_stops_reading(self):
+        session_id = str(uuid.uuid4())
+        self.write(self.make_log(), session_id, 3)
+        path = os.path.join(self.directory, session_id, self.segments(session_id)[0])
+        records, _ = read_frames(path)
+        self.assertEqual(len(records), 3)
+        # 2件目の本文を書き換えるとCRCが一致せず、1件目までしか読まない
+        with open(path, "r+b") as f:
+            data = f.read()
+            second = data.index(b'"seq":2')
+            f.seek(second)
+            f.write(b'"seq":9')
+        records, valid_length = read_frames(path)
+        self.assertEqual([record["seq"] for record in records], [1])
+        self.assertLess(valid_length, os.path.getsize(path))
+
+    def test_compaction(self):
+        session_id = str(uuid.uuid4())
+        log = self.make_log(snapshot_every=4)
+        self.write(log, session_id, 4)
+        # スナップショットを書いた時点でそれまでのセグメントは削除される
+        self.assertTrue(os.path.exists(os.path.join(self.directory, session_id, SNAPSHOT_NAME)))
+        self.assertEqual(self.segments(session_id), [])
+
+        self.write(log, session_id, 2, start=5)
+        self.assertEqual(self.segments(session_id), [f"{5:012d}{SEGMENT_SUFFIX}"])
+        self.write(log, session_id, 2, start=7)
+        self.assertEqual(self.segments(session_id), [])
+        self.assertEqual(log.written_snapshots, 2)
+
+        restored = self.make_log().load()
+        self.assertEqual(restored[0].snapshot, {"count": 8})
+        self.assertEqual(restored[0].events, [])
+
+    def test_restore_snapshot_and_tail(self):
+        session_id = str(uuid.uuid4())
+        log = self.make_log(snapshot_every=3)
+        self.write(log, session_id, 5)
+
+        log = self.make_log(snapshot_every=3)
+        restored = log.load()
+        self.assertEqual(restored[0].snapshot, {"count": 3})
+        self.assertEqual([event["seq"] for event in restored[0].events], [4, 5])
+        # 復元後の番号はログの続きから割り当てる
+        self.assertEqual(log.sessions[session_id].seq, 5)
+
+    def test_delete(self):
+        session_id = str(uuid.uuid4())
+        log = self.make_log()
+        self.write(log, session_id, 2)
+        log.delete(session_id)
+        asyncio.run(log.flush())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, session_id)))
+        self.assertTrue(os.path.isdir(self.directory))
+
+    def test_reject_invalid_session_id(self):
+        log = self.make_log()
+        os.makedirs(self.directory)
+        marker = os.path.join(self.root, "keep")
+        open(marker, "w").close()
+        for session_id in ("..", ".", "../session_logs", "a/b", ""):
+            with self.assertRaises(InvalidSessionId):
+                log.append(session_id, "message", {})
+            with self.assertRaises(InvalidSessionId):
+                log.delete(session_id)
+        asyncio.run(log.flush())
+        self.assertTrue(os.path.exists(marker))
+        self.assertTrue(os.path.isdir(self.directory))
+
+    def test_load_skips_other_directories(self):
+        os.makedirs(os.path.join(self.directory, "not-a-session"))
+        self.assertEqual(self.make_log().load(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
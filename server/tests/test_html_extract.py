@@ -0,0 +1,70 @@
+"""
+html_extract.py のテスト（定型部分の除去で本文を落とさないこと）
+
+    cd server && python -m pytest -q tests
+"""
+
+import unittest
+
+from html_extract import extract_text
+
+# WordPressのテーマでよくある構成（body・ラッパーのclassに header/sidebar を含む語がある）
+PAGE = """<!DOCTYPE html>
+<html lang="ja" class="no-js">
+<head><title>Async I/O入門 | Example Blog</title></head>
+<body class="home post-template-default has-sidebar wp-custom-logo">
+<div id="page" class="site header-fixed">
+  <a class="skip-link screen-reader-text" href="#content">本文へ移動</a>
+  <div class="site-branding"><p class="site-title">Example Blog</p></div>
+  <div class="nav main-menu" id="site-navigation">
+    <a href="/">ホーム</a> <a href="/about">このサイトについて</a>
+  </div>
+  <div id="content" class="site-content sidebar-right">
+    <main id="main" class="site-main nav-below">
+      <article class="post type-post header-image">
+        <h1 class="entry-title">Async I/O入門</h1>
+        <div class="entry-content share-buttons-enabled">
+          <p>イベントループはI/Oの完了を待つ間に他のタスクを進める。</p>
+          <p>詳しくは<a href="/docs/asyncio">公式ドキュメント</a>を参照。</p>
+        </div>
+        <div class="share"><a href="https://twitter.com/share">共有</a></div>
+      </article>
+    </main>
+    <div id="secondary" class="widget-area sidebar">
+      <h2>最近の投稿</h2><p>別の記事</p>
+    </div>
+  </div>
+  <div class="site-info footer">© Example Blog</div>
+</div>
+</body>
+</html>
+"""
+
+
+class BoilerplateTest(unittest.TestCase):
+    def test_realistic_page_keeps_article(self):
+        result = extract_text(PAGE, base_url="https://blog.example.com/async-io/")
+        text = result["text"]
+        self.assertEqual(result["title"], "Async I/O入門 | Example Blog")
+        self.assertIn("Async I/O入門", text)
+        self.assertIn("イベントループはI/Oの完了を待つ間に他のタスクを進める。", text)
+        self.assertIn("[公式ドキュメント](https://blog.example.com/docs/asyncio)", text)
+        # class/idのトークンが一致する部分だけを除去する
+        for removed in ("このサイトについて", "共有", "最近の投稿", "© Example Blog"):
+            self.assertNotIn(removed, text)
+
+    def test_content_roots_are_never_removed(self):
+        html = (
+            '<html class="nav"><body class="sidebar" role="navigation">'
+            '<main class="footer"><article id="header"><p>本文</p></article></main>'
+            "</body></html>"
+        )
+        self.assertEqual(extract_text(html)["text"], "本文")
+
+    def test_whole_token_match(self):
+        html = '<div class="menu-toggle-wrapper"><p>本文</p></div><div class="Menu"><p>メニュー</p></div>'
+        self.assertEqual(extract_text(html)["text"], "本文")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+"""
+sandbox.py のテスト（run_limited のタイムアウトの扱い）
+
+    cd server && python -m pytest -q tests
+"""
+
+import sys
+import unittest
+
+from sandbox import run_limited
+
+
+@unittest.skipIf(sys.platform == "win32", "プロセスグループとwait4が必要です")
+class RunLimitedTimeoutTest(unittest.TestCase):
+    def test_string_timeout(self):
+        result = run_limited(["sh", "-c", "echo ok"], timeout="5")
+        self.assertTrue(result["success"], result)
+        self.assertEqual(result["stdout"], "ok\n")
+
+    def test_invalid_timeout_uses_default(self):
+        for timeout in (None, 0, "abc"):
+            result = run_limited(["sh", "-c", "echo ok"], timeout=timeout)
+            self.assertTrue(result["success"], result)
+
+    def test_timeout_kills_group(self):
+        result = run_limited(["sh", "-c", "sleep 5 & sleep 5"], timeout="0.2")
+        self.assertTrue(result["timed_out"])
+        self.assertLess(result["usage"]["wall_time"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+shell_session.py のテスト（LLMが指定したタイムアウトの扱い）
+
+    cd server && python -m pytest -q tests
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from sandbox import DEFAULT_TIMEOUT, parse_timeout
+from shell_session import ShellSessionManager
+
+
+class ParseTimeoutTest(unittest.TestCase):
+    def test_string_timeout(self):
+        self.assertEqual(parse_timeout("30", 300), 30.0)
+
+    def test_missing_or_invalid_timeout(self):
+        for value in (None, 0, -5, "abc", "", True, float("nan"), float("inf"), [], {}):
+            self.assertEqual(parse_timeout(value, 300), 300.0, value)
+        self.assertEqual(parse_timeout(None), DEFAULT_TIMEOUT)
+
+    def test_clamp_to_maximum(self):
+        self.assertEqual(parse_timeout(10 ** 9, 300), 300.0)
+        self.assertEqual(parse_timeout(0.5, 300), 0.5)
+
+
+@unittest.skipIf(sys.platform == "win32" or shutil.which("bash") is None, "bashが必要です")
+class ShellSessionTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "out.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run_commands(self, timeouts):
+        async def run():
+            manager = ShellSessionManager()
+            try:
+                results = []
+                for timeout in timeouts:
+                    results.append(await manager.run("s", f"echo x >> {self.path}", cwd=self.directory, timeout=timeout))
+                results.append(await manager.run("s", "echo next", cwd=self.directory, timeout=10))
+                return results
+            finally:
+                await manager.close_all()
+        return asyncio.run(run())
+
+    def test_string_timeout_runs_once(self):
+        results = self.run_commands(["30"])
+        self.assertTrue(results[0]["success"], results[0])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "x\n")
+        # 同じシェルで次のコマンドも実行できる
+        self.assertEqual(results[-1]["stdout"].strip(), "next")
+
+    def test_missing_timeout(self):
+        results = self.run_commands([None, 0])
+        self.assertTrue(all(result["success"] for result in results), results)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "x\nx\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+トークン数の概算ユーティリティ
+
+モデル固有のトークナイザーを持たないため、文字種ごとの平均的な比率から
+トークン数を概算する。日本語などのCJK文字は1文字あたり約1トークン、
+ASCII文字は約4文字で1トークンとして数える。
+"""
+
+import unicodedata
+
+# ASCII文字何文字で1トークンとみなすか
+ASCII_CHARS_PER_TOKEN = 4
+
+
+def _is_wide(ch):
+    """
+    CJKなど1文字で約1トークンになる文字かどうかを判定する
+    """
+    return unicodedata.east_asian_width(ch) in ("W", "F")
+
+
+def count_chars(text):
+    """
+    トークン数の概算に使う (全角文字数, ASCII換算の文字数) を返す
+
+    細かい断片ごとにestimate_tokensで切り上げると合計が過大になるため、
+    連結するテキストはこの文字数を足し合わせてからtokens_from_charsで換算する。
+    """
+    wide = 0
+    narrow = 0
+    for ch in text:
+        if ord(ch) < 128:
+            narrow += 1
+        elif _is_wide(ch):
+            wide += 1
+        else:
+            # 全角でない非ASCII文字（アクセント付きラテン文字など）は2文字で1トークン
+            narrow += 2
+    return wide, narrow
+
+
+def tokens_from_chars(wide, narrow):
+    return wide + (narrow + ASCII_CHARS_PER_TOKEN - 1) // ASCII_CHARS_PER_TOKEN
+
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を概算する
+    """
+    if not text:
+        return 0
+    return tokens_from_chars(*count_chars(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    テキストを概算トークン数が上限以内になるように先頭から切り詰める
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 二分探索で上限に収まる最長の接頭辞を求める
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
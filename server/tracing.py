@@ -0,0 +1,263 @@
+"""
+タスクの処理を区間（スパン）単位で計測するトレーシングのモジュール
+
+計画の生成・各ステップのツール実行・配信・要約・実行枠の待ち時間などを
+親子関係付きのスパンとして記録する。スパンはコンテキスト変数で親を引き継ぐため、
+asyncioのタスクに分かれた処理も同じトレースにまとまる。記録したスパンは
+セッションごとに上限付きで保持し、必要に応じてOTLP互換のJSONでファイルに書き出す。
+"""
+
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 現在のスパン（子スパンの親になる）
+current_span = contextvars.ContextVar("trace_current_span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "trace_id", "span_id", "parent_id", "name", "session_id",
+        "start_ns", "end_ns", "attributes", "status", "error"
+    )
+
+    def __init__(self, name, trace_id, parent_id, session_id, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.session_id = session_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.status = "ok"
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_ns / 1e9,
+            "end_time": self.end_ns / 1e9 if self.end_ns is not None else None,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+            "error": self.error
+        }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans, service_name):
+    """
+    スパンをOTLP/JSON（ExportTraceServiceRequest）の形式にする
+    """
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": service_name},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                        "name": span.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns),
+                        "attributes": [
+                            {"key": key, "value": _otlp_value(value)}
+                            for key, value in span.attributes.items() if value is not None
+                        ],
+                        "status": {"code": 2, "message": span.error or ""} if span.status == "error" else {"code": 1}
+                    }
+                    for span in spans
+                ]
+            }]
+        }]
+    }
+
+
+class OTLPFileExporter:
+    """
+    完了したトレースをOTLP/JSONで1行ずつファイルに追記する（書き込みは別スレッドで行う）
+    """
+
+    def __init__(self, path, service_name="manus-clone", max_queue=1000):
+        self.path = path
+        self.service_name = service_name
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, spans):
+        try:
+            self._queue.put_nowait(list(spans))
+        except queue.Full:
+            logger.warning("トレースの書き出しが追いつかないため破棄します（%d件）", len(spans))
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                return
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(to_otlp(spans, self.service_name), ensure_ascii=False) + "\n")
+            except OSError as e:
+                logger.warning("トレースの書き出しに失敗しました: %s", e)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class Tracer:
+    """
+    スパンの開始・終了と、セッションごとの保持を行う
+    """
+
+    def __init__(self, max_spans_per_session=2000, exporter=None, max_task_traces=1000):
+        self.max_spans_per_session = max_spans_per_session
+        self.exporter = exporter
+        self.max_task_traces = max_task_traces
+        # セッションID -> 完了したスパン（古いものから捨てる）
+        self.sessions = {}
+        # タスクID -> トレースID（古いものから捨てる）
+        self.task_traces = OrderedDict()
+        # 書き出し待ちのトレース（トレースID -> スパン）と、ルートが実行中のトレース
+        self._pending = {}
+        self._active_traces = set()
+
+    def start(self, name, session_id=None, root=False, **attributes):
+        """
+        スパンを開始して現在のスパンにする（end()で終了する）
+
+        親スパンがない場合はroot=Trueのときだけ新しいトレースを始め、
+        それ以外は計測せずに (None, None) を返す。
+        """
+        parent = current_span.get()
+        if parent is None and not root:
+            return None, None
+        if root or parent is None:
+            trace_id = os.urandom(16).hex()
+            parent_id = None
+            self._active_traces.add(trace_id)
+        else:
+            trace_id = parent.trace_id
+            parent_id = parent.span_id
+        span = Span(name, trace_id, parent_id, session_id or (parent.session_id if parent else None), attributes)
+        return span, current_span.set(span)
+
+    def end(self, span, token, error=None):
+        if span is None:
+            return
+        if error is not None:
+            span.status = "error"
+            span.error = f"{type(error).__name__}: {error}"
+        current_span.reset(token)
+        self.finish(span)
+
+    @contextmanager
+    def span(self, name, session_id=None, root=False, **attributes):
+        """
+        スパンを開始する（with で使う。計測しない場合はNoneを返す）
+        """
+        span, token = self.start(name, session_id, root, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, token, e)
+            raise
+        self.end(span, token)
+
+    def record(self, name, start_ns, end_ns=None, **attributes):
+        """
+        計測済みの区間を現在のスパンの子として記録する
+        """
+        parent = current_span.get()
+        if parent is None:
+            return None
+        span = Span(name, parent.trace_id, parent.span_id, parent.session_id, attributes)
+        span.start_ns = start_ns
+        self.finish(span, end_ns)
+        return span
+
+    def finish(self, span, end_ns=None):
+        span.end_ns = end_ns if end_ns is not None else time.time_ns()
+        if span.session_id is not None:
+            buffer = self.sessions.get(span.session_id)
+            if buffer is None:
+                buffer = self.sessions[span.session_id] = deque(maxlen=self.max_spans_per_session)
+            buffer.append(span)
+        if span.parent_id is None:
+            self._active_traces.discard(span.trace_id)
+            if self.exporter is not None:
+                self.exporter.export(self._pending.pop(span.trace_id, []) + [span])
+            return
+        if self.exporter is None:
+            return
+        if span.trace_id not in self._active_traces:
+            # ルートの完了後に終わったスパン（バックグラウンドの要約など）は単独で書き出す
+            self.exporter.export([span])
+            return
+        self._pending.setdefault(span.trace_id, []).append(span)
+
+    def link_task(self, task_id):
+        """
+        現在のトレースをタスクに関連付ける
+        """
+        span = current_span.get()
+        if span is not None:
+            self.task_traces[task_id] = (span.session_id, span.trace_id)
+            self.task_traces.move_to_end(task_id)
+            while len(self.task_traces) > self.max_task_traces:
+                self.task_traces.popitem(last=False)
+
+    def task_trace(self, task_id):
+        """
+        タスクのトレースのスパンを開始順に返す（見つからなければNone）
+        """
+        entry = self.task_traces.get(task_id)
+        if entry is None:
+            return None
+        session_id, trace_id = entry
+        spans = [span for span in self.sessions.get(session_id, ()) if span.trace_id == trace_id]
+        return {
+            "task_id": task_id,
+            "trace_id": trace_id,
+            "spans": [span.to_dict() for span in sorted(spans, key=lambda span: span.start_ns)]
+        }
+
+    def drop_session(self, session_id):
+        self.sessions.pop(session_id, None)
+        for task_id, (span_session_id, _) in list(self.task_traces.items()):
+            if span_session_id == session_id:
+                del self.task_traces[task_id]
@@ -0,0 +1,177 @@
+"""
+セッション・タスクごとのリソース使用量の集計と、セッションごとの上限（予算）
+
+Ollamaの応答に含まれるトークン数と処理時間、ツールの実行時間、サブプロセスの
+CPU時間、web_fetchで取得したバイト数、ワークスペースへ書き込んだバイト数を
+セッションとタスクの単位で積算する。
+
+集計先のセッション・タスクはコンテキスト変数で結び付けるため、エージェントの処理から
+起動したバックグラウンドの処理（先行実行・要約）の使用量も同じタスクに計上される。
+"""
+
+import contextvars
+import time
+
+# 使用量の項目（いずれも加算していく値）
+USAGE_FIELDS = (
+    "llm_requests",
+    "prompt_tokens",
+    "prompt_seconds",
+    "eval_tokens",
+    "eval_seconds",
+    "llm_seconds",
+    "tool_calls",
+    "tool_seconds",
+    "subprocess_cpu_seconds",
+    "web_fetch_bytes",
+    "workspace_bytes_written",
+)
+
+# 上限を設定できる項目（tokens はプロンプトと生成のトークン数の合計）
+BUDGET_FIELDS = ("tokens", "llm_seconds", "tool_seconds", "subprocess_cpu_seconds")
+
+
+class UsageScope:
+    """
+    使用量を計上するセッションとタスク
+    """
+
+    __slots__ = ("session_id", "task_id")
+
+    def __init__(self, session_id, task_id=None):
+        self.session_id = session_id
+        self.task_id = task_id
+
+
+current_usage_scope = contextvars.ContextVar("usage_scope", default=None)
+
+
+class Usage:
+    """
+    1つのセッションまたはタスクの使用量
+    """
+
+    __slots__ = USAGE_FIELDS + ("updated_at",)
+
+    def __init__(self):
+        for name in USAGE_FIELDS:
+            setattr(self, name, 0)
+        self.updated_at = None
+
+    @property
+    def tokens(self):
+        return self.prompt_tokens + self.eval_tokens
+
+    def add(self, amounts):
+        for name, amount in amounts.items():
+            setattr(self, name, getattr(self, name) + amount)
+        self.updated_at = time.time()
+
+    def to_dict(self):
+        result = {}
+        for name in USAGE_FIELDS:
+            value = getattr(self, name)
+            result[name] = round(value, 4) if isinstance(value, float) else value
+        result["tokens"] = self.tokens
+        result["updated_at"] = self.updated_at
+        return result
+
+
+class UsageTracker:
+    """
+    セッション・タスクごとの使用量を積算し、セッションの上限を確認する
+    """
+
+    def __init__(self, budgets=None):
+        # 項目 -> セッションあたりの上限（0以下・未指定は無制限）
+        self.budgets = {name: limit for name, limit in (budgets or {}).items() if limit and limit > 0}
+        unknown = set(self.budgets) - set(BUDGET_FIELDS)
+        if unknown:
+            raise ValueError(f"上限を設定できない項目です: {', '.join(sorted(unknown))}")
+        self.sessions = {}
+        self.tasks = {}
+        # セッションID -> そのセッションのタスクID（セッションの削除時にまとめて消す）
+        self._session_tasks = {}
+
+    def bind(self, session_id):
+        """
+        現在のコンテキストの使用量をこのセッションに計上する
+        """
+        current_usage_scope.set(UsageScope(session_id))
+
+    def set_task(self, task_id):
+        """
+        現在のコンテキスト（とそこから起動した処理）の使用量をこのタスクにも計上する
+        """
+        scope = current_usage_scope.get()
+        if scope is not None:
+            scope.task_id = task_id
+            self._session_tasks.setdefault(scope.session_id, set()).add(task_id)
+
+    def add(self, **amounts):
+        scope = current_usage_scope.get()
+        if scope is None:
+            return
+        amounts = {name: amount for name, amount in amounts.items() if amount}
+        if not amounts:
+            return
+        usage = self.sessions.get(scope.session_id)
+        if usage is None:
+            usage = self.sessions[scope.session_id] = Usage()
+        usage.add(amounts)
+        if scope.task_id is not None:
+            task_usage = self.tasks.get(scope.task_id)
+            if task_usage is None:
+                task_usage = self.tasks[scope.task_id] = Usage()
+            task_usage.add(amounts)
+
+    def add_ollama_response(self, result):
+        """
+        Ollamaの応答（ストリーミングの場合は最後のチャンク）の計測値を計上する
+        """
+        self.add(
+            llm_requests=1,
+            prompt_tokens=result.get("prompt_eval_count") or 0,
+            prompt_seconds=(result.get("prompt_eval_duration") or 0) / 1e9,
+            eval_tokens=result.get("eval_count") or 0,
+            eval_seconds=(result.get("eval_duration") or 0) / 1e9,
+            llm_seconds=(result.get("total_duration") or 0) / 1e9
+        )
+
+    def session(self, session_id):
+        usage = self.sessions.get(session_id)
+        return usage.to_dict() if usage is not None else Usage().to_dict()
+
+    def task(self, task_id):
+        usage = self.tasks.get(task_id)
+        return usage.to_dict() if usage is not None else Usage().to_dict()
+
+    def exceeded(self, session_id):
+        """
+        上限に達した項目を (項目, 使用量, 上限) のリストで返す
+        """
+        usage = self.sessions.get(session_id)
+        if usage is None:
+            return []
+        return [
+            (name, getattr(usage, name), limit)
+            for name, limit in self.budgets.items() if getattr(usage, name) >= limit
+        ]
+
+    def report(self, session_id):
+        usage = self.session(session_id)
+        return {
+            "session_id": session_id,
+            "usage": usage,
+            "budgets": {
+                name: {"limit": limit, "used": usage[name], "remaining": max(0, limit - usage[name])}
+                for name, limit in self.budgets.items()
+            },
+            "exceeded": [name for name, _, _ in self.exceeded(session_id)],
+            "tasks": {task_id: self.task(task_id) for task_id in sorted(self._session_tasks.get(session_id, ()))}
+        }
+
+    def drop_session(self, session_id):
+        self.sessions.pop(session_id, None)
+        for task_id in self._session_tasks.pop(session_id, ()):
+            self.tasks.pop(task_id, None)
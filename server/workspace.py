@@ -0,0 +1,248 @@
+"""
+セッションごとの作業ディレクトリ（ワークスペース）を管理するモジュール
+
+ワークスペースのディスク使用量を記録してクォータを適用し、
+一定時間使われていないワークスペースをバックグラウンドで削除する。
+使用量は初回アクセス時に一度だけ走査し、以降はファイル書き込みの
+差分で更新する（シェルコマンドの後は変更内容が分からないため再走査する）。
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from session_ids import is_valid_session_id, session_path
+
+logger = logging.getLogger(__name__)
+
+
+class WorkspaceQuotaExceeded(Exception):
+    """
+    ワークスペースのディスク使用量がクォータを超えたことを示す例外
+    """
+
+
+def _scan_directory(path):
+    """
+    ディレクトリ配下のファイルの合計サイズとファイル数を数える（シンボリックリンクは辿らない）
+    """
+    total = 0
+    files = 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total, files
+
+
+class Workspace:
+    """
+    1セッション分のワークスペースの状態
+    """
+
+    def __init__(self, session_id, path):
+        self.session_id = session_id
+        self.path = path
+        self.bytes_used = 0
+        self.file_count = 0
+        self.scanned = False
+        self.last_used = time.time()
+        # 実行中のステップ数（0より大きい間は回収しない）
+        self.active = 0
+
+    def to_dict(self, quota_bytes):
+        return {
+            "session_id": self.session_id,
+            "path": self.path,
+            "bytes_used": self.bytes_used,
+            "file_count": self.file_count,
+            "quota_bytes": quota_bytes,
+            "last_used": self.last_used,
+            "active": self.active > 0
+        }
+
+
+class WorkspaceManager:
+    """
+    ワークスペースの作成・使用量の記録・クォータ確認・期限切れの回収を行う
+    """
+
+    def __init__(self, root="workspaces", quota_bytes=0, ttl=0, sweep_interval=300, on_reclaim=None):
+        self.root = root
+        # 0以下はクォータなし
+        self.quota_bytes = quota_bytes
+        # 0以下は回収しない
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        # 回収時に呼ぶコールバック（常駐シェルの終了など）
+        self.on_reclaim = on_reclaim
+        self.workspaces = {}
+        self._sweeper = None
+
+    def path_for(self, session_id):
+        """
+        セッションのワークスペースのパスを返す（IDが不正なら InvalidSessionId を送出する）
+        """
+        return session_path(self.root, session_id)
+
+    def get(self, session_id):
+        """
+        ワークスペースを取得する（未登録なら登録し、ディレクトリを作成する）
+        """
+        workspace = self.workspaces.get(session_id)
+        if workspace is None:
+            workspace = Workspace(session_id, self.path_for(session_id))
+            self.workspaces[session_id] = workspace
+        os.makedirs(workspace.path, exist_ok=True)
+        return workspace
+
+    async def _ensure_scanned(self, workspace):
+        if not workspace.scanned:
+            await self.rescan(workspace.session_id)
+
+    async def rescan(self, session_id):
+        """
+        ワークスペースを走査して使用量を更新する
+        """
+        workspace = self.get(session_id)
+        workspace.bytes_used, workspace.file_count = await asyncio.to_thread(_scan_directory, workspace.path)
+        workspace.scanned = True
+        return workspace
+
+    def use(self, session_id):
+        """
+        ステップ実行中にワークスペースを使用中として扱うコンテキストマネージャーを返す
+        """
+        return _WorkspaceLease(self, session_id)
+
+    def check_quota(self, session_id, additional_bytes=0):
+        """
+        追加で書き込んでもクォータ内に収まるか確認し、超える場合は例外を送出する
+        """
+        if self.quota_bytes <= 0:
+            return
+        workspace = self.get(session_id)
+        if workspace.bytes_used + additional_bytes > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(
+                f"ワークスペースのディスク使用量が上限を超えます: "
+                f"{workspace.bytes_used + additional_bytes} / {self.quota_bytes} バイト"
+            )
+
+    def record_write(self, session_id, old_size, new_size, new_file=False):
+        """
+        ファイルの書き込みによる使用量の変化を記録する
+        """
+        workspace = self.get(session_id)
+        workspace.bytes_used = max(0, workspace.bytes_used + new_size - old_size)
+        if new_file:
+            workspace.file_count += 1
+        workspace.last_used = time.time()
+
+    def usage(self, session_id):
+        """
+        セッションのワークスペースの使用状況を返す
+        """
+        workspace = self.workspaces.get(session_id)
+        if workspace is None:
+            return None
+        return workspace.to_dict(self.quota_bytes)
+
+    def all_usage(self):
+        return [workspace.to_dict(self.quota_bytes) for workspace in self.workspaces.values()]
+
+    async def remove(self, session_id):
+        """
+        ワークスペースを削除する
+        """
+        # IDを検証してから削除する（登録済みのワークスペースも同じパスになる）
+        path = self.path_for(session_id)
+        self.workspaces.pop(session_id, None)
+        if self.on_reclaim is not None:
+            await self.on_reclaim(session_id)
+        if os.path.isdir(path):
+            await asyncio.to_thread(shutil.rmtree, path, True)
+
+    def start(self):
+        """
+        期限切れワークスペースの回収タスクを開始する
+        """
+        if self.ttl > 0 and (self._sweeper is None or self._sweeper.done()):
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.exception("ワークスペースの回収中にエラーが発生しました: %s", e)
+
+    async def sweep(self):
+        """
+        最終使用から一定時間経過したワークスペースを削除する
+
+        サーバー再起動前に作成された未登録のディレクトリは更新日時で判定する。
+        """
+        if self.ttl <= 0 or not os.path.isdir(self.root):
+            return []
+        now = time.time()
+        reclaimed = []
+        for name in await asyncio.to_thread(os.listdir, self.root):
+            path = os.path.join(self.root, name)
+            # セッションIDの形式でないディレクトリはワークスペースではないため触らない
+            if not is_valid_session_id(name) or not os.path.isdir(path):
+                continue
+            workspace = self.workspaces.get(name)
+            if workspace is not None:
+                if workspace.active > 0:
+                    continue
+                last_used = workspace.last_used
+            else:
+                try:
+                    last_used = os.path.getmtime(path)
+                except OSError:
+                    continue
+            if now - last_used > self.ttl:
+                logger.info("期限切れのワークスペースを削除します: %s", path)
+                await self.remove(name)
+                reclaimed.append(name)
+        return reclaimed
+
+
+class _WorkspaceLease:
+    def __init__(self, manager, session_id):
+        self.manager = manager
+        self.session_id = session_id
+
+    async def __aenter__(self):
+        workspace = self.manager.get(self.session_id)
+        workspace.active += 1
+        workspace.last_used = time.time()
+        await self.manager._ensure_scanned(workspace)
+        return workspace
+
+    async def __aexit__(self, exc_type, exc, tb):
+        workspace = self.manager.workspaces.get(self.session_id)
+        if workspace is not None:
+            workspace.active -= 1
+            workspace.last_used = time.time()
+        return False